@@ -6,24 +6,676 @@
 # be invoked directly with ./backend/benchmark.py to simply run get_dupe_content()
 # and print traces to stdout (note: traces only available if DEBUG=1 set)
 
+#
+# the stub_* benchmarks don't need a plex server: they run against a tiny local
+# http server that only answers the handshake endpoints, and compare per-request
+# latency of building a fresh PlexWrapper against reusing the shared one.
+
+#
+# the fake_* benchmarks run against fakeplex.py, a synthetic plex server with
+# generated libraries, so they can run offline and be compared between commits:
+#
+#   make benchmark_offline                      # saves results under backend/.benchmarks
+#   make benchmark_compare                      # compares against the last saved run
+#
+# FAKE_PLEX_SIZES (comma separated, default 1000) sets the library sizes to run
+# every fake_* benchmark against, e.g. FAKE_PLEX_SIZES=1000,10000,100000.
+# FAKE_PLEX_DUPE_RATIO and FAKE_PLEX_LATENCY_MS are passed on to the server.
+
+from dotenv import load_dotenv
+
+# Before importing the backend: DEBUG decides which functions trace_time wraps
+# and the log level, both at import time
+load_dotenv()
+
+import io
+import json
 import os
 import pytest
+import socket
+import threading
 import time
-from plexwrapper import PlexWrapper
+import tracemalloc
+import xml.etree.ElementTree as ElementTree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from plexapi.video import Movie
+from types import SimpleNamespace
+import cli
+from crossdupes import CrossLibraryIndex, CrossServerIndex
+from database import Database
+from dupeindex import DupeIndex, DupeQuery
+from flask import Flask, request
+from flask.json.provider import DefaultJSONProvider
+from fakeplex import SECTIONS, FakeLibrary, count_subscribers, notify, start_fake_plex, timeline_entry
+from jsonresponse import FastJSONProvider, brotli, prepare_json_response
+from listener import ChangeListener
+from records import ContentRecord
+from thumbcache import ThumbnailCache
+from plexwrapper import PlexWrapper, get_plex_wrapper
+from scanner import DupeScanner
+from servers import ServerConfig, ServerPool
 from utils import print_top_traces
-from dotenv import load_dotenv
 
-load_dotenv()
+STUB_LATENCY = float(os.getenv("STUB_LATENCY_MS", "2")) / 1000
+CLI_BENCHMARK_ROWS = int(os.getenv("CLI_BENCHMARK_ROWS", "50000"))
+MEMORY_BENCHMARK_ITEMS = int(os.getenv("MEMORY_BENCHMARK_ITEMS", "100000"))
+QUERY_BENCHMARK_ITEMS = int(os.getenv("QUERY_BENCHMARK_ITEMS", "100000"))
+JSON_BENCHMARK_ITEMS = 10000
+FAKE_PLEX_SIZES = [int(size) for size in os.getenv("FAKE_PLEX_SIZES", "1000").split(",")]
+STUB_SERVER_XML = (
+    b'<?xml version="1.0" encoding="UTF-8"?>'
+    b'<MediaContainer size="0" friendlyName="Stub Plex" '
+    b'machineIdentifier="stub-machine-id" version="1.40.0.0"></MediaContainer>'
+)
+
+
+class StubPlexHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(STUB_LATENCY)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(STUB_SERVER_XML)))
+        self.end_headers()
+        self.wfile.write(STUB_SERVER_XML)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubPlexHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+@pytest.fixture(scope="module")
+def stub_plex(tmp_path_factory):
+    server, baseurl = start_stub_server()
+    previous = {key: os.environ.get(key) for key in ("PLEX_BASE_URL", "PLEX_TOKEN", "CONFIG_DIR")}
+    os.environ["PLEX_BASE_URL"] = baseurl
+    os.environ["PLEX_TOKEN"] = "stub-token"
+    os.environ["CONFIG_DIR"] = str(tmp_path_factory.mktemp("config"))
+    yield baseurl
+    server.shutdown()
+    for key, value in previous.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+@pytest.fixture(scope="module", params=FAKE_PLEX_SIZES, ids=lambda size: f"{size}items")
+def fake_plex(request, tmp_path_factory):
+    server, baseurl = start_fake_plex(size=request.param)
+    previous = {key: os.environ.get(key) for key in ("CONFIG_DIR", "LIBRARY_NAMES")}
+    os.environ["CONFIG_DIR"] = str(tmp_path_factory.mktemp("config"))
+    os.environ["LIBRARY_NAMES"] = "Movies;TV Shows"
+    wrapper = PlexWrapper(baseurl, "fake-token")
+    wrapper.fake_server = server
+    # measure round trips to plex, not the cross-worker cache (see test_fake_shared_cache_hit)
+    wrapper.shared_cache.enabled = False
+    yield wrapper
+    wrapper.executor.shutdown()
+    server.shutdown()
+    for key, value in previous.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+@pytest.fixture(scope="module")
+def fake_servers(tmp_path_factory):
+    # two fake servers, and one that accepts connections but never answers
+    fakes = [start_fake_plex(size=FAKE_PLEX_SIZES[0]) for _ in range(2)]
+    hole = socket.socket()
+    hole.bind(("127.0.0.1", 0))
+    hole.listen(16)
+    baseurls = [baseurl for server, baseurl in fakes] + [f"http://127.0.0.1:{hole.getsockname()[1]}"]
+    previous = {key: os.environ.get(key) for key in ("CONFIG_DIR", "LIBRARY_NAMES", "PLEX_TIMEOUT")}
+    config_dir = str(tmp_path_factory.mktemp("config"))
+    os.environ["CONFIG_DIR"] = config_dir
+    os.environ["LIBRARY_NAMES"] = "Movies;TV Shows"
+    os.environ["PLEX_TIMEOUT"] = "10"
+    configs = [
+        ServerConfig(name, baseurl, "fake-token", os.path.join(config_dir, "servers", name))
+        for name, baseurl in zip(("Home", "Cabin", "Offline"), baseurls)
+    ]
+    wrappers = {}
+
+    def get_wrapper(name):
+        # no lock, so connecting to the silent server doesn't block the others
+        if name not in wrappers:
+            config = next(config for config in configs if config.name == name)
+            os.makedirs(config.config_dir, exist_ok=True)
+            wrapper = PlexWrapper(config.baseurl, config.token, config.name, config.config_dir)
+            wrapper.shared_cache.enabled = False
+            wrappers[name] = wrapper
+        return wrappers[name]
+
+    yield configs, get_wrapper
+    # unblocks the requests still waiting on the silent server
+    hole.close()
+    for server, baseurl in fakes:
+        server.shutdown()
+    for key, value in previous.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+def server_info_per_request_wrapper():
+    # behaviour before the shared wrapper: a new session and handshake per call
+    return PlexWrapper().get_server_info()
+
+
+def server_info_shared_wrapper():
+    return get_plex_wrapper().get_server_info()
+
+
+def make_movie_items(plex, count, media_count=2, part_count=2):
+    # search results as plex returns them: partial objects with media, parts
+    # and streams, and every attribute the serializers read already present
+    items = []
+    for i in range(count):
+        video = ElementTree.Element("Video", {
+            "ratingKey": str(i), "key": f"/library/metadata/{i}", "type": "movie", "librarySectionID": "1",
+            "title": f"Movie {i}", "guid": f"plex://movie/{i}", "year": "2000",
+            "duration": "5400000", "thumb": f"/library/metadata/{i}/thumb/1",
+        })
+        for m in range(media_count):
+            media = ElementTree.SubElement(video, "Media", {
+                "id": str(i * media_count + m), "duration": "5400000", "bitrate": "8000",
+                "width": "1920", "height": "1080", "container": "mkv", "videoCodec": "h264",
+                "videoResolution": "1080", "audioCodec": "aac", "audioChannels": "2",
+            })
+            for p in range(part_count):
+                part = ElementTree.SubElement(media, "Part", {
+                    "id": str((i * media_count + m) * part_count + p), "size": "4000000000",
+                    "file": f"/movies/{i}/{m}-{p}.mkv", "container": "mkv", "duration": "2700000",
+                    "key": f"/library/parts/{i}{m}{p}/file.mkv", "exists": "1", "accessible": "1",
+                })
+                ElementTree.SubElement(part, "Stream", {"id": "1", "streamType": "1", "codec": "h264"})
+        items.append(Movie(plex, video, "/library/sections/1/all"))
+    return items
+
+
+def count_threads_started(func, *args):
+    started = [0]
+    original_start = threading.Thread.start
+
+    def counting_start(thread):
+        started[0] += 1
+        return original_start(thread)
+
+    threading.Thread.start = counting_start
+    try:
+        func(*args)
+    finally:
+        threading.Thread.start = original_start
+    return started[0]
+
+
+def serialize_dupes(wrapper, items):
+    section = SimpleNamespace(type="movie", title="Movies")
+    return wrapper._serialize_dupes(section, items)
+
+
+def make_ignored_db(config_dir, count=10000):
+    os.environ["CONFIG_DIR"] = str(config_dir)
+    db = Database()
+    with db.transaction() as conn:
+        conn.executemany("INSERT INTO ignored (key) VALUES (?)", ((f"/library/metadata/{i}",) for i in range(count)))
+        db._bump_ignored_version(conn)
+    return db
+
+
+def lookup_ignored_query(db, keys):
+    # one indexed query per lookup, for comparison with the in-memory set
+    conn = db.get_db()
+    return [conn.execute("SELECT 1 FROM ignored WHERE key = ?", (key,)).fetchone() is not None for key in keys]
+
+
+def add_deleted_sizes(db, count=100):
+    for _ in range(count):
+        db.add_deleted_size("Movies", 1024)
+
+
+def lookup_ignored(db, keys):
+    return [db.is_ignored(key) for key in keys]
+
+
+def scan_all_dupes(wrapper):
+    # every window of every library, as the background scanner fetches them
+    dupes = []
+    for section in wrapper._get_sections():
+        total = wrapper.count_dupe_content_for_section(section)
+        for offset in range(0, total, wrapper.page_size):
+            dupes.extend(wrapper.scan_dupe_content_for_section(section, offset, wrapper.page_size)[0])
+    return dupes
+
+
+def fetch_metadata_elements(wrapper, count=100):
+    section = wrapper._get_sections()[0]
+    keys = [item.ratingKey for item in wrapper._search_dupe_window(section, 0, count)]
+    return wrapper.plex.query(f"/library/metadata/{','.join(map(str, keys))}").findall("Video")
+
+
+def serialize_elements(wrapper, videos):
+    return [wrapper.video_element_to_dict(video, "Movies") for video in videos]
+
+
+def build_cross_library_index(wrapper, sections, path):
+    if os.path.exists(path):
+        os.remove(path)
+    index = CrossLibraryIndex(path)
+    index.update(wrapper, sections, 200)
+    return index.get_groups()
+
+
+def update_cross_library_index(index, wrapper, sections):
+    index.update(wrapper, sections, 200)
+    index._groups = None
+    return index.get_groups()
+
+
+def notify_and_wait(wrapper, listener, entries):
+    # from a notification being sent to the dupe index having been updated
+    refreshed = listener.get_status()["refreshed"]
+    notify(wrapper.fake_server, entries)
+    while listener.get_status()["refreshed"] == refreshed:
+        time.sleep(0.001)
+
+
+def toggle_ignored(db, count=100):
+    for i in range(count):
+        db.add_ignored_item(f"/library/metadata/{i}")
+        db.remove_ignored_item(f"/library/metadata/{i}")
+
+
+def make_scan_results_json(wrapper, count):
+    # serialized episodes, every one a duplicate, dumped the way the dupe index
+    # stores them so neither representation shares strings with the other
+    library = FakeLibrary(count, 1)
+    return json.dumps([
+        wrapper.video_element_to_dict(ElementTree.fromstring(library.video_xml(SECTIONS[1], i, full=True)), "TV Shows")
+        for i in range(count)
+    ])
+
+
+def measure_memory(func, *args):
+    # bytes still allocated once func returns, counting only what it keeps
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def load_scan_result_dicts(data):
+    return json.loads(data)
+
+
+def load_scan_result_records(data):
+    return [ContentRecord.from_dict(item) for item in json.loads(data)]
+
+
+def make_dupe_index(wrapper, path, count):
+    index = DupeIndex(str(path))
+    index.replace(json.loads(make_scan_results_json(wrapper, count)))
+    return index
+
+
+def query_dupe_index(index, query, fresh):
+    if fresh:
+        # as right after a scan, before the query's matches are cached
+        index._queries.clear()
+    return index.query(query, 50, offset=50)
+
+
+@pytest.fixture(scope="module")
+def json_results(stub_plex):
+    return json.loads(make_scan_results_json(get_plex_wrapper(), JSON_BENCHMARK_ITEMS))
+
+
+def encode_json_response(app, data):
+    with app.app_context():
+        return app.json.response(data)
+
+
+def send_json_response(app, data, accept_encoding):
+    # encode, then add the etag and compress, as for a GET /content/dupes
+    with app.test_request_context(headers={"Accept-Encoding": accept_encoding}):
+        return prepare_json_response(app.json.response(data), request)
+
+
+def make_json_app(provider):
+    app = Flask(__name__)
+    app.json = provider(app)
+    return app
+
+
+class RecordingWindow(object):
+    # stands in for a curses window, counting the lines written
+    def __init__(self, height=50, width=200):
+        self.size = (height, width)
+        self.lines_written = 0
+
+    def getmaxyx(self):
+        return self.size
+
+    def move(self, y, x):
+        pass
+
+    def clrtoeol(self):
+        pass
+
+    def addnstr(self, *args):
+        self.lines_written += 1
+
+
+def make_cli_rows(wrapper, count):
+    # every dupe has two single-part media, so two rows each
+    dupes = json.loads(make_scan_results_json(wrapper, count // 2))
+    app = cli.CleanarrCli(wrapper=SimpleNamespace())
+    for start in range(0, len(dupes), 50):
+        app.add_dupes(dupes[start:start + 50])
+    return app
+
+
+def scroll_cli(app, window, steps):
+    for _ in range(steps):
+        app.move_to(app.current_index + 1, len(app.rows))
+        app.draw(window)
+
+
+def load_cli_pages(wrapper):
+    app = cli.CleanarrCli(wrapper=wrapper)
+    for content in app.iter_dupe_pages(wrapper.get_dupe_content):
+        app.add_dupes(content)
+    return app
+
 
 def get_dupe_content(page):
     return PlexWrapper().get_dupe_content(int(page))
 
+@pytest.mark.skipif(not os.getenv("PLEX_BASE_URL"), reason="needs a plex server configured in .env")
 def test_get_dupe_content(benchmark):
     benchmark.pedantic(get_dupe_content, iterations=10, rounds=3)
 
+def test_stub_server_info_per_request_wrapper(benchmark, stub_plex):
+    benchmark(server_info_per_request_wrapper)
+
+def test_stub_server_info_shared_wrapper(benchmark, stub_plex):
+    benchmark(server_info_shared_wrapper)
+
+def test_ignored_lookup_10k_query(benchmark, tmp_path):
+    db = make_ignored_db(tmp_path)
+    keys = [f"/library/metadata/{i}" for i in range(0, 20000, 200)]
+    benchmark(lookup_ignored_query, db, keys)
+
+def test_ignored_lookup_10k_in_memory(benchmark, tmp_path):
+    db = make_ignored_db(tmp_path)
+    keys = [f"/library/metadata/{i}" for i in range(0, 20000, 200)]
+    benchmark(lookup_ignored, db, keys)
+
+def test_add_deleted_size_100_writes(benchmark, tmp_path):
+    os.environ["CONFIG_DIR"] = str(tmp_path)
+    benchmark(add_deleted_sizes, Database())
+
+def test_stub_serialize_1000_items(benchmark, stub_plex):
+    wrapper = get_plex_wrapper()
+    items = make_movie_items(wrapper.plex, 1000)
+    benchmark.extra_info["threads_started"] = count_threads_started(serialize_dupes, wrapper, items)
+    benchmark.pedantic(serialize_dupes, args=(wrapper, items), iterations=1, rounds=5)
+
+def test_fake_get_dupe_content(benchmark, fake_plex):
+    benchmark(fake_plex.get_dupe_content, 1)
+
+def test_fake_get_dupe_content_with_errors(benchmark, fake_plex):
+    # 5% of requests fail with a 503 and are retried by the request governor
+    handler = fake_plex.fake_server.RequestHandlerClass
+    handler.error_rate = 0.05
+    try:
+        benchmark(fake_plex.get_dupe_content, 1)
+    finally:
+        handler.error_rate = 0
+    benchmark.extra_info["governor"] = fake_plex.governor.get_status()
+
+def test_fake_get_dupe_content_bulk(benchmark, fake_plex):
+    fake_plex.bulk_fetch = True
+    try:
+        benchmark(fake_plex.get_dupe_content, 1)
+    finally:
+        fake_plex.bulk_fetch = False
+
+def test_fake_get_dupe_content_page(benchmark, fake_plex):
+    benchmark(fake_plex.get_dupe_content_page)
+
+def test_fake_shared_cache_hit(benchmark, fake_plex):
+    # a page another worker has already fetched
+    fake_plex.shared_cache.enabled = True
+    try:
+        fake_plex.get_dupe_content(1)
+        benchmark(fake_plex.get_dupe_content, 1)
+    finally:
+        fake_plex.invalidate_dupe_content()
+        fake_plex.shared_cache.enabled = False
+
+def test_fake_scan_all_dupes(benchmark, fake_plex):
+    dupes = benchmark.pedantic(scan_all_dupes, args=(fake_plex,), iterations=1, rounds=3)
+    benchmark.extra_info["dupes"] = len(dupes)
+
+def test_fake_get_content_sample_files(benchmark, fake_plex):
+    benchmark.pedantic(fake_plex.get_content_sample_files, kwargs={"refresh": True}, iterations=1, rounds=3)
+
+def test_fake_serialize_search_results(benchmark, fake_plex):
+    section = fake_plex._get_sections()[0]
+    items = fake_plex._search_dupe_window(section, 0, 100)
+    benchmark(fake_plex._serialize_dupes, section, items)
+
+def test_fake_serialize_metadata_elements(benchmark, fake_plex):
+    benchmark(serialize_elements, fake_plex, fetch_metadata_elements(fake_plex))
+
+def test_fake_cross_library_full_scan(benchmark, fake_plex, tmp_path):
+    sections = [fake_plex.plex.library.section(title) for title in ("Movies", "Movies 4K")]
+    groups = benchmark.pedantic(
+        build_cross_library_index, args=(fake_plex, sections, str(tmp_path / "index.json")), iterations=1, rounds=3
+    )
+    benchmark.extra_info["groups"] = len(groups)
+
+def test_fake_cross_library_incremental_scan(benchmark, fake_plex, tmp_path):
+    sections = [fake_plex.plex.library.section(title) for title in ("Movies", "Movies 4K")]
+    index = CrossLibraryIndex(str(tmp_path / "index.json"))
+    index.update(fake_plex, sections, 200)
+    benchmark(update_cross_library_index, index, fake_plex, sections)
+
+def test_fake_servers_merged_page_one_offline(benchmark, fake_servers):
+    # one page from every server at once; the silent server must not hold up the others
+    configs, get_wrapper = fake_servers
+    for config in configs[:2]:
+        get_wrapper(config.name)
+    pool = ServerPool(get_wrapper, configs)
+    pool.timeout = 1
+    pool.map(lambda wrapper: wrapper.get_dupe_content(1))
+    results, errors = benchmark(pool.map, lambda wrapper: wrapper.get_dupe_content(1))
+    assert list(results) == ["Home", "Cabin"] and list(errors) == ["Offline"]
+    benchmark.extra_info["items"] = sum(len(dupes) for dupes in results.values())
+
+def test_fake_cross_server_groups(benchmark, fake_servers):
+    configs, get_wrapper = fake_servers
+    for config in configs[:2]:
+        wrapper = get_wrapper(config.name)
+        sections = [wrapper.plex.library.section(title) for title in ("Movies", "TV Shows")]
+        wrapper.cross_library_index.update(wrapper, sections, 200)
+    # the offline server has no wrapper, so its fingerprints are read from disk
+    index = CrossServerIndex(configs, lambda name: get_wrapper(name) if name != "Offline" else None)
+
+    def rebuild():
+        # as after one of the servers has been scanned again
+        index._versions = None
+        return index.get_groups()
+
+    groups = benchmark(rebuild)
+    benchmark.extra_info["groups"] = len(groups)
+
+def test_fake_refresh_100_changed_items(benchmark, fake_plex):
+    scanner = DupeScanner(lambda: fake_plex)
+    scanner.scan()
+    rating_keys = [str(FakeLibrary.rating_key("1", i)) for i in range(100)]
+    benchmark(fake_plex.refresh_content, rating_keys)
+
+def test_fake_notification_to_index(benchmark, fake_plex):
+    scanner = DupeScanner(lambda: fake_plex)
+    scanner.scan()
+    listener = ChangeListener(lambda: fake_plex, scanner)
+    listener.enabled = True
+    listener.debounce = listener.max_delay = 0
+    listener.start()
+    try:
+        while count_subscribers(fake_plex.fake_server) == 0:
+            time.sleep(0.01)
+        entries = [timeline_entry(FakeLibrary.rating_key("1", i)) for i in range(10)]
+        benchmark(notify_and_wait, fake_plex, listener, entries)
+    finally:
+        listener.stop()
+
+def test_fake_delete_media(benchmark, fake_plex):
+    # the fake server accepts deletes without applying them, so every round
+    # deletes the same media
+    dupe = fake_plex.get_dupe_content(1)[0]
+    benchmark(fake_plex.delete_media, dupe["library"], dupe["key"], dupe["media"][0]["id"])
+
+def test_fake_thumbnail_cache_hit(benchmark, fake_plex):
+    cache = ThumbnailCache()
+    key = fake_plex.get_dupe_content(1)[0]["key"]
+    benchmark(cache.get, fake_plex, key)
+
+def test_fake_thumbnail_cache_revalidate(benchmark, fake_plex):
+    cache = ThumbnailCache()
+    cache.ttl = 0
+    key = fake_plex.get_dupe_content(1)[0]["key"]
+    benchmark(cache.get, fake_plex, key)
+
+def test_ignore_toggle_100_items(benchmark, tmp_path):
+    os.environ["CONFIG_DIR"] = str(tmp_path)
+    benchmark(toggle_ignored, Database())
+
+def test_scan_results_memory_100k_dicts(benchmark, stub_plex):
+    data = make_scan_results_json(get_plex_wrapper(), MEMORY_BENCHMARK_ITEMS)
+    benchmark.extra_info["bytes"] = measure_memory(load_scan_result_dicts, data)[1]
+    benchmark.pedantic(load_scan_result_dicts, args=(data,), iterations=1, rounds=1)
+
+def test_scan_results_memory_100k_records(benchmark, stub_plex):
+    data = make_scan_results_json(get_plex_wrapper(), MEMORY_BENCHMARK_ITEMS)
+    benchmark.extra_info["bytes"] = measure_memory(load_scan_result_records, data)[1]
+    benchmark.pedantic(load_scan_result_records, args=(data,), iterations=1, rounds=1)
+
+def test_dupe_index_query_first_page(benchmark, stub_plex, tmp_path):
+    index = make_dupe_index(get_plex_wrapper(), tmp_path / "dupe_index.db", QUERY_BENCHMARK_ITEMS)
+    query = DupeQuery(resolutions=["1080"], search="show 1", sort="-reclaimable")
+    benchmark.pedantic(query_dupe_index, args=(index, query, True), iterations=1, rounds=3)
+
+def test_dupe_index_query_next_page(benchmark, stub_plex, tmp_path):
+    index = make_dupe_index(get_plex_wrapper(), tmp_path / "dupe_index.db", QUERY_BENCHMARK_ITEMS)
+    query = DupeQuery(resolutions=["1080"], search="show 1", sort="-reclaimable")
+    query_dupe_index(index, query, True)
+    benchmark(query_dupe_index, index, query, False)
+
+def test_json_encode_10k_flask_default(benchmark, json_results):
+    response = benchmark(encode_json_response, make_json_app(DefaultJSONProvider), json_results)
+    benchmark.extra_info["bytes"] = len(response.get_data())
+
+def test_json_encode_10k_fast(benchmark, json_results):
+    response = benchmark(encode_json_response, make_json_app(FastJSONProvider), json_results)
+    benchmark.extra_info["bytes"] = len(response.get_data())
+
+def test_json_response_10k_gzip(benchmark, json_results):
+    response = benchmark(send_json_response, make_json_app(FastJSONProvider), json_results, "gzip")
+    assert response.headers["Content-Encoding"] == "gzip"
+    benchmark.extra_info["bytes"] = len(response.get_data())
+
+@pytest.mark.skipif(brotli is None, reason="brotli is not installed")
+def test_json_response_10k_brotli(benchmark, json_results):
+    response = benchmark(send_json_response, make_json_app(FastJSONProvider), json_results, "br")
+    assert response.headers["Content-Encoding"] == "br"
+    benchmark.extra_info["bytes"] = len(response.get_data())
+
+def test_cli_scroll_50k_rows(benchmark, stub_plex):
+    app = make_cli_rows(get_plex_wrapper(), CLI_BENCHMARK_ROWS)
+    # start at the end of the list, so nothing is cheaper for being near the top
+    app.move_to(len(app.rows) - 1000, len(app.rows))
+    window = RecordingWindow()
+    app.draw(window)
+    window.lines_written = 0
+    benchmark.pedantic(scroll_cli, args=(app, window, 100), iterations=1, rounds=5)
+    benchmark.extra_info["lines_per_keypress"] = window.lines_written / 500
+
+def test_cli_move_within_screen_50k_rows(benchmark, stub_plex):
+    app = make_cli_rows(get_plex_wrapper(), CLI_BENCHMARK_ROWS)
+    window = RecordingWindow()
+    app.draw(window)
+    window.lines_written = 0
+    keypresses = []
+
+    def move_down_and_up():
+        app.move_to(app.current_index + 1, len(app.rows))
+        app.draw(window)
+        app.move_to(app.current_index - 1, len(app.rows))
+        app.draw(window)
+        keypresses.append(2)
+
+    benchmark(move_down_and_up)
+    benchmark.extra_info["lines_per_keypress"] = window.lines_written / sum(keypresses)
+
+def test_fake_cli_load_pages_prefetch(benchmark, fake_plex):
+    benchmark(load_cli_pages, fake_plex)
+
+def test_fake_cli_load_pages_sequential(benchmark, fake_plex, monkeypatch):
+    monkeypatch.setattr(cli, "PREFETCH_PAGES", 1)
+    benchmark(load_cli_pages, fake_plex)
+
+def test_fake_cli_batch_plan(benchmark, fake_plex):
+    # streams every duplicate through the keep rules into a JSON Lines export, as `cli.py --batch` does
+    app = cli.CleanarrCli(wrapper=fake_plex)
+    rules = cli.KeepRules(["resolution", "bitrate"])
+
+    def plan():
+        return app.plan_deletes(rules, cli.JsonLinesExport(io.StringIO()))
+
+    items, reclaimable = benchmark(plan)
+    benchmark.extra_info["media_to_delete"] = len(items)
+    benchmark.extra_info["reclaimable_bytes"] = sum(reclaimable.values())
+
 
 # allow for direct invocation, without pytest
-if __name__ == "__main__":
+if __name__ == "__main__" and os.getenv("STUB") == "1":
+    server, os.environ["PLEX_BASE_URL"] = start_stub_server()
+    os.environ["PLEX_TOKEN"] = "stub-token"
+    for name, func in (
+        ("per-request wrapper", server_info_per_request_wrapper),
+        ("shared wrapper", server_info_shared_wrapper),
+    ):
+        start = time.perf_counter()
+        for _ in range(100):
+            func()
+        print(f"{name}: {(time.perf_counter() - start) * 10:.2f} ms/request")
+    wrapper = get_plex_wrapper()
+    items = make_movie_items(wrapper.plex, 1000)
+    start = time.perf_counter()
+    threads = count_threads_started(serialize_dupes, wrapper, items)
+    print(f"serialize 1000 items: {time.perf_counter() - start:.3f}s, {threads} threads started")
+    data = make_scan_results_json(wrapper, MEMORY_BENCHMARK_ITEMS)
+    for name, func in (("dicts", load_scan_result_dicts), ("records", load_scan_result_records)):
+        _, size = measure_memory(func, data)
+        print(f"{MEMORY_BENCHMARK_ITEMS} scan results as {name}: {size / 1024 / 1024:.1f} MiB")
+    server.shutdown()
+elif __name__ == "__main__":
     dupes = get_dupe_content(os.getenv("PAGE", "1"))
     if dupes:
         print(f"found {len(dupes)} dupes")
@@ -1,17 +1,203 @@
 #!/usr/bin/env python3
+import argparse
+import csv
+import json
 import os
-import re
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import curses
 
 from plexwrapper import PlexWrapper
 
+# Pages requested from Plex at once, ahead of the ones already shown
+PREFETCH_PAGES = int(os.environ.get("CLI_PREFETCH_PAGES", 4))
+# How often the screen picks up newly loaded rows, in milliseconds
+REFRESH_INTERVAL = 100
+SPINNER = "|/-\\"
+# What --keep can rank copies by, highest first
+KEEP_RULES = ("resolution", "bitrate", "size", "container", "path")
+CSV_COLUMNS = ("library", "key", "title", "year", "media_id", "action", "resolution", "bitrate", "container", "size", "file")
+
+
+def resolution_rank(media):
+    # Plex reports "sd", "480", "720", "1080", "4k" or "8k"
+    resolution = (media.get("videoResolution") or "").lower()
+    if resolution.endswith("k") and resolution[:-1].isdigit():
+        return int(resolution[:-1]) * 540
+    if resolution.isdigit():
+        return int(resolution)
+    if resolution == "sd":
+        return 480
+    return media.get("height") or 0
+
+
+def media_size(media):
+    return sum(part.get("size") or 0 for part in media["parts"])
+
+
+class KeepRules:
+    """
+    Picks the copy of a duplicate to keep by comparing rules in order, each
+    only breaking ties left by the ones before it. Copies still tied after
+    every rule are kept in Plex's order, so the first one wins.
+    """
+
+    def __init__(self, rules, container=None, path_prefix=None):
+        self.rules = rules
+        self.container = container.lower() if container else None
+        self.path_prefix = path_prefix
+
+    def rank(self, media):
+        ranks = []
+        for rule in self.rules:
+            if rule == "resolution":
+                ranks.append(resolution_rank(media))
+            elif rule == "bitrate":
+                ranks.append(media.get("bitrate") or 0)
+            elif rule == "size":
+                ranks.append(media_size(media))
+            elif rule == "container":
+                ranks.append((media.get("container") or "").lower() == self.container)
+            elif rule == "path":
+                ranks.append(any((part.get("file") or "").startswith(self.path_prefix) for part in media["parts"]))
+        return ranks
+
+    def select(self, dupe):
+        """Return the media to keep and the list of media to delete."""
+        keep = max(dupe["media"], key=self.rank)
+        return keep, [media for media in dupe["media"] if media is not keep]
+
+
+class JsonLinesExport:
+    """One JSON object per duplicate, with the copy kept and those to delete."""
+
+    def __init__(self, output):
+        self.output = output
+
+    @staticmethod
+    def media_to_dict(media):
+        return {
+            "id": media["id"],
+            "resolution": media.get("videoResolution"),
+            "bitrate": media.get("bitrate"),
+            "container": media.get("container"),
+            "size": media_size(media),
+            "files": [part.get("file") for part in media["parts"]],
+        }
+
+    def write(self, dupe, keep, delete):
+        record = {
+            "library": dupe["library"],
+            "key": dupe["key"],
+            "title": dupe.get("title"),
+            "year": dupe.get("year"),
+            "keep": self.media_to_dict(keep),
+            "delete": [self.media_to_dict(media) for media in delete],
+            "reclaimable": sum(media_size(media) for media in delete),
+        }
+        self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        self.output.flush()
+
+
+class CsvExport:
+    """One CSV row per file, marked keep or delete."""
+
+    def __init__(self, output):
+        self.output = output
+        self.writer = csv.writer(output)
+        self.writer.writerow(CSV_COLUMNS)
+
+    def write(self, dupe, keep, delete):
+        for media in dupe["media"]:
+            action = "keep" if media is keep else "delete"
+            for part in media["parts"]:
+                self.writer.writerow((
+                    dupe["library"], dupe["key"], dupe.get("title"), dupe.get("year"), media["id"], action,
+                    media.get("videoResolution"), media.get("bitrate"), media.get("container"),
+                    part.get("size"), part.get("file"),
+                ))
+
+    def flush(self):
+        self.output.flush()
+
+
+EXPORTS = {"jsonl": JsonLinesExport, "csv": CsvExport}
+
+
+class BatchState:
+    """
+    Progress of a batch delete as JSON Lines: the planned deletions first,
+    then each media deleted, then a completion marker. A run given the state
+    file of an incomplete one deletes what is left of its plan instead of
+    scanning again. Failed deletes aren't recorded, so they are retried.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def load_pending(self):
+        """Return the deletions left from an incomplete run, or None."""
+        if not os.path.exists(self.path):
+            return None
+        planned = []
+        deleted = set()
+        with open(self.path, encoding="utf-8") as state_file:
+            for line in state_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may have been cut short by a crash
+                    continue
+                if "delete" in entry:
+                    planned.append(tuple(entry["delete"]))
+                elif "deleted" in entry:
+                    deleted.add(entry["deleted"])
+                elif entry.get("complete"):
+                    return None
+        return [item for item in planned if item[2] not in deleted]
+
+    def start(self, items):
+        self.file = open(self.path, "w", encoding="utf-8")
+        for item in items:
+            self.file.write(json.dumps({"delete": list(item)}) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, result):
+        if result["success"]:
+            self.file.write(json.dumps({"deleted": result["media_id"]}) + "\n")
+            self.file.flush()
+
+    def finish(self, complete):
+        if complete:
+            self.file.write(json.dumps({"complete": True}) + "\n")
+        self.file.close()
+
 
 class CleanarrCli:
-    def __init__(self):
-        self.wrapper = PlexWrapper()
+    def __init__(self, wrapper=None):
+        self.wrapper = wrapper or PlexWrapper()
         self.items_obj = {}
+        # (dupe, media id, part) for every file, appended to by the loader
+        # thread while the list is already on screen
+        self.rows = []
+        self.checkboxes = []
+        self.rows_lock = threading.Lock()
+        self.loading = False
+        self.pages_loaded = 0
+        self.load_error = None
+        self.stopped = threading.Event()
+        self.current_index = 0
+        self.top_row = 0
+        self.selected_attr = 0
+        # Screen line -> what was last drawn there, so only changed lines are repainted
+        self.drawn = {}
+        self.ticks = 0
 
     @staticmethod
     def validate_env():
@@ -25,17 +211,6 @@ class CleanarrCli:
             raise Exception("Please provide all environment variables {}".format(envs))
 
     # Curses section
-    @staticmethod
-    def draw_checkbox(win, y, x, checked):
-        try:
-            if checked:
-                win.addstr(y, x, "[X] ")
-            else:
-                win.addstr(y, x, "[ ] ")
-        except Exception as err:
-            print(err)
-            pass
-
     @staticmethod
     def format_bytes(fbytes):
         if fbytes >= 1024**3:  # GB
@@ -47,110 +222,175 @@ class CleanarrCli:
         else:
             return f"{fbytes} bytes"
 
+    def format_row(self, index):
+        # Built only for rows on screen, not for the whole library up front
+        dupe, media_id, part = self.rows[index]
+        return f"{dupe['title']} - {part['file']} @ {self.format_bytes(part['size'])} [{media_id}]"
+
+    def add_dupes(self, dupes):
+        rows = []
+        checkboxes = []
+        for dupe in dupes:
+            is_first = True
+            for media in dupe["media"]:
+                for part in media["parts"]:
+                    rows.append((dupe, media["id"], part))
+                    # Every file but the first of each item starts checked
+                    checkboxes.append(not is_first)
+                    is_first = False
+                self.items_obj[media["id"]] = {
+                    "dupe": dupe,
+                }
+        with self.rows_lock:
+            self.rows.extend(rows)
+            self.checkboxes.extend(checkboxes)
+            self.pages_loaded += 1
+
+    def load_rows(self):
+        try:
+            for content in self.iter_dupe_pages(self.wrapper.get_dupe_content):
+                if self.stopped.is_set():
+                    break
+                self.add_dupes(content)
+        except Exception as err:
+            self.load_error = str(err)
+        finally:
+            self.loading = False
+
+    def draw_line(self, win, y, width, state, text, attr=0):
+        if self.drawn.get(y) == state:
+            return
+        win.move(y, 0)
+        win.clrtoeol()
+        if text is not None:
+            try:
+                win.addnstr(y, 0, text, width - 1, attr)
+            except curses.error:
+                # Writing the bottom-right corner moves the cursor off screen
+                pass
+        self.drawn[y] = state
+
+    def draw(self, win):
+        height, width = win.getmaxyx()
+        list_height = max(height - 1, 1)
+        with self.rows_lock:
+            count = len(self.rows)
+        if self.current_index < self.top_row:
+            self.top_row = self.current_index
+        elif self.current_index >= self.top_row + list_height:
+            self.top_row = self.current_index - list_height + 1
+
+        for y in range(list_height):
+            index = self.top_row + y
+            if index >= count:
+                self.draw_line(win, y, width, (), None)
+                continue
+            checked = self.checkboxes[index]
+            selected = index == self.current_index
+            state = (index, checked, selected)
+            if self.drawn.get(y) != state:
+                checkbox = "[X] " if checked else "[ ] "
+                attr = self.selected_attr if selected else 0
+                self.draw_line(win, y, width, state, checkbox + self.format_row(index), attr)
+
+        if self.load_error is not None:
+            status = f"Loading failed after {count} rows: {self.load_error}"
+        elif self.loading:
+            self.ticks += 1
+            spinner = SPINNER[self.ticks % len(SPINNER)]
+            status = f"{spinner} Loading page {self.pages_loaded + 1}... {count} rows so far"
+        else:
+            status = f"{count} rows. Up/Down/PgUp/PgDn/Home/End move, Space toggles, Enter deletes checked, Q quits"
+        self.draw_line(win, height - 1, width, status, status, curses.A_REVERSE)
+        return list_height, count
+
+    def move_to(self, index, count):
+        self.current_index = max(0, min(index, count - 1))
+
+    def confirm_delete(self):
+        confirm_win = curses.newwin(5, curses.COLS - 2, curses.LINES - 7, 1)
+        confirm_win.box()
+        confirm_win.addstr(1, 2, "Are you sure you want to delete these?")
+        confirm_win.addstr(4, 2, "[Y] Yes    [N] No")
+        confirm_win.refresh()
+
+        while True:
+            confirm_key = confirm_win.getch()
+            if confirm_key == ord("y") or confirm_key == ord("Y"):
+                confirm_win.clear()
+                confirm_win.refresh()
+                confirm_win.addstr(1, 2, "I shall continue with deletion!")
+                confirm_win.refresh()
+                return True
+            elif confirm_key == ord("n") or confirm_key == ord("N"):
+                confirm_win.clear()
+                confirm_win.refresh()
+                confirm_win.addstr(1, 2, "Deletion canceled!")
+                confirm_win.refresh()
+                return False
+
     def start_curses(self, stdscr):
         curses.curs_set(0)
 
         curses.start_color()
         curses.init_pair(1, curses.COLOR_CYAN, curses.COLOR_BLACK)
         curses.init_pair(2, curses.COLOR_BLACK, curses.COLOR_CYAN)
+        self.selected_attr = curses.color_pair(2)
 
-        # Initialize the list of items and checkboxes
-        items = []
-        self.items_obj = {}
-        firsts = []
-        dupes = self.get_all_dupes()
-        for dupe in dupes:
-            is_first = True
-            for media in dupe["media"]:
-                for part in media["parts"]:
-                    if is_first is True:
-                        firsts.append(len(items))
-                        is_first = False
-                    items.append(
-                        f"{dupe['title']} - {part['file']} @ {self.format_bytes(part['size'])} [{media['id']}]"
-                    )
-                    self.items_obj[media["id"]] = {
-                        "dupe": dupe,
-                    }
-
-        checkboxes = [True] * len(items)
-        for first in firsts:
-            checkboxes[first] = False
-        current_index = 0
-        top_row = 0
-        bottom_row = min(curses.LINES - 2, len(items))
+        # Rows are shown as pages arrive; getch() times out so the list and
+        # the loading indicator keep updating without a keypress
+        self.loading = True
+        threading.Thread(target=self.load_rows, name="cli-loader", daemon=True).start()
+        stdscr.timeout(REFRESH_INTERVAL)
+        stdscr.erase()
         continue_with_delete = False
 
         while True:
-            stdscr.clear()
-
-            for i in range(top_row, bottom_row):
-                if i == current_index:
-                    stdscr.attron(curses.color_pair(2))
-                    self.draw_checkbox(stdscr, i - top_row, 0, checkboxes[i])
-                    stdscr.addstr(i - top_row, 4, items[i])
-                    stdscr.attroff(curses.color_pair(2))
-                else:
-                    self.draw_checkbox(stdscr, i - top_row, 0, checkboxes[i])
-                    stdscr.addstr(i - top_row, 4, items[i])
-
-            stdscr.refresh()
+            list_height, count = self.draw(stdscr)
+            stdscr.noutrefresh()
+            curses.doupdate()
 
             key = stdscr.getch()
+            if key == -1:
+                continue
 
             # Process user input
-            if key == curses.KEY_UP and current_index > 0:
-                current_index -= 1
-                if current_index < top_row:
-                    top_row -= 1
-                    bottom_row -= 1
-            elif key == curses.KEY_DOWN and current_index < len(items) - 1:
-                current_index += 1
-                if current_index >= bottom_row:
-                    top_row += 1
-                    bottom_row += 1
-            elif key == ord(" "):
-                checkboxes[current_index] = not checkboxes[current_index]
+            if key == curses.KEY_UP:
+                self.move_to(self.current_index - 1, count)
+            elif key == curses.KEY_DOWN:
+                self.move_to(self.current_index + 1, count)
+            elif key == curses.KEY_PPAGE:
+                self.move_to(self.current_index - list_height, count)
+            elif key == curses.KEY_NPAGE:
+                self.move_to(self.current_index + list_height, count)
+            elif key == curses.KEY_HOME:
+                self.move_to(0, count)
+            elif key == curses.KEY_END:
+                self.move_to(count - 1, count)
+            elif key == ord(" ") and count > 0:
+                with self.rows_lock:
+                    self.checkboxes[self.current_index] = not self.checkboxes[self.current_index]
+            elif key == curses.KEY_RESIZE:
+                curses.update_lines_cols()
+                self.drawn.clear()
+                stdscr.erase()
+            elif key == ord("q") or key == ord("Q"):
+                break
             elif key == ord("\n"):
-                confirm_win = curses.newwin(5, curses.COLS - 2, curses.LINES - 7, 1)
-                confirm_win.box()
-                confirm_win.addstr(1, 2, "Are you sure you want to delete these?")
-                confirm_win.addstr(4, 2, "[Y] Yes    [N] No")
-                confirm_win.refresh()
-
-                while True:
-                    confirm_key = confirm_win.getch()
-                    if confirm_key == ord("y") or confirm_key == ord("Y"):
-                        confirm_win.clear()
-                        confirm_win.refresh()
-                        confirm_win.addstr(1, 2, "I shall continue with deletion!")
-                        confirm_win.refresh()
-                        continue_with_delete = True
-                        # Continue with the program and handle deletion logic
-                        break
-                    elif confirm_key == ord("n") or confirm_key == ord("N"):
-                        confirm_win.clear()
-                        confirm_win.refresh()
-                        confirm_win.addstr(1, 2, "Deletion canceled!")
-                        confirm_win.refresh()
-                        # Continue with the program
-                        break
-
+                continue_with_delete = self.confirm_delete()
                 if continue_with_delete is True:
                     break
+                # Repaint what the dialog covered
+                self.drawn.clear()
+                stdscr.touchwin()
 
+        self.stopped.set()
         if continue_with_delete is True:
-            for i, checkbox in enumerate(checkboxes):
-                if checkbox is True:
-                    match = re.search(r"\[(\d+)\]", items[i])
-                    if not match:
-                        print(
-                            "Silently erroring: could not find media ID in {}".format(
-                                items[i]
-                            )
-                        )
-                        continue
-                    self.delete_media(int(match.group(1)))
+            with self.rows_lock:
+                checked = [self.rows[i][1] for i, checkbox in enumerate(self.checkboxes) if checkbox is True]
+            # A media with several parts has one row per part
+            media_ids = list(dict.fromkeys(checked))
+            self.delete_media_batch(media_ids)
 
     def delete_media(self, media_id):
         content_key = self.items_obj[media_id]["dupe"]["key"]
@@ -160,20 +400,143 @@ class CleanarrCli:
             library_name=library_name, content_key=content_key, media_id=media_id
         )
 
+    def delete_media_batch(self, media_ids):
+        items = [
+            (self.items_obj[media_id]["dupe"]["library"], self.items_obj[media_id]["dupe"]["key"], media_id)
+            for media_id in media_ids
+        ]
+        self.delete_items(items)
+
+    def delete_items(self, items, concurrency=None, state=None):
+        """Delete (library_name, content_key, media_id) tuples, returning the number that failed."""
+        failed = 0
+        results = self.wrapper.iter_delete_media_batch(items, concurrency)
+        for done, result in enumerate(results, start=1):
+            if state is not None:
+                state.record(result)
+            status = "Deleted" if result["success"] else "Failed to delete"
+            print(f"[{done}/{len(items)}] {status} {result['media_id']} {result['content_key']} in {result['library_name']}",
+                  file=sys.stderr)
+            if not result["success"]:
+                failed += 1
+                print(f"  {result['error']}", file=sys.stderr)
+        return failed
+
+    # Batch section
+    def plan_deletes(self, rules, export=None, include_ignored=False):
+        """
+        Apply rules to every duplicate as its page arrives, writing each to
+        export, and return the (library_name, content_key, media_id) tuples to
+        delete along with the reclaimable bytes per library. Only the plan is
+        kept in memory, not the duplicates themselves.
+        """
+        items = []
+        reclaimable = {}
+        skipped = 0
+        for content in self.iter_dupe_pages(self.wrapper.get_dupe_content):
+            ignored = set() if include_ignored else self.wrapper.db.get_ignored_items(dupe["key"] for dupe in content)
+            for dupe in content:
+                if dupe["key"] in ignored:
+                    skipped += 1
+                    continue
+                keep, delete = rules.select(dupe)
+                if export is not None:
+                    export.write(dupe, keep, delete)
+                for media in delete:
+                    items.append((dupe["library"], dupe["key"], media["id"]))
+                    reclaimable[dupe["library"]] = reclaimable.get(dupe["library"], 0) + media_size(media)
+            if export is not None:
+                export.flush()
+        if skipped:
+            print(f"Skipped {skipped} ignored items", file=sys.stderr)
+        return items, reclaimable
+
+    def print_report(self, items, reclaimable):
+        print(f"{len(items)} media could be deleted, freeing {self.format_bytes(sum(reclaimable.values()))}",
+              file=sys.stderr)
+        counts = {}
+        for library_name, _, _ in items:
+            counts[library_name] = counts.get(library_name, 0) + 1
+        for library_name, size in reclaimable.items():
+            print(f"  {library_name}: {counts.get(library_name, 0)} media, {self.format_bytes(size)}", file=sys.stderr)
+
+    def run_batch(self, args):
+        """Non-interactive mode for cron: export, report and optionally delete. Returns the exit code."""
+        state = BatchState(args.state) if args.state else None
+        items = state.load_pending() if state is not None and args.delete else None
+        if items is not None:
+            print(f"Resuming {len(items)} deletions left in {args.state}", file=sys.stderr)
+        else:
+            rules = KeepRules(args.keep, args.container, args.path_prefix)
+            output = None
+            if args.output == "-":
+                output = sys.stdout
+            elif args.output:
+                output = open(args.output, "w", encoding="utf-8", newline="")
+            try:
+                export = EXPORTS[args.format](output) if output is not None else None
+                items, reclaimable = self.plan_deletes(rules, export, args.include_ignored)
+            finally:
+                if output not in (None, sys.stdout):
+                    output.close()
+            self.print_report(items, reclaimable)
+
+        if not args.delete or not items:
+            return 0
+        if not args.yes:
+            if not sys.stdin.isatty():
+                print("Not deleting anything: pass --yes to delete without confirmation", file=sys.stderr)
+                return 1
+            answer = input(f"Delete {len(items)} media? [y/N] ")
+            if answer.strip().lower() not in ("y", "yes"):
+                print("Deletion canceled!", file=sys.stderr)
+                return 0
+
+        if state is not None:
+            state.start(items)
+        failed = len(items)
+        try:
+            failed = self.delete_items(items, args.concurrency, state)
+        finally:
+            if state is not None:
+                state.finish(complete=failed == 0)
+        return 1 if failed else 0
+
     # PlexWrapper section
     def get_dupe_content(self, page=1):
         print("Getting duplicate content for page {}".format(page))
         return self.wrapper.get_dupe_content(page)
 
+    def iter_dupe_pages(self, get_page=None):
+        """
+        Yield pages of dupes in order until the first empty one, keeping
+        PREFETCH_PAGES requests in flight so the next pages are usually ready
+        by the time they are needed. Pages past the end come back empty, so
+        at most PREFETCH_PAGES - 1 requests are wasted.
+        """
+        get_page = get_page or self.get_dupe_content
+        with ThreadPoolExecutor(max_workers=PREFETCH_PAGES, thread_name_prefix="cli-prefetch") as executor:
+            futures = {}
+            next_page = 1
+            page = 1
+            try:
+                while True:
+                    while len(futures) < PREFETCH_PAGES:
+                        futures[next_page] = executor.submit(get_page, next_page)
+                        next_page += 1
+                    content = futures.pop(page).result()
+                    if len(content) == 0:
+                        break
+                    yield content
+                    page += 1
+            finally:
+                for future in futures.values():
+                    future.cancel()
+
     def get_all_dupes(self):
-        page = 1
         dupes = []
-        while True:
-            content = self.get_dupe_content(page)
-            if len(content) == 0:
-                break
+        for content in self.iter_dupe_pages():
             dupes.extend(content)
-            page += 1
         return dupes
 
     def dupe_content_summary(self):
@@ -186,7 +549,50 @@ class CleanarrCli:
         return dupes
 
 
+def parse_rules(value):
+    rules = [rule.strip() for rule in value.split(",") if rule.strip()]
+    for rule in rules:
+        if rule not in KEEP_RULES:
+            raise argparse.ArgumentTypeError(f"unknown rule {rule!r}, expected some of {', '.join(KEEP_RULES)}")
+    return rules
+
+
+def positive_int(value):
+    if not value.strip().isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value!r}")
+    return int(value)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Find and delete duplicate content in Plex.")
+    parser.add_argument("--batch", action="store_true",
+                        help="run without the interactive UI, keeping one copy of each duplicate by --keep")
+    parser.add_argument("--keep", type=parse_rules, default=["resolution", "bitrate"], metavar="RULES",
+                        help="comma separated rules, most important first, that pick the copy to keep: "
+                             f"{', '.join(KEEP_RULES)} (default: resolution,bitrate)")
+    parser.add_argument("--container", help="container preferred by the container rule, e.g. mkv")
+    parser.add_argument("--path-prefix", help="path preferred by the path rule, e.g. /media/4k")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write every duplicate and the action taken on it to FILE, or - for stdout")
+    parser.add_argument("--format", choices=sorted(EXPORTS), default="jsonl", help="format of --output")
+    parser.add_argument("--include-ignored", action="store_true", help="also delete from items ignored in the UI")
+    parser.add_argument("--delete", action="store_true",
+                        help="delete the copies not kept; without it, only report the space that would be freed")
+    parser.add_argument("--yes", action="store_true", help="delete without asking for confirmation")
+    parser.add_argument("--concurrency", type=positive_int, help="maximum items deleted at once (default: DELETE_CONCURRENCY)")
+    parser.add_argument("--state", metavar="FILE",
+                        help="record deletions in FILE, and resume the ones left by an interrupted run")
+    args = parser.parse_args(argv)
+    if "container" in args.keep and not args.container:
+        parser.error("the container rule needs --container")
+    if "path" in args.keep and not args.path_prefix:
+        parser.error("the path rule needs --path-prefix")
+    return args
+
+
 if __name__ == "__main__":
+    args = parse_args()
+
     # environment validation
     try:
         CleanarrCli.validate_env()
@@ -195,4 +601,6 @@ if __name__ == "__main__":
         sys.exit(1)
 
     cli = CleanarrCli()
+    if args.batch:
+        sys.exit(cli.run_batch(args))
     curses.wrapper(cli.start_curses)
@@ -0,0 +1,315 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import as_completed
+
+from logger import get_logger
+from records import FingerprintRecord
+from utils import increment_counter, trace_time
+
+logger = get_logger(__name__)
+
+
+class CrossLibraryIndex(object):
+    """
+    Finds content that exists in more than one of the configured libraries,
+    e.g. a film in both "Movies" and "Movies 4K", which Plex's per-library
+    duplicate filter never reports.
+
+    Every item is fingerprinted by its guid and, when CROSS_LIBRARY_MATCH_FILES
+    is set, by the size and duration of each of its files. Fingerprints are
+    hashed into buckets, so groups are found in one pass over the buckets
+    holding more than one item rather than by comparing items pairwise.
+
+    The fingerprints are persisted under CONFIG_DIR, and later scans only ask
+    Plex for items updated since the previous one; a library is only listed
+    in full again when its item count shows that something was removed.
+    """
+
+    def __init__(self, path=None, config_dir=None):
+        config_dir = config_dir or os.environ.get("CONFIG_DIR", "")  # Will be set by Dockerfile
+        self.path = path or os.path.join(config_dir, "cross_library_index.json")
+        self.enabled = os.environ.get("CROSS_LIBRARY_DUPES", "1") == "1"
+        self.match_files = os.environ.get("CROSS_LIBRARY_MATCH_FILES", "0") == "1"
+        self.lock = threading.RLock()
+        self.items = {}
+        # library name -> {"updatedAt": newest updatedAt seen, "count": items}
+        self.sections = {}
+        # match key -> set of (library, key)
+        self.buckets = {}
+        self.scanned_at = None
+        self._groups = None
+        self._mtime = None
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        logger.debug("Loading cross-library index from %s", self.path)
+        with open(self.path) as f:
+            data = json.load(f)
+        self.items = {}
+        self.buckets = {}
+        for item in data["items"]:
+            self._add(FingerprintRecord.from_dict(item))
+        self.sections = data["sections"]
+        self.scanned_at = data["scannedAt"]
+        self._mtime = mtime
+
+    def refresh(self):
+        """Reload the fingerprints if they were saved since, e.g. by another process."""
+        with self.lock:
+            self._refresh()
+
+    def version(self):
+        """
+        Changes every time the fingerprints are saved, by any process; None
+        until the first scan has saved them.
+        """
+        with self.lock:
+            self._refresh()
+            return self._mtime
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "scannedAt": self.scanned_at,
+                "sections": self.sections,
+                "items": [item.to_dict() for item in self.items.values()],
+            }, f)
+        os.replace(tmp_path, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def _match_keys(self, item):
+        keys = []
+        # local:// guids are unique per item, so they never match anything
+        if item.guid and not item.guid.startswith("local://"):
+            keys.append(item.guid)
+        if self.match_files:
+            keys.extend(f"file:{size}:{duration}" for size, duration in item.files if size)
+        return keys
+
+    def _add(self, item):
+        item_id = (item.library, item.key)
+        self.items[item_id] = item
+        for match_key in self._match_keys(item):
+            self.buckets.setdefault(match_key, set()).add(item_id)
+        self._groups = None
+
+    def _remove(self, item_id):
+        item = self.items.pop(item_id)
+        for match_key in self._match_keys(item):
+            bucket = self.buckets[match_key]
+            bucket.discard(item_id)
+            if not bucket:
+                del self.buckets[match_key]
+        self._groups = None
+
+    def _apply(self, items):
+        # Returns how many items were new or changed
+        changed = 0
+        for item in items:
+            item_id = (item.library, item.key)
+            previous = self.items.get(item_id)
+            if previous is not None:
+                if previous.updatedAt == item.updatedAt and previous.files == item.files:
+                    continue
+                self._remove(item_id)
+            self._add(item)
+            changed += 1
+        return changed
+
+    @staticmethod
+    def _fetch(wrapper, section, page_size, updated_after=None):
+        total = wrapper.count_library_items(section, updated_after)
+        futures = [
+            wrapper.executor.submit(wrapper.scan_library_fingerprints, section, offset, page_size, updated_after)
+            for offset in range(0, total, page_size)
+        ]
+        items = []
+        for future in as_completed(futures):
+            items.extend(future.result())
+        return items
+
+    def _update_section(self, wrapper, section, page_size):
+        library = section.title
+        known = {key for item_library, key in self.items if item_library == library}
+        total = wrapper.count_library_items(section)
+        previous = self.sections.get(library)
+        items = None
+        if previous is not None:
+            items = self._fetch(wrapper, section, page_size, previous["updatedAt"] - 1)
+            added = {item.key for item in items} - known
+            if len(known) + len(added) != total:
+                logger.debug("Items were removed from %s, listing it in full", library)
+                items = None
+        if items is None:
+            items = self._fetch(wrapper, section, page_size)
+            for key in known - {item.key for item in items}:
+                self._remove((library, key))
+        changed = self._apply(items)
+        updated_at = max((item.updatedAt or 0 for item in items), default=0)
+        if previous is not None:
+            updated_at = max(updated_at, previous["updatedAt"])
+        self.sections[library] = {"updatedAt": updated_at, "count": total}
+        logger.debug("Cross-library index: %s fetched, %s changed in %s", len(items), changed, library)
+        return changed
+
+    @trace_time
+    def update(self, wrapper, sections, page_size):
+        """
+        Bring the fingerprints of the given library sections up to date.
+        Returns the number of items that were added or changed.
+        """
+        with self.lock:
+            self._refresh()
+            for library in set(self.sections) - {section.title for section in sections}:
+                # No longer configured
+                for item_id in [item_id for item_id in self.items if item_id[0] == library]:
+                    self._remove(item_id)
+                del self.sections[library]
+            changed = 0
+            for section in sections:
+                changed += self._update_section(wrapper, section, page_size)
+            increment_counter("cross_library_items_changed", changed)
+            self.scanned_at = time.time()
+            self._save()
+            return changed
+
+    def is_ready(self):
+        with self.lock:
+            self._refresh()
+            return self.scanned_at is not None
+
+    def get_groups(self):
+        """
+        Groups of items that share a guid (or a file) across two or more
+        libraries, each as {"guid", "libraries", "items"}.
+        """
+        with self.lock:
+            self._refresh()
+            if self._groups is None:
+                self._groups = self._build_groups()
+            return self._groups
+
+    def _build_groups(self):
+        # Union-find over every bucket holding more than one item, so items
+        # linked through different keys (a guid and a file) end up together
+        parent = {}
+
+        def find(item_id):
+            while parent[item_id] != item_id:
+                parent[item_id] = parent[parent[item_id]]
+                item_id = parent[item_id]
+            return item_id
+
+        for bucket in self.buckets.values():
+            if len(bucket) < 2:
+                continue
+            root = None
+            for item_id in bucket:
+                parent.setdefault(item_id, item_id)
+                if root is None:
+                    root = find(item_id)
+                    continue
+                other = find(item_id)
+                if other != root:
+                    parent[other] = root
+
+        components = {}
+        for item_id in parent:
+            components.setdefault(find(item_id), []).append(item_id)
+
+        groups = []
+        for item_ids in components.values():
+            libraries = sorted({library for library, key in item_ids})
+            if len(libraries) < 2:
+                continue
+            items = [self.items[item_id] for item_id in sorted(item_ids)]
+            groups.append({
+                "guid": items[0].guid,
+                "libraries": libraries,
+                "items": [item.to_dict() for item in items],
+            })
+        groups.sort(key=lambda group: (group["items"][0]["title"] or "", group["guid"] or ""))
+        return groups
+
+
+class CrossServerIndex(object):
+    """
+    Finds content that exists on more than one Plex server (PLEX_SERVERS) by
+    guid, from the fingerprints each server's background scan keeps for its
+    CrossLibraryIndex. The fingerprints are read from each server's config
+    directory rather than asked of the server, so servers that are offline
+    still match as of their last scan. Groups are only rebuilt once one of
+    the servers has been scanned again.
+
+    get_existing_wrapper(name) returns a server's wrapper if one was already
+    created, without connecting; its index is used so the fingerprints are
+    only held once. Servers without a wrapper get an index of their own until
+    one shows up.
+    """
+
+    def __init__(self, configs, get_existing_wrapper=None):
+        self.configs = configs
+        self.get_existing_wrapper = get_existing_wrapper or (lambda name: None)
+        self.lock = threading.Lock()
+        # Server name -> index read from its config directory, for servers with no wrapper
+        self.indexes = {}
+        self._groups = None
+        self._versions = None
+
+    def _get_indexes(self):
+        indexes = {}
+        for config in self.configs:
+            wrapper = self.get_existing_wrapper(config.name)
+            if wrapper is not None:
+                self.indexes.pop(config.name, None)
+                indexes[config.name] = wrapper.cross_library_index
+            else:
+                if config.name not in self.indexes:
+                    self.indexes[config.name] = CrossLibraryIndex(config_dir=config.config_dir)
+                indexes[config.name] = self.indexes[config.name]
+        return indexes
+
+    def get_groups(self):
+        """
+        Groups of items that share a guid across two or more servers, each as
+        {"guid", "servers", "items"}, items being tagged with their server.
+        """
+        with self.lock:
+            indexes = self._get_indexes()
+            versions = {name: index.version() for name, index in indexes.items()}
+            if self._groups is None or versions != self._versions:
+                self._groups = self._build_groups(indexes)
+                self._versions = versions
+                increment_counter("cross_server_index_builds")
+            return self._groups
+
+    @staticmethod
+    def _build_groups(indexes):
+        by_guid = {}
+        for name, index in indexes.items():
+            with index.lock:
+                for item in index.items.values():
+                    # local:// guids are unique per item, so they never match anything
+                    if item.guid and not item.guid.startswith("local://"):
+                        by_guid.setdefault(item.guid, []).append((name, item))
+
+        groups = []
+        for guid, entries in by_guid.items():
+            servers = list(dict.fromkeys(name for name, item in entries))
+            if len(servers) < 2:
+                continue
+            groups.append({
+                "guid": guid,
+                "servers": servers,
+                "items": [{**item.to_dict(), "server": name} for name, item in entries],
+            })
+        groups.sort(key=lambda group: (group["items"][0]["title"] or "", group["guid"]))
+        return groups
@@ -1,59 +1,175 @@
+import json
 import os
+import sqlite3
 import threading
-
-from tinydb import TinyDB, where
-from tinydb.table import Document
+import time
+from contextlib import contextmanager
 
 from logger import get_logger
 
-DELETED_SIZE_DOC_ID = 1
-IGNORED_ITEMS_TABLE = 'ignored'
+DB_FILENAME = 'cleanarr.db'
+LEGACY_DB_FILENAME = 'db.json'
+LEGACY_DELETED_SIZE_TABLE = '_default'
+LEGACY_IGNORED_ITEMS_TABLE = 'ignored'
+IGNORED_VERSION = 'ignored_version'
+# How long the in-memory ignored keys are trusted before checking for writes
+# from other processes
+IGNORED_CHECK_INTERVAL = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ignored (
+    key TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS deleted_sizes (
+    library_name TEXT PRIMARY KEY,
+    deleted_size INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
 
 
 logger = get_logger(__name__)
 
 
 class Database(object):
-    def __init__(self):
+    def __init__(self, config_dir=None):
         logger.debug("DB Init")
-        config_dir = os.environ.get("CONFIG_DIR", "")  # Will be set by Dockerfile
+        config_dir = config_dir or os.environ.get("CONFIG_DIR", "")  # Will be set by Dockerfile
         self.local = threading.local()
+        self.path = os.path.join(config_dir, DB_FILENAME)
+        # Ignored keys are held in memory and reloaded whenever the version
+        # stamp changes, whether bumped by this thread, another thread or
+        # another process (the latter are picked up within IGNORED_CHECK_INTERVAL).
+        self.ignored_keys = set()
+        self.ignored_lock = threading.Lock()
+        self._ignored_version = None
+        self._ignored_checked_at = 0
+        self.get_db().executescript(SCHEMA)
+        self._import_legacy_db(os.path.join(config_dir, LEGACY_DB_FILENAME))
         logger.debug("DB Init Success")
 
     def get_db(self):
+        # sqlite connections can't be shared between threads, so keep one per
+        # thread. WAL mode lets readers run alongside a writer, across threads
+        # and uWSGI workers alike.
         if not hasattr(self.local, 'db'):
-            config_dir = os.environ.get("CONFIG_DIR", "")
-            self.local.db = TinyDB(os.path.join(config_dir, 'db.json'))
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
         return self.local.db
 
+    @contextmanager
+    def transaction(self):
+        db = self.get_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _import_legacy_db(self, legacy_path):
+        # One-time import of the TinyDB file used by earlier versions
+        if not os.path.isfile(legacy_path):
+            return
+        logger.debug("Importing %s", legacy_path)
+        with open(legacy_path) as f:
+            data = json.load(f)
+        with self.transaction() as db:
+            # Another worker may have imported it while we waited for the lock
+            if not os.path.isfile(legacy_path):
+                return
+            for doc in data.get(LEGACY_DELETED_SIZE_TABLE, {}).values():
+                db.executemany(
+                    "INSERT INTO deleted_sizes (library_name, deleted_size) VALUES (?, ?) "
+                    "ON CONFLICT (library_name) DO UPDATE SET deleted_size = excluded.deleted_size",
+                    doc.items(),
+                )
+            db.executemany(
+                "INSERT OR IGNORE INTO ignored (key) VALUES (?)",
+                [(doc['key'],) for doc in data.get(LEGACY_IGNORED_ITEMS_TABLE, {}).values()],
+            )
+            self._bump_ignored_version(db)
+            os.replace(legacy_path, legacy_path + '.migrated')
+
     def set_deleted_size(self, library_name, deleted_size):
         logger.debug("library_name %s, deleted_size %s", library_name, deleted_size)
-        self.get_db().upsert(Document({
-            library_name: deleted_size
-        }, doc_id=DELETED_SIZE_DOC_ID))
+        self.get_db().execute(
+            "INSERT INTO deleted_sizes (library_name, deleted_size) VALUES (?, ?) "
+            "ON CONFLICT (library_name) DO UPDATE SET deleted_size = excluded.deleted_size",
+            (library_name, deleted_size),
+        )
+
+    def add_deleted_size(self, library_name, deleted_size):
+        logger.debug("library_name %s, deleted_size %s", library_name, deleted_size)
+        self.get_db().execute(
+            "INSERT INTO deleted_sizes (library_name, deleted_size) VALUES (?, ?) "
+            "ON CONFLICT (library_name) DO UPDATE SET deleted_size = deleted_size + excluded.deleted_size",
+            (library_name, deleted_size),
+        )
 
     def get_deleted_size(self, library_name):
         logger.debug("library_name %s", library_name)
-        data = self.get_db().get(doc_id=DELETED_SIZE_DOC_ID)
-        if data is not None:
-            if library_name in data:
-                return data[library_name]
+        row = self.get_db().execute(
+            "SELECT deleted_size FROM deleted_sizes WHERE library_name = ?", (library_name,)
+        ).fetchone()
+        if row is not None:
+            return row[0]
         return 0
 
+    @staticmethod
+    def _bump_ignored_version(db):
+        db.execute(
+            "INSERT INTO meta (name, value) VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            (IGNORED_VERSION,),
+        )
+
+    def _get_ignored_version(self):
+        row = self.get_db().execute("SELECT value FROM meta WHERE name = ?", (IGNORED_VERSION,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def get_ignored_keys(self):
+        with self.ignored_lock:
+            if time.monotonic() - self._ignored_checked_at < IGNORED_CHECK_INTERVAL:
+                return self.ignored_keys
+            version = self._get_ignored_version()
+            if version != self._ignored_version:
+                logger.debug("Reloading ignored items")
+                rows = self.get_db().execute("SELECT key FROM ignored").fetchall()
+                self.ignored_keys = {row[0] for row in rows}
+                self._ignored_version = version
+            self._ignored_checked_at = time.monotonic()
+            return self.ignored_keys
+
+    def is_ignored(self, content_key):
+        return content_key in self.get_ignored_keys()
+
+    def get_ignored_items(self, content_keys):
+        ignored_keys = self.get_ignored_keys()
+        return {content_key for content_key in content_keys if content_key in ignored_keys}
+
     def get_ignored_item(self, content_key):
         logger.debug("content_key %s", content_key)
-        table = self.get_db().table(IGNORED_ITEMS_TABLE)
-        data = table.get(where('key') == content_key)
-        return data
+        if self.is_ignored(content_key):
+            return {'key': content_key}
+        return None
 
     def add_ignored_item(self, content_key):
         logger.debug("content_key %s", content_key)
-        table = self.get_db().table(IGNORED_ITEMS_TABLE)
-        table.insert({
-            'key': content_key
-        })
+        with self.transaction() as db:
+            if db.execute("INSERT OR IGNORE INTO ignored (key) VALUES (?)", (content_key,)).rowcount:
+                self._bump_ignored_version(db)
+        self._ignored_checked_at = 0
 
     def remove_ignored_item(self, content_key):
         logger.debug("content_key %s", content_key)
-        table = self.get_db().table(IGNORED_ITEMS_TABLE)
-        table.remove(where('key') == content_key)
+        with self.transaction() as db:
+            if db.execute("DELETE FROM ignored WHERE key = ?", (content_key,)).rowcount:
+                self._bump_ignored_version(db)
+        self._ignored_checked_at = 0
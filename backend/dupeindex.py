@@ -0,0 +1,557 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from logger import get_logger
+from records import ContentRecord
+
+logger = get_logger(__name__)
+
+# Sort keys accepted by DupeQuery, prefix with "-" to sort descending
+SORT_KEYS = ("title", "year", "size", "reclaimable")
+# Distinct filter/sort combinations whose results are kept between pages
+QUERY_CACHE_SIZE = 16
+
+DB_FILENAME = "dupe_index.db"
+LEGACY_FILENAME = "dupe_index.json"
+# Changes kept for other workers to replay; one further behind reloads the index
+CHANGE_LOG_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    library TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (library, key)
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    library TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+
+class DupeQuery(object):
+    """
+    Filters and sort order for /content/dupes, evaluated against the summaries
+    DupeIndex keeps of every item:
+
+    - library, contentType, resolution, codec: match any of the given values
+      (codec matches the video or audio codec of any media);
+    - minSize, maxSize: total bytes across all media;
+    - ignored: 1 or 0;
+    - search: every word must appear in the title, series title or a file path;
+    - sort: one of SORT_KEYS, "reclaimable" being the bytes freed by keeping
+      only the largest media.
+    """
+
+    def __init__(self, libraries=(), content_types=(), resolutions=(), codecs=(), min_size=None, max_size=None,
+                 ignored=None, search="", sort=None):
+        self.libraries = frozenset(libraries)
+        self.content_types = frozenset(content_types)
+        self.resolutions = frozenset(value.lower() for value in resolutions)
+        self.codecs = frozenset(value.lower() for value in codecs)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.ignored = ignored
+        self.terms = tuple(search.lower().split())
+        self.descending = bool(sort) and sort.startswith("-")
+        self.sort = sort.lstrip("-") if sort else None
+        if self.sort is not None and self.sort not in SORT_KEYS:
+            raise ValueError(f"Invalid sort: {sort}, expected one of {', '.join(SORT_KEYS)}")
+
+    @classmethod
+    def from_args(cls, args):
+        def get_int(name):
+            value = args.get(name)
+            if value in (None, ""):
+                return None
+            try:
+                return int(value)
+            except ValueError:
+                raise ValueError(f"Invalid {name}: {value!r}, expected an integer")
+
+        ignored = args.get("ignored")
+        return cls(
+            libraries=args.getlist("library"),
+            content_types=args.getlist("contentType"),
+            resolutions=args.getlist("resolution"),
+            codecs=args.getlist("codec"),
+            min_size=get_int("minSize"),
+            max_size=get_int("maxSize"),
+            ignored=None if ignored in (None, "") else ignored == "1",
+            search=args.get("search", ""),
+            sort=args.get("sort") or None,
+        )
+
+    def is_empty(self):
+        return self.key() == DupeQuery().key()
+
+    def key(self):
+        # The sort direction is left out, both directions walk the same rows
+        return (
+            self.libraries, self.content_types, self.resolutions, self.codecs, self.min_size, self.max_size,
+            self.ignored, self.terms, self.sort,
+        )
+
+    def get_postings(self):
+        # Posting keys an item must hold at least one of, per filter
+        filters = [
+            ("library", self.libraries),
+            ("contentType", self.content_types),
+            ("resolution", self.resolutions),
+            ("codec", self.codecs),
+            ("ignored", () if self.ignored is None else (self.ignored,)),
+        ]
+        return [[(name, value) for value in values] for name, values in filters if values]
+
+    def has_checks(self):
+        return self.min_size is not None or self.max_size is not None or bool(self.terms)
+
+    def matches(self, summary):
+        # The filters not covered by get_postings()
+        if self.min_size is not None and summary.size < self.min_size:
+            return False
+        if self.max_size is not None and summary.size > self.max_size:
+            return False
+        return all(term in summary.text for term in self.terms)
+
+    def sort_value(self, summary):
+        if self.sort is None:
+            return 0
+        return getattr(summary, self.sort)
+
+
+class ItemSummary(object):
+    """The fields of a ContentRecord that DupeQuery filters and sorts on."""
+
+    __slots__ = ("title", "year", "size", "reclaimable", "text", "postings")
+
+    def __init__(self, item):
+        media = getattr(item, "media", ())
+        sizes = []
+        files = []
+        postings = {
+            ("library", item.library),
+            ("contentType", getattr(item, "contentType", None)),
+            ("ignored", bool(getattr(item, "ignored", False))),
+        }
+        for m in media:
+            size = 0
+            for part in getattr(m, "parts", ()):
+                size += getattr(part, "size", None) or 0
+                files.append(getattr(part, "file", None) or "")
+            sizes.append(size)
+            postings.add(("resolution", (getattr(m, "videoResolution", None) or "").lower()))
+            postings.add(("codec", (getattr(m, "videoCodec", None) or "").lower()))
+            postings.add(("codec", (getattr(m, "audioCodec", None) or "").lower()))
+        series_title = getattr(item, "seriesTitle", None)
+        title = getattr(item, "title", None) or ""
+        self.title = f"{series_title} {title}".lower() if series_title else title.lower()
+        self.year = getattr(item, "year", None) or 0
+        self.size = sum(sizes)
+        self.reclaimable = self.size - max(sizes, default=0)
+        self.text = "\n".join([self.title, *files]).lower()
+        self.postings = postings
+
+
+class DupeIndex(object):
+    """
+    Fully serialized duplicate content, as produced by a background scan, keyed
+    by library name and content key. The index is persisted in SQLite under
+    CONFIG_DIR so that every worker process serves the same results.
+
+    Items are held in memory as ContentRecords and only turned into dicts for
+    the pages being returned, which keeps large libraries affordable in every
+    worker. A scan replaces every row; deletes, ignores and refreshes update
+    single rows and append them to a change log, which other workers replay
+    on their next request instead of reloading the whole index. Writes catch
+    up with the log under SQLite's write lock first, so workers never
+    overwrite each other's changes.
+    """
+
+    def __init__(self, path=None, config_dir=None):
+        config_dir = config_dir or os.environ.get("CONFIG_DIR", "")  # Will be set by Dockerfile
+        self.path = path or os.path.join(config_dir, DB_FILENAME)
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.items = {}
+        # content key -> libraries holding it
+        self._libraries = defaultdict(set)
+        self.scanned_at = None
+        self._values = None
+        self._order = None
+        # (library, key) -> ItemSummary, and posting key -> set of (library, key),
+        # built along with a scan (or on the first query after loading one) and
+        # kept up to date item by item
+        self._summaries = None
+        self._postings = None
+        # sort key -> (sort value, library, key) rows of every item, ascending
+        self._sorted = {}
+        # DupeQuery.key() -> the matching rows
+        self._queries = OrderedDict()
+        # Which scan the items came from, and the last change applied to them
+        self._generation = None
+        self._seq = 0
+        self.get_db().executescript(SCHEMA)
+        self._import_legacy_index(os.path.join(os.path.dirname(self.path), LEGACY_FILENAME))
+
+    def get_db(self):
+        # One connection per thread, as in Database
+        if not hasattr(self.local, "db"):
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return self.local.db
+
+    @contextmanager
+    def transaction(self, mode="IMMEDIATE"):
+        db = self.get_db()
+        db.execute(f"BEGIN {mode}")
+        try:
+            yield db
+        except Exception:
+            db.execute("ROLLBACK")
+            # The items in memory may be ahead of what was stored
+            self._generation = None
+            raise
+        db.execute("COMMIT")
+
+    def _import_legacy_index(self, legacy_path):
+        # One-time import of the JSON file used by earlier versions
+        if not os.path.isfile(legacy_path):
+            return
+        logger.debug("Importing %s", legacy_path)
+        with open(legacy_path) as f:
+            data = json.load(f)
+        with self.transaction() as db:
+            # Another worker may have imported it while we waited for the lock
+            if not os.path.isfile(legacy_path):
+                return
+            if self._get_meta(db, "generation") is None:
+                records = [ContentRecord.from_dict(item) for item in data["items"]]
+                self._write_all(db, records, data["scannedAt"])
+            # Only a copy of what a scan finds, so nothing is lost by removing it
+            os.remove(legacy_path)
+
+    @staticmethod
+    def _get_meta(db, name):
+        row = db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    @staticmethod
+    def _get_last_seq(db):
+        # The last change ever logged, including ones a rescan or pruning removed
+        row = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row is not None else 0
+
+    @staticmethod
+    def _set_meta(db, name, value):
+        db.execute(
+            "INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+            (name, value),
+        )
+
+    def _write_all(self, db, records, scanned_at):
+        # Returns the new generation, which makes every worker reload
+        db.execute("DELETE FROM items")
+        db.execute("DELETE FROM changes")
+        db.executemany(
+            "INSERT INTO items (library, key, data) VALUES (?, ?, ?)",
+            ((record.library, record.key, json.dumps(record.to_dict())) for record in records),
+        )
+        generation = (self._get_meta(db, "generation") or 0) + 1
+        self._set_meta(db, "generation", generation)
+        self._set_meta(db, "scannedAt", scanned_at)
+        return generation
+
+    def _refresh(self):
+        # A read transaction, so the rows and the change log are read as of one moment
+        with self.transaction("DEFERRED") as db:
+            self._catch_up(db)
+
+    def _catch_up(self, db):
+        generation, first_seq, last_seq = db.execute(
+            "SELECT (SELECT value FROM meta WHERE name = 'generation'), MIN(seq), MAX(seq) FROM changes"
+        ).fetchone()
+        if generation is None:
+            return
+        if generation != self._generation or (first_seq is not None and self._seq < first_seq - 1):
+            # Rescanned, or behind changes that were already pruned from the log
+            self._load(db, generation)
+        elif last_seq is not None and last_seq > self._seq:
+            rows = db.execute(
+                "SELECT library, key, data FROM changes WHERE seq > ? ORDER BY seq", (self._seq,)
+            ).fetchall()
+            for library, key, data in rows:
+                if data is None:
+                    self._drop((library, key))
+                else:
+                    self._put(ContentRecord.from_dict(json.loads(data)))
+            self._seq = last_seq
+            self._invalidate()
+
+    def _load(self, db, generation):
+        logger.debug("Loading dupe index from %s", self.path)
+        self.items = {}
+        self._libraries = defaultdict(set)
+        for library, key, data in db.execute("SELECT library, key, data FROM items ORDER BY rowid"):
+            self.items[(library, key)] = ContentRecord.from_dict(json.loads(data))
+            self._libraries[key].add(library)
+        self.scanned_at = self._get_meta(db, "scannedAt")
+        self._summaries = None
+        self._postings = None
+        self._invalidate()
+        self._generation = generation
+        self._seq = self._get_last_seq(db)
+
+    def _write_changes(self, db, item_ids):
+        # Store the current state of the given items row by row, and log it for the other workers
+        for item_id in item_ids:
+            item = self.items.get(item_id)
+            data = json.dumps(item.to_dict()) if item is not None else None
+            if data is None:
+                db.execute("DELETE FROM items WHERE library = ? AND key = ?", item_id)
+            else:
+                db.execute(
+                    "INSERT INTO items (library, key, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT (library, key) DO UPDATE SET data = excluded.data",
+                    (*item_id, data),
+                )
+            cursor = db.execute("INSERT INTO changes (library, key, data) VALUES (?, ?, ?)", (*item_id, data))
+            self._seq = cursor.lastrowid
+        # Workers that fall further behind than this reload the index instead
+        db.execute("DELETE FROM changes WHERE seq <= ?", (self._seq - CHANGE_LOG_SIZE,))
+        self._invalidate()
+
+    def _put(self, item):
+        item_id = (item.library, item.key)
+        self._unindex_item(item_id)
+        self.items[item_id] = item
+        self._libraries[item.key].add(item.library)
+        self._index_item(item_id)
+
+    def _drop(self, item_id):
+        self._unindex_item(item_id)
+        if self.items.pop(item_id, None) is not None:
+            libraries = self._libraries[item_id[1]]
+            libraries.discard(item_id[0])
+            if not libraries:
+                del self._libraries[item_id[1]]
+
+    def _invalidate(self):
+        self._values = None
+        self._order = None
+        self._sorted = {}
+        self._queries.clear()
+
+    def is_ready(self):
+        with self.lock:
+            self._refresh()
+            return self.scanned_at is not None
+
+    def age(self):
+        with self.lock:
+            self._refresh()
+            if self.scanned_at is None:
+                return None
+            return time.time() - self.scanned_at
+
+    def replace(self, items, scanned_at=None):
+        # items are ContentRecords, or dicts in the movie_to_dict shape
+        records = [ContentRecord.from_dict(item) if isinstance(item, dict) else item for item in items]
+        scanned_at = scanned_at or time.time()
+        with self.lock, self.transaction() as db:
+            generation = self._write_all(db, records, scanned_at)
+            self.items = {}
+            self._libraries = defaultdict(set)
+            for record in records:
+                self.items[(record.library, record.key)] = record
+                self._libraries[record.key].add(record.library)
+            self.scanned_at = scanned_at
+            self._generation = generation
+            self._seq = self._get_last_seq(db)
+            self._summaries = None
+            self._invalidate()
+            self._build_summaries()
+
+    def get_page(self, page, page_size):
+        with self.lock:
+            self._refresh()
+            if self._values is None:
+                self._values = list(self.items.values())
+            offset = (page - 1) * page_size
+            return [item.to_dict() for item in self._values[offset:offset + page_size]]
+
+    def get_after(self, after, limit):
+        """
+        Keyset pagination: return up to limit items that sort after the given
+        (library, key) pair, and whether any more follow. Unlike offsets this
+        stays correct while items are removed between pages.
+        """
+        with self.lock:
+            self._refresh()
+            if self._order is None:
+                self._order = sorted(self.items)
+            start = bisect.bisect_right(self._order, tuple(after)) if after else 0
+            keys = self._order[start:start + limit]
+            return [self.items[key].to_dict() for key in keys], start + limit < len(self._order)
+
+    def query(self, query, limit, offset=0, after=None):
+        """
+        Return up to limit items matching the DupeQuery, in its sort order,
+        along with the number of matches and whether more follow. Pages are
+        addressed by offset, or by the cursor of the last item returned
+        (see get_cursor) like get_after.
+
+        Matches are computed once per query, by intersecting postings and
+        checking the remaining filters against item summaries, and kept until
+        the index changes, so paging through them only costs the page.
+        """
+        with self.lock:
+            self._refresh()
+            rows = self._get_query_rows(query)
+            if query.descending:
+                end = (bisect.bisect_left(rows, tuple(after)) if after else len(rows)) - offset
+                selected = rows[max(end - limit, 0):max(end, 0)][::-1]
+                has_more = end - limit > 0
+            else:
+                start = (bisect.bisect_right(rows, tuple(after)) if after else 0) + offset
+                selected = rows[start:start + limit]
+                has_more = start + limit < len(rows)
+            return [self.items[row[1:]].to_dict() for row in selected], len(rows), has_more
+
+    def get_cursor(self, query, item):
+        # The keyset position of an item returned by query()
+        with self.lock:
+            self._build_summaries()
+            summary = self._summaries[(item["library"], item["key"])]
+            return [query.sort_value(summary), item["library"], item["key"]]
+
+    def _build_summaries(self):
+        if self._summaries is not None:
+            return
+        self._summaries = {}
+        self._postings = defaultdict(set)
+        for item_id in self.items:
+            self._index_item(item_id)
+
+    def _index_item(self, item_id):
+        if self._summaries is None:
+            return
+        summary = self._summaries[item_id] = ItemSummary(self.items[item_id])
+        for posting in summary.postings:
+            self._postings[posting].add(item_id)
+
+    def _unindex_item(self, item_id):
+        if self._summaries is None:
+            return
+        summary = self._summaries.pop(item_id, None)
+        if summary is not None:
+            for posting in summary.postings:
+                self._postings[posting].discard(item_id)
+
+    def _get_query_rows(self, query):
+        query_key = query.key()
+        rows = self._queries.get(query_key)
+        if rows is not None:
+            self._queries.move_to_end(query_key)
+            return rows
+        self._build_summaries()
+        summaries = self._summaries
+        candidates = None
+        for alternatives in query.get_postings():
+            matching = set().union(*(self._postings.get(posting, ()) for posting in alternatives))
+            candidates = matching if candidates is None else candidates & matching
+        if candidates is not None and len(candidates) * 8 < len(summaries):
+            # Cheaper to sort a few matches than to walk every item in order
+            rows = sorted((query.sort_value(summaries[item_id]), *item_id) for item_id in candidates)
+        else:
+            rows = self._sorted.get(query.sort)
+            if rows is None:
+                rows = self._sorted[query.sort] = sorted(
+                    (query.sort_value(summary), *item_id) for item_id, summary in summaries.items()
+                )
+            if candidates is not None:
+                rows = [row for row in rows if row[1:] in candidates]
+        if query.has_checks():
+            rows = [row for row in rows if query.matches(summaries[row[1:]])]
+        self._queries[query_key] = rows
+        if len(self._queries) > QUERY_CACHE_SIZE:
+            self._queries.popitem(last=False)
+        return rows
+
+    def get_totals(self):
+        with self.lock:
+            self._refresh()
+            return dict(Counter(library_name for library_name, key in self.items))
+
+    def remove_media(self, library_name, content_key, media_id):
+        self.remove_media_batch([(library_name, content_key, media_id)])
+
+    def remove_media_batch(self, deleted):
+        # deleted is a list of (library_name, content_key, media_id), written
+        # in one transaction
+        with self.lock, self.transaction() as db:
+            self._catch_up(db)
+            changed = set()
+            for library_name, content_key, media_id in deleted:
+                item = self.items.get((library_name, content_key))
+                if item is None:
+                    continue
+                item.media = tuple(media for media in item.media if media.id != media_id)
+                if len(item.media) < 2:
+                    # No longer a duplicate
+                    self._drop((library_name, content_key))
+                else:
+                    self._put(item)
+                changed.add((library_name, content_key))
+            if changed:
+                self._write_changes(db, changed)
+
+    def update_items(self, items, removed=()):
+        """
+        Insert or replace serialized items and drop the (library, key) pairs in
+        removed, in one transaction. Does nothing until a scan has built the
+        index, since there is nothing to keep fresh before then.
+        """
+        with self.lock, self.transaction() as db:
+            self._catch_up(db)
+            if self.scanned_at is None:
+                return False
+            changed = set()
+            for item in items:
+                if isinstance(item, dict):
+                    item = ContentRecord.from_dict(item)
+                self._put(item)
+                changed.add((item.library, item.key))
+            for item_id in removed:
+                self._drop(tuple(item_id))
+                changed.add(tuple(item_id))
+            self._write_changes(db, changed)
+            return True
+
+    def set_ignored(self, content_key, ignored):
+        with self.lock, self.transaction() as db:
+            self._catch_up(db)
+            changed = set()
+            for library_name in self._libraries.get(content_key, ()):
+                item = self.items[(library_name, content_key)]
+                if item.ignored != ignored:
+                    item.ignored = ignored
+                    self._put(item)
+                    changed.add((library_name, content_key))
+            if changed:
+                self._write_changes(db, changed)
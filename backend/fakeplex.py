@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+#
+# a synthetic plex server for offline benchmarks and local development. it
+# answers the endpoints cleanarr uses (handshake, library sections, filtered
+# searches, metadata, thumbnails and media deletes) with generated xml, so
+# benchmarks give comparable numbers without a real server. run it directly
+# to point a local backend at it:
+#
+#   FAKE_PLEX_SIZE=10000 FAKE_PLEX_DUPE_RATIO=0.2 ./backend/fakeplex.py
+#
+# every library holds FAKE_PLEX_SIZE items, FAKE_PLEX_DUPE_RATIO of which have
+# two media, every response is delayed by FAKE_PLEX_LATENCY_MS, and a
+# FAKE_PLEX_ERROR_RATE fraction of GETs fail with a 503. "Movies 4K"
+# holds every tenth movie of "Movies" again, for cross-library duplicates. items are
+# derived from their index, so nothing is held in memory per item. deletes are
+# accepted but not applied, so the same media can be deleted on every round.
+#
+# the notification websocket is served too: notify(server, entries) pushes
+# timeline entries (see timeline_entry) to every connected listener.
+
+import base64
+import bisect
+import hashlib
+import json
+import os
+import queue
+import random
+import re
+import select
+import struct
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import quoteattr
+
+MACHINE_IDENTIFIER = "fake-plex-machine-id"
+# Every n-th item also has a short media, for the sample files view
+SAMPLE_EVERY = 97
+SAMPLE_DURATION = 60 * 1000
+ITEM_DURATION = 90 * 60 * 1000
+UPDATED_AT = 1700000000
+THUMBNAIL = hashlib.sha256(b"fakeplex").digest() * 512  # 16KB
+
+SECTIONS = (
+    # key, type, title, search type id, item libtype, holds every n-th item
+    ("1", "movie", "Movies", "1", "movie", 1),
+    ("2", "show", "TV Shows", "4", "episode", 1),
+    ("3", "movie", "Movies 4K", "1", "movie", 10),
+)
+
+FIELD_TYPES = (
+    '<FieldType type="boolean"><Operator key="=" title="is"/><Operator key="!=" title="is not"/></FieldType>'
+    '<FieldType type="integer"><Operator key="=" title="is"/><Operator key="!=" title="is not"/>'
+    '<Operator key="&gt;&gt;=" title="is greater than"/><Operator key="&lt;&lt;=" title="is less than"/></FieldType>'
+    '<FieldType type="date"><Operator key="&gt;&gt;=" title="is after"/><Operator key="&lt;&lt;=" title="is before"/></FieldType>'
+)
+
+SEARCH_PATH = re.compile(r"^/library/sections/(\d+)/(all|collections)$")
+METADATA_PATH = re.compile(r"^/library/metadata/([\d,]+)$")
+THUMB_PATH = re.compile(r"^/library/metadata/(\d+)/thumb/\d+$")
+MEDIA_PATH = re.compile(r"^/library/metadata/(\d+)/media/(\d+)$")
+NOTIFICATIONS_PATH = "/:/websockets/notifications"
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class FakeLibrary(object):
+    def __init__(self, size, dupe_ratio):
+        self.size = size
+        self.dupe_ratio = dupe_ratio
+        # Spread dupes evenly, so any window of the library has the same ratio
+        self.dupes = [i for i in range(size) if int((i + 1) * dupe_ratio) > int(i * dupe_ratio)]
+        self.samples = list(range(0, size, SAMPLE_EVERY))
+
+    def section_size(self, section):
+        return self.size // section[5]
+
+    def is_dupe(self, index):
+        return int((index + 1) * self.dupe_ratio) > int(index * self.dupe_ratio)
+
+    @staticmethod
+    def rating_key(section_key, index):
+        return int(section_key) * 1000000 + index
+
+    @staticmethod
+    def locate(rating_key):
+        # Returns the section and item index of a rating key, or (None, None)
+        section_key, index = divmod(int(rating_key), 1000000)
+        for section in SECTIONS:
+            if section[0] == str(section_key):
+                return section, index
+        return None, None
+
+    def video_xml(self, section, index, full=False):
+        section_key, section_type, section_title, _, libtype, every = section
+        rating_key = self.rating_key(section_key, index)
+        key = f"/library/metadata/{rating_key}"
+        attrs = {
+            "ratingKey": rating_key,
+            "key": key,
+            "guid": f"plex://{libtype}/{index * every:024x}",
+            "type": libtype,
+            "title": f"{libtype.title()} {index}",
+            "librarySectionID": section_key,
+            "librarySectionTitle": section_title,
+            "year": 1950 + index % 75,
+            "duration": ITEM_DURATION,
+            "thumb": f"{key}/thumb/1700000000",
+            "addedAt": 1600000000 + index,
+            "updatedAt": UPDATED_AT + index,
+        }
+        if libtype == "episode":
+            season, episode = divmod(index, 20)
+            attrs.update({
+                "index": episode + 1,
+                "parentIndex": season % 10 + 1,
+                "parentRatingKey": 900000 + season,
+                "grandparentRatingKey": 800000 + season // 10,
+                "grandparentTitle": f"Show {season // 10}",
+                "parentThumb": f"/library/metadata/{900000 + season}/thumb/1700000000",
+                "grandparentThumb": f"/library/metadata/{800000 + season // 10}/thumb/1700000000",
+            })
+        media_count = 2 if self.is_dupe(index) else 1
+        media = []
+        for m in range(media_count):
+            media_id = rating_key * 4 + m
+            duration = SAMPLE_DURATION if m == 0 and index % SAMPLE_EVERY == 0 else ITEM_DURATION
+            height = 2160 if m else 1080
+            part_attrs = {
+                "id": media_id,
+                "key": f"/library/parts/{media_id}/1700000000/file.mkv",
+                "duration": duration,
+                "file": f"/data/{section_title}/{index}/{index}-{height}p.mkv",
+                "size": 4000000000 + m * 8000000000 + index,
+                "container": "mkv",
+                "videoProfile": "high",
+            }
+            if full:
+                part_attrs.update({"exists": 1, "accessible": 1})
+                streams = (
+                    f'<Stream id="{media_id * 3}" streamType="1" codec="hevc" index="0" height="{height}"/>'
+                    f'<Stream id="{media_id * 3 + 1}" streamType="2" codec="aac" index="1" channels="6"/>'
+                    f'<Stream id="{media_id * 3 + 2}" streamType="3" codec="srt" index="2"/>'
+                )
+            else:
+                streams = ""
+            media.append(
+                f'<Media id="{media_id}" duration="{duration}" bitrate="{8000 * (m + 1)}" '
+                f'width="{height * 16 // 9}" height="{height}" aspectRatio="1.78" audioChannels="6" '
+                f'audioCodec="aac" videoCodec="hevc" videoResolution="{"4k" if m else "1080"}" '
+                f'container="mkv" videoFrameRate="24p" videoProfile="main">'
+                f'<Part {_attributes(part_attrs)}>{streams}</Part></Media>'
+            )
+        extra = f'<Guid id="imdb://tt{rating_key:07d}"/>' if full else ""
+        return f'<Video {_attributes(attrs)}>{"".join(media)}{extra}</Video>'
+
+    def search(self, section, params):
+        size = self.section_size(section)
+        duplicate = params.get("duplicate") or params.get(f"{section[4]}.duplicate")
+        max_duration = params.get("duration<<") or params.get(f"{section[4]}.duration<<")
+        updated_after = params.get("updatedAt>>") or params.get(f"{section[4]}.updatedAt>>")
+        if updated_after is not None:
+            # Item n was last updated at UPDATED_AT + n
+            matches = range(max(int(updated_after) - UPDATED_AT + 1, 0), size)
+        elif duplicate == "1":
+            matches = self.dupes[:bisect.bisect_left(self.dupes, size)]
+        elif max_duration is not None:
+            matches = self.samples[:bisect.bisect_left(self.samples, size)] if int(max_duration) > SAMPLE_DURATION else []
+        else:
+            matches = range(size)
+        return matches
+
+
+def _attributes(attrs):
+    return " ".join(f"{name}={quoteattr(str(value))}" for name, value in attrs.items())
+
+
+def _filter_meta(section):
+    section_key, section_type, section_title, type_id, libtype, _ = section
+    prefix = "" if libtype == section_type else f"{libtype}."
+    types = [
+        f'<Type key="/library/sections/{section_key}/all?type={type_id}" type="{libtype}" '
+        f'title="{libtype.title()}s" active="1">'
+        f'<Field key="{prefix}duplicate" title="Duplicate" type="boolean"/>'
+        f'<Field key="{prefix}duration" title="Duration" type="integer"/>'
+        f'<Field key="{prefix}updatedAt" title="Date Updated" type="date"/>'
+        f'<Field key="{prefix}title" title="Title" type="string"/>'
+        f'</Type>'
+    ]
+    if libtype != section_type:
+        types.insert(0, (
+            f'<Type key="/library/sections/{section_key}/all?type=2" type="{section_type}" title="Shows" active="0">'
+            f'<Field key="title" title="Title" type="string"/></Type>'
+        ))
+    return f'<Meta>{"".join(types)}{FIELD_TYPES}</Meta>'
+
+
+class FakePlexHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive between requests
+    protocol_version = "HTTP/1.1"
+    library = None
+    latency = 0
+    error_rate = 0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return self.send_error(503)
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path.rstrip("/") or "/"
+
+        if path in ("/", "/identity"):
+            return self.send_xml(
+                f'<MediaContainer size="0" friendlyName="Fake Plex" machineIdentifier="{MACHINE_IDENTIFIER}" '
+                f'version="1.40.0.0" myPlex="0" platform="Linux" allowMediaDeletion="1"></MediaContainer>'
+            )
+        if path == "/library":
+            return self.send_xml('<MediaContainer size="0" title1="Plex Library" identifier="com.plexapp.plugins.library"/>')
+        if path == "/library/sections":
+            directories = "".join(
+                f'<Directory key="{key}" type="{section_type}" title="{title}" agent="tv.plex.agents.{section_type}" '
+                f'scanner="Plex {section_type.title()}" language="en-US" uuid="fake-{key}" refreshing="0"/>'
+                for key, section_type, title, _, _, _ in SECTIONS
+            )
+            return self.send_xml(f'<MediaContainer size="{len(SECTIONS)}">{directories}</MediaContainer>')
+        if path == NOTIFICATIONS_PATH:
+            return self.send_notifications()
+        if path == "/photo/:/transcode":
+            return self.send_thumbnail(params.get("url", ""))
+
+        match = SEARCH_PATH.match(path)
+        if match:
+            return self.send_search(match.group(1), match.group(2), params)
+        match = METADATA_PATH.match(path)
+        if match:
+            videos = []
+            for rating_key in match.group(1).split(","):
+                section, index = self.library.locate(rating_key)
+                if section is not None and index < self.library.section_size(section):
+                    videos.append(self.library.video_xml(section, index, full=True))
+            if not videos:
+                return self.send_error(404)
+            return self.send_xml(f'<MediaContainer size="{len(videos)}">{"".join(videos)}</MediaContainer>')
+        if THUMB_PATH.match(path):
+            return self.send_thumbnail(path)
+        self.send_error(404)
+
+    def do_DELETE(self):
+        time.sleep(self.latency)
+        match = MEDIA_PATH.match(urllib.parse.urlsplit(self.path).path)
+        if not match:
+            return self.send_error(404)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_search(self, section_key, endpoint, params):
+        section = next((section for section in SECTIONS if section[0] == section_key), None)
+        if section is None:
+            return self.send_error(404)
+        start = int(self.headers.get("X-Plex-Container-Start", params.get("X-Plex-Container-Start", 0)))
+        size = int(self.headers.get("X-Plex-Container-Size", params.get("X-Plex-Container-Size", 100)))
+        meta = _filter_meta(section) if params.get("includeMeta") == "1" else ""
+        if endpoint == "collections":
+            return self.send_xml(f'<MediaContainer size="0" totalSize="0">{meta}</MediaContainer>')
+        matches = self.library.search(section, params)
+        window = matches[start:start + size]
+        videos = "".join(self.library.video_xml(section, index) for index in window)
+        self.send_xml(
+            f'<MediaContainer size="{len(window)}" totalSize="{len(matches)}" offset="{start}" '
+            f'librarySectionID="{section_key}" librarySectionTitle="{section[2]}">{meta}{videos}</MediaContainer>'
+        )
+
+    def send_notifications(self):
+        # Just enough of RFC 6455 to push unmasked text frames to one client
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.close_connection = True
+        messages = queue.Queue()
+        with self.subscribers_lock:
+            self.subscribers.append(messages)
+        try:
+            while True:
+                try:
+                    message = messages.get(timeout=0.1)
+                except queue.Empty:
+                    # Anything from the client is its close frame
+                    if select.select([self.connection], [], [], 0)[0]:
+                        return
+                    continue
+                if message is None:
+                    return
+                payload = message.encode()
+                if len(payload) < 126:
+                    header = struct.pack("!BB", 0x81, len(payload))
+                elif len(payload) < 65536:
+                    header = struct.pack("!BBH", 0x81, 126, len(payload))
+                else:
+                    header = struct.pack("!BBQ", 0x81, 127, len(payload))
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with self.subscribers_lock:
+                self.subscribers.remove(messages)
+
+    def send_thumbnail(self, path):
+        etag = '"' + hashlib.sha1(path.encode()).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Tue, 14 Nov 2023 22:13:20 GMT")
+        self.send_header("Content-Length", str(len(THUMBNAIL)))
+        self.end_headers()
+        self.wfile.write(THUMBNAIL)
+
+    def send_xml(self, body):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>' + body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml;charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_plex(size=None, dupe_ratio=None, latency_ms=None, error_rate=None, port=0):
+    """
+    Start a fake Plex server on a background thread. Arguments default to the
+    FAKE_PLEX_* environment variables. Returns (server, baseurl); call
+    server.shutdown() to stop it.
+    """
+    size = int(size if size is not None else os.getenv("FAKE_PLEX_SIZE", 1000))
+    dupe_ratio = float(dupe_ratio if dupe_ratio is not None else os.getenv("FAKE_PLEX_DUPE_RATIO", 0.1))
+    latency_ms = float(latency_ms if latency_ms is not None else os.getenv("FAKE_PLEX_LATENCY_MS", 0))
+    error_rate = float(error_rate if error_rate is not None else os.getenv("FAKE_PLEX_ERROR_RATE", 0))
+    handler = type("FakePlexHandler", (FakePlexHandler,), {
+        "library": FakeLibrary(size, dupe_ratio),
+        "latency": latency_ms / 1000,
+        "error_rate": error_rate,
+        "subscribers": [],
+        "subscribers_lock": threading.Lock(),
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def timeline_entry(rating_key, state=5):
+    # A library timeline notification, as Plex sends for a processed item
+    section, index = FakeLibrary.locate(rating_key)
+    return {
+        "identifier": "com.plexapp.plugins.library",
+        "sectionID": section[0],
+        "itemID": str(rating_key),
+        "type": 4 if section[4] == "episode" else 1,
+        "title": f"{section[4].title()} {index}",
+        "state": state,
+        "updatedAt": UPDATED_AT + index,
+    }
+
+
+def notify(server, entries):
+    """Push timeline entries to every client of the notification websocket."""
+    handler = server.RequestHandlerClass
+    message = json.dumps({
+        "NotificationContainer": {"type": "timeline", "size": len(entries), "TimelineEntry": entries}
+    })
+    with handler.subscribers_lock:
+        for messages in handler.subscribers:
+            messages.put(message)
+
+
+def count_subscribers(server):
+    handler = server.RequestHandlerClass
+    with handler.subscribers_lock:
+        return len(handler.subscribers)
+
+
+if __name__ == "__main__":
+    server, baseurl = start_fake_plex(port=int(os.getenv("FAKE_PLEX_PORT", 32400)))
+    print(f"fake plex listening on {baseurl}, set LIBRARY_NAMES=\"Movies;TV Shows\" to use both libraries")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
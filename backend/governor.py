@@ -0,0 +1,179 @@
+import os
+import random
+import threading
+import time
+
+import requests
+
+from logger import get_logger
+from utils import increment_counter
+
+logger = get_logger(__name__)
+
+# Only these are safe to send again after a failure
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+RETRY_STATUSES = (429, 502, 503, 504)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class PlexUnavailableError(Exception):
+    """
+    Raised instead of sending a request while the circuit breaker is open, or
+    when no request slot frees up in time. Deliberately not a requests
+    exception, so it doesn't make the wrapper reconnect.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RequestGovernor(object):
+    """
+    Every request to Plex passes through here (see GovernedAdapter). It:
+
+    - limits the number of requests in flight, growing the limit by one per
+      window of fast, successful requests and halving it when a request fails
+      or takes longer than PLEX_LATENCY_TARGET seconds (AIMD);
+    - retries idempotent requests that failed to connect, timed out or got a
+      429/502/503/504, up to PLEX_RETRIES times with full-jitter backoff;
+    - opens a circuit breaker after PLEX_BREAKER_THRESHOLD consecutive
+      failures, failing every request fast for PLEX_BREAKER_COOLDOWN seconds,
+      then lets a single probe request through, holding the others back
+      until it decides whether the breaker closes again.
+    """
+
+    def __init__(self, max_limit=32):
+        self.max_limit = int(os.environ.get("PLEX_MAX_CONCURRENCY", max_limit))
+        self.min_limit = 1
+        self.limit = float(min(8, self.max_limit))
+        self.latency_target = float(os.environ.get("PLEX_LATENCY_TARGET", 5))
+        self.queue_timeout = float(os.environ.get("PLEX_QUEUE_TIMEOUT", 60))
+        self.retries = int(os.environ.get("PLEX_RETRIES", 2))
+        self.backoff = 0.25
+        self.backoff_max = 10
+        self.breaker_threshold = int(os.environ.get("PLEX_BREAKER_THRESHOLD", 5))
+        self.breaker_cooldown = float(os.environ.get("PLEX_BREAKER_COOLDOWN", 30))
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.last_error = None
+        self._probe_in_flight = False
+        self._last_decrease = 0
+
+    def get_status(self):
+        with self.condition:
+            return {
+                "state": self.state,
+                "limit": int(self.limit),
+                "inFlight": self.in_flight,
+                "consecutiveFailures": self.consecutive_failures,
+                "retryAfter": max(self.open_until - time.monotonic(), 0) if self.state == OPEN else None,
+                "lastError": self.last_error,
+            }
+
+    def call(self, method, send):
+        """Send a request through the governor; send() performs one attempt."""
+        idempotent = method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            probe = self._acquire()
+            start_time = time.monotonic()
+            error = None
+            # The slot (and the probe) is given back whatever send() raises
+            try:
+                response = send()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = str(e)
+                if not idempotent or attempt >= self.retries:
+                    raise
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                raise
+            else:
+                if response.status_code >= 500:
+                    error = f"HTTP {response.status_code}"
+                if not idempotent or attempt >= self.retries or response.status_code not in RETRY_STATUSES:
+                    return response
+                response.close()
+            finally:
+                self._release(time.monotonic() - start_time, error, probe)
+            attempt += 1
+            increment_counter("plex_retries")
+            time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt)))
+
+    def _acquire(self):
+        # Returns whether this request is the half-open probe
+        deadline = time.monotonic() + self.queue_timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.state == OPEN and now >= self.open_until:
+                    self.state = HALF_OPEN
+                if self.state == OPEN:
+                    increment_counter("plex_rejected_requests")
+                    retry_after = max(self.open_until - now, 1)
+                    raise PlexUnavailableError(
+                        f"Plex is not responding ({self.last_error}), not retrying for {int(retry_after)}s",
+                        retry_after,
+                    )
+                # While half-open, everything else waits for the probe's outcome
+                if self.in_flight < int(self.limit) and not self._probe_in_flight:
+                    break
+                if now >= deadline:
+                    increment_counter("plex_rejected_requests")
+                    raise PlexUnavailableError(
+                        f"Plex is busy: no request slot freed up within {self.queue_timeout:g}s", self.queue_timeout
+                    )
+                self.condition.wait(deadline - now)
+            self.in_flight += 1
+            if self.state == HALF_OPEN:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def _release(self, elapsed, error, probe):
+        now = time.monotonic()
+        with self.condition:
+            self.in_flight -= 1
+            if probe:
+                self._probe_in_flight = False
+            if error is not None:
+                increment_counter("plex_failed_requests")
+                self.last_error = error
+                self.consecutive_failures += 1
+                if probe or self.consecutive_failures >= self.breaker_threshold:
+                    if self.state != OPEN:
+                        logger.error(f"Plex circuit breaker opened after {self.consecutive_failures} failures: {error}")
+                    self.state = OPEN
+                    self.open_until = now + self.breaker_cooldown
+            else:
+                self.consecutive_failures = 0
+                if probe:
+                    logger.warning("Plex circuit breaker closed")
+                    self.state = CLOSED
+            if error is not None or elapsed > self.latency_target:
+                # Halve at most once per request duration, so a burst of slow
+                # requests that were all sent together only counts once
+                if now - self._last_decrease > elapsed:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class GovernedAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter that sends every request through a RequestGovernor."""
+
+    def __init__(self, governor, *args, **kwargs):
+        self.governor = governor
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        return self.governor.call(request.method, lambda: super(GovernedAdapter, self).send(request, **kwargs))
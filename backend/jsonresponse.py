@@ -0,0 +1,78 @@
+import gzip
+import hashlib
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional, falls back to the standard library encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional, responses are gzipped instead
+    brotli = None
+
+# Bodies smaller than this aren't worth compressing
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 2048))
+GZIP_LEVEL = 6
+# Brotli's default quality (11) is meant for static assets and is far too slow per request
+BROTLI_QUALITY = 5
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask's JSON provider, minus key sorting and ASCII escaping, which only
+    cost time on large result lists. Uses orjson when it is installed.
+    """
+
+    ensure_ascii = False
+    sort_keys = False
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def get_encoding(request):
+    encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(encodings)
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def prepare_json_response(response, request):
+    """
+    Give a successful JSON response to a GET a content hash as its ETag,
+    answering a matching If-None-Match with 304, and compress large bodies
+    for clients that accept gzip or brotli. The ETag is weak, since it stays
+    the same whichever encoding the body is sent with.
+    """
+    if request.method != "GET" or response.status_code != 200 or response.mimetype != "application/json":
+        return response
+    if response.is_streamed or response.direct_passthrough:
+        return response
+    body = response.get_data()
+    response.set_etag(hashlib.blake2b(body, digest_size=16).hexdigest(), weak=True)
+    # Cached copies must be revalidated, which is cheap now that it's a 304
+    response.headers["Cache-Control"] = "no-cache"
+    compressible = len(body) >= COMPRESS_MIN_SIZE and "Content-Encoding" not in response.headers
+    if compressible:
+        response.vary.add("Accept-Encoding")
+    response.make_conditional(request)
+    if response.status_code == 304 or not compressible:
+        return response
+    encoding = get_encoding(request)
+    if encoding is None:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
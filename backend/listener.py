@@ -0,0 +1,189 @@
+import fcntl
+import math
+import os
+import threading
+import time
+
+from plexapi.alert import AlertListener
+
+from logger import get_logger
+from utils import increment_counter
+
+logger = get_logger(__name__)
+
+LIBRARY_IDENTIFIER = "com.plexapp.plugins.library"
+# Timeline entry types for movies and episodes
+CONTENT_TYPES = (1, 4)
+# Timeline states for "the item processed" and "the item deleted"
+CONTENT_STATES = (5, 9)
+
+
+class ChangeListener(object):
+    """
+    Keeps cached duplicate and sample results fresh from Plex's notification
+    websocket (PLEX_NOTIFICATIONS=1), instead of waiting for the next full
+    scan. The rating keys of changed movies and episodes are queued, and once
+    notifications have been quiet for NOTIFICATION_DEBOUNCE seconds only those
+    items are fetched and re-serialized. A full scan still runs every
+    RECONCILE_INTERVAL seconds to catch anything a notification missed.
+
+    Every worker process listens, since each holds its own sample cache, but
+    only the one holding a lock file under CONFIG_DIR writes the dupe index.
+    """
+
+    def __init__(self, wrapper_factory, scanner, config_dir=None):
+        config_dir = config_dir or os.environ.get("CONFIG_DIR", "")  # Will be set by Dockerfile
+        self.wrapper_factory = wrapper_factory
+        self.scanner = scanner
+        self.enabled = os.environ.get("PLEX_NOTIFICATIONS", "0") == "1"
+        self.debounce = float(os.environ.get("NOTIFICATION_DEBOUNCE", 5))
+        # Don't let a steady stream of notifications hold changes back forever
+        self.max_delay = self.debounce * 6
+        self.reconcile_interval = int(os.environ.get("RECONCILE_INTERVAL", 6 * 60 * 60))
+        self.lock_path = os.path.join(config_dir, "dupe_index_writer.lock")
+        self.condition = threading.Condition()
+        # rating key -> when it was first queued
+        self.pending = {}
+        self.last_event = 0
+        self.next_reconcile = self._get_next_reconcile()
+        self.connected = False
+        self.refreshed = 0
+        self.alert_listener = None
+        self.threads = []
+        self.stopped = False
+        self._lock_file = None
+
+    def _get_next_reconcile(self):
+        if self.reconcile_interval <= 0:
+            return math.inf
+        return time.monotonic() + self.reconcile_interval
+
+    def start(self):
+        with self.condition:
+            if not self.enabled or (self.threads and all(thread.is_alive() for thread in self.threads)):
+                return
+            self.stopped = False
+            # Also replaces a thread that died, so one crash doesn't stop notifications for good
+            targets = ((self._listen, "plex-notifications"), (self._work, "plex-notification-worker"))
+            threads = []
+            for index, (target, name) in enumerate(targets):
+                thread = self.threads[index] if self.threads else None
+                if thread is None or not thread.is_alive():
+                    thread = threading.Thread(target=target, name=name, daemon=True)
+                    thread.start()
+                threads.append(thread)
+            self.threads = threads
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.alert_listener is not None and self.alert_listener._ws is not None:
+            self.alert_listener.stop()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def get_status(self):
+        with self.condition:
+            return {
+                "enabled": self.enabled,
+                "connected": self.connected,
+                "pending": len(self.pending),
+                "refreshed": self.refreshed,
+            }
+
+    def _listen(self):
+        backoff = 1
+        while not self.stopped:
+            started_at = time.monotonic()
+            try:
+                self.alert_listener = AlertListener(
+                    self.wrapper_factory().plex, callback=self._on_alert, callbackError=self._on_error
+                )
+                self.connected = True
+                # Runs on this thread until the websocket closes
+                self.alert_listener.run()
+            except Exception as e:
+                logger.error(f"Plex notification listener failed: {e}")
+            self.connected = False
+            if self.stopped:
+                return
+            if time.monotonic() - started_at > 60:
+                backoff = 1
+            logger.warning("Plex notifications disconnected, reconnecting in %ss", backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def _on_error(self, error):
+        logger.error(f"Plex notification error: {error}")
+
+    def _on_alert(self, data):
+        if data.get("type") != "timeline":
+            return
+        now = time.monotonic()
+        with self.condition:
+            for entry in data.get("TimelineEntry", []):
+                if entry.get("identifier") != LIBRARY_IDENTIFIER:
+                    continue
+                if entry.get("type") not in CONTENT_TYPES or entry.get("state") not in CONTENT_STATES:
+                    continue
+                self.pending.setdefault(str(entry["itemID"]), now)
+                self.last_event = now
+            self.condition.notify_all()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    due = self.next_reconcile
+                    if self.pending:
+                        due = min(due, self.last_event + self.debounce, min(self.pending.values()) + self.max_delay)
+                    timeout = due - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(None if timeout == math.inf else timeout)
+                if self.stopped:
+                    return
+                rating_keys = list(self.pending)
+                self.pending = {}
+            try:
+                if rating_keys:
+                    self._refresh(rating_keys)
+                if time.monotonic() >= self.next_reconcile:
+                    self._reconcile()
+            except Exception as e:
+                logger.error(f"Plex notification worker failed: {e}")
+
+    def _refresh(self, rating_keys):
+        try:
+            self.wrapper_factory().refresh_content(rating_keys, update_index=self._is_index_writer())
+            increment_counter("notification_items_refreshed", len(rating_keys))
+            with self.condition:
+                self.refreshed += len(rating_keys)
+        except Exception as e:
+            # The next reconcile picks these up
+            logger.error(f"Error refreshing {len(rating_keys)} changed items: {e}")
+
+    def _reconcile(self):
+        logger.debug("Reconciling cached results with a full scan")
+        self.next_reconcile = self._get_next_reconcile()
+        try:
+            self.wrapper_factory().sample_cache.clear()
+        except Exception as e:
+            # Plex is unreachable; the scan below records that it failed and is retried next interval
+            logger.error(f"Error clearing cached samples before reconciling: {e}")
+        self.scanner.start()
+
+    def _is_index_writer(self):
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        # Held until the process exits
+        self._lock_file = lock_file
+        return True
@@ -1,41 +1,232 @@
-import io
+import json
 import os
+import threading
+import time
 import urllib
+from functools import partial
 
 import requests as requests
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, g, jsonify, request, send_file
 from flask_cors import CORS
 
-from database import Database
+from crossdupes import CrossServerIndex
+from dupeindex import DupeQuery
 from logger import get_logger
-from plexwrapper import PlexWrapper
+from governor import PlexUnavailableError
+from jsonresponse import FastJSONProvider, prepare_json_response
+from listener import ChangeListener
+from plexwrapper import get_existing_plex_wrapper, get_plex_wrapper, mark_plex_wrapper_unhealthy
+import metrics
+from scanner import DupeScanner
+from servers import MissingServerError, ServerPool, UnknownServerError, get_server_config, get_server_configs, is_multi_server
+from thumbcache import ThumbnailCache
+from utils import InvalidCursorError, decode_cursor, encode_cursor, increment_counter
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app)
 
 logger = get_logger(__name__)
 
+server_configs = get_server_configs()
+# Every server is scanned and listened to on its own, so one that is down can't hold up the others
+scanners = {
+    config.name: DupeScanner(partial(get_plex_wrapper, config.name), config.config_dir)
+    for config in server_configs
+}
+listeners = {
+    config.name: ChangeListener(partial(get_plex_wrapper, config.name), scanners[config.name], config.config_dir)
+    for config in server_configs
+}
+server_pool = ServerPool(get_plex_wrapper, server_configs)
+cross_server_index = CrossServerIndex(server_configs, get_existing_plex_wrapper)
+thumbnail_cache = ThumbnailCache()
+
+# Upstream fetches made by /server/proxy share the wrapper's keep-alive
+# session, and are streamed through in chunks rather than buffered.
+PROXY_MAX_CONCURRENCY = int(os.environ.get("PROXY_MAX_CONCURRENCY", 16))
+PROXY_TIMEOUT = int(os.environ.get("PROXY_TIMEOUT", 30))
+PROXY_CHUNK_SIZE = 64 * 1024
+# No Content-Length: iter_content decodes gzip, so the body can be longer than Plex said
+PROXY_HEADERS = ("Content-Type", "Cache-Control", "ETag", "Last-Modified", "Expires")
+proxy_semaphore = threading.BoundedSemaphore(PROXY_MAX_CONCURRENCY)
+# Artwork hosted anywhere but the Plex server is fetched without the Plex
+# governor, so its failures don't open the breaker or shrink the limit
+external_session = requests.Session()
+external_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=PROXY_MAX_CONCURRENCY))
+external_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=PROXY_MAX_CONCURRENCY))
+
+# Thumbnails are addressed by content key, so browsers can keep them for a long time
+THUMBNAIL_MAX_AGE = int(os.environ.get("THUMBNAIL_MAX_AGE", 7 * 24 * 60 * 60))
+
+
+@app.before_request
+def start_background_threads():
+    # Started lazily so the scheduler and listener threads live in the uWSGI worker,
+    # not in the master process it was forked from.
+    for config in server_configs:
+        scanners[config.name].start_scheduler()
+        listeners[config.name].start()
+
+
+def request_server():
+    # The server a request is for, from ?server= or "server" in a JSON body; None means the first one
+    if request.is_json:
+        content = request.get_json(silent=True) or {}
+        if "server" in content:
+            return content["server"]
+    return request.args.get("server")
+
+
+def request_page():
+    # ?page= of the listings, counted from 1
+    value = request.args.get("page", "1")
+    if not value.isdigit() or int(value) < 1:
+        raise ValueError(f"Invalid page: {value!r}, expected a positive integer")
+    return int(value)
+
+
+def request_item_server():
+    # Content keys and media ids are only unique within a server, so with several
+    # servers, calls about one item must say which server it came from
+    server = request_server()
+    if server is None and is_multi_server():
+        raise MissingServerError("Missing server: content keys and media ids are only unique within a server")
+    return server
+
+
+def get_scanner():
+    return scanners[get_server_config(request_server()).name]
+
+
+if metrics.enabled:
+    @app.before_request
+    def start_request_timer():
+        g.request_start_time = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response):
+        if "request_start_time" in g:
+            # Label by route rule, not path, so the number of series stays bounded
+            route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+            metrics.route_latency.observe(time.perf_counter() - g.request_start_time, route, request.method)
+        return response
+
+
+@app.after_request
+def add_json_validators(response):
+    return prepare_json_response(response, request)
+
+
+@app.errorhandler(PlexUnavailableError)
+def plex_unavailable(error):
+    # Failing fast while Plex is overloaded or down
+    logger.error(error)
+    response = jsonify({"error": str(error)})
+    response.status_code = 503
+    if error.retry_after is not None:
+        response.headers["Retry-After"] = str(int(error.retry_after))
+    return response
+
+
+@app.errorhandler(InvalidCursorError)
+def invalid_cursor(error):
+    return jsonify({"error": str(error)}), 400
+
+
+@app.errorhandler(MissingServerError)
+def missing_server(error):
+    return jsonify({"error": str(error)}), 400
+
+
+@app.errorhandler(UnknownServerError)
+def unknown_server(error):
+    return jsonify({"error": str(error)}), 404
+
 
 @app.errorhandler(Exception)
 def internal_error(error):
     logger.error(error)
+    # An error status from Plex means it was reached, so only other failures mark it unhealthy
+    response = getattr(error, "response", None)
+    if isinstance(error, requests.exceptions.RequestException) and (response is None or response.status_code >= 500):
+        mark_plex_wrapper_unhealthy(request_server())
     return jsonify({"error": str(error)}), 500
 
 
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/server/info")
 def get_server_info():
-    info = PlexWrapper().get_server_info()
+    info = get_plex_wrapper(request_server()).get_server_info()
     return jsonify(info)
 
 
+@app.route("/server/health")
+def get_server_health():
+    # State of the Plex request governor: concurrency limit and circuit breaker.
+    # Read without reconnecting, which would fail exactly while the breaker is open
+    wrapper = get_existing_plex_wrapper(request_server())
+    if wrapper is None:
+        return jsonify({"state": "disconnected"})
+    return jsonify(wrapper.governor.get_status())
+
+
+def is_plex_url(wrapper, url):
+    plex_url = urllib.parse.urlsplit(wrapper.baseurl)
+    target = urllib.parse.urlsplit(url)
+    return (target.scheme, target.netloc) == (plex_url.scheme, plex_url.netloc)
+
+
 @app.route("/server/proxy")
 def get_server_proxy():
     # Proxy a request to the server - useful when the user
     # is viewing the cleanarr dash over HTTPS to avoid the browser
     # blocking untrusted server certs
     url = request.args.get('url')
-    r = requests.get(url)
-    return send_file(io.BytesIO(r.content), mimetype='image/jpeg')
+    if not url:
+        return jsonify({"error": "Missing url"}), 400
+    headers = {
+        name: request.headers[name]
+        for name in ("If-None-Match", "If-Modified-Since")
+        if name in request.headers
+    }
+    wrapper = get_plex_wrapper(request_server())
+    plex_url = is_plex_url(wrapper, url)
+    session = wrapper.plex._session if plex_url else external_session
+    if not proxy_semaphore.acquire(timeout=PROXY_TIMEOUT):
+        return jsonify({"error": "Too many concurrent proxy requests"}), 503
+    try:
+        r = session.get(url, headers=headers, stream=True, timeout=PROXY_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        proxy_semaphore.release()
+        if plex_url:
+            raise
+        # Artwork hosted elsewhere failing says nothing about the Plex connection
+        logger.error(f"Proxy request to {url} failed: {e}")
+        return jsonify({"error": str(e)}), 502
+    except Exception:
+        proxy_semaphore.release()
+        raise
+
+    response_headers = {name: r.headers[name] for name in PROXY_HEADERS if name in r.headers}
+    response_headers.setdefault("Content-Type", "image/jpeg")
+    response = Response(
+        r.iter_content(chunk_size=PROXY_CHUNK_SIZE),
+        status=r.status_code,
+        headers=response_headers,
+    )
+
+    def release():
+        r.close()
+        proxy_semaphore.release()
+
+    # Runs when the response is closed, including when the client disconnects
+    response.call_on_close(release)
+    return response
 
 @app.route("/server/thumbnail")
 def get_server_thumbnail():
@@ -43,26 +234,289 @@ def get_server_thumbnail():
     # is viewing the cleanarr dash over HTTPS to avoid the browser
     # blocking untrusted server certs
     content_key = urllib.parse.unquote(request.args.get('content_key'))
-    url = PlexWrapper().get_thumbnail_url(content_key)
-    r = requests.get(url)
-    return send_file(io.BytesIO(r.content), mimetype='image/jpeg')
+    path, meta = thumbnail_cache.get(get_plex_wrapper(request_item_server()), content_key)
+    if path is None:
+        return jsonify({"error": "No thumbnail found"}), 404
+    # send_file answers If-None-Match with a 304 using the etag
+    return send_file(
+        path,
+        mimetype=meta["contentType"],
+        etag=meta["etag"],
+        max_age=THUMBNAIL_MAX_AGE,
+    )
 
 @app.route("/content/dupes")
 def get_dupes():
-    page = int(request.args.get("page", 1))
-    dupes = PlexWrapper().get_dupe_content(page)
+    try:
+        query = DupeQuery.from_args(request.args)
+        page = request_page()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not query.is_empty():
+        return query_dupes(query, page)
+    if "cursor" in request.args:
+        return get_dupes_page(request.args.get("cursor"))
+    if is_multi_server() and request_server() is None:
+        return get_merged_dupes(page)
+    wrapper = get_plex_wrapper(request_server())
+    if wrapper.dupe_index.is_ready():
+        increment_counter("dupe_index_cache_hits")
+        dupes = wrapper.dupe_index.get_page(page, wrapper.page_size)
+        mark_ignored(wrapper, dupes)
+        add_thumb_urls(wrapper, dupes)
+        response = jsonify(dupes)
+        response.headers["X-Scan-Age"] = str(int(wrapper.dupe_index.age()))
+        response.headers["X-Scan-State"] = get_scanner().get_status()["state"]
+        return response
+    increment_counter("dupe_index_cache_misses")
+    dupes = wrapper.get_dupe_content(page)
+    # Live pages may come from the shared cache, from before an item was (un)ignored
+    mark_ignored(wrapper, dupes)
+    add_thumb_urls(wrapper, dupes)
     return jsonify(dupes)
 
 
+def mark_ignored(wrapper, dupes):
+    ignored_keys = wrapper.db.get_ignored_items(dupe["key"] for dupe in dupes)
+    for dupe in dupes:
+        dupe["ignored"] = dupe["key"] in ignored_keys
+
+
+def add_thumb_urls(wrapper, dupes):
+    for dupe in dupes:
+        if "thumbUrl" in dupe:
+            dupe["thumbUrl"] = wrapper.get_thumb_url(dupe["thumbUrl"])
+
+
+def get_server_dupes(wrapper, page):
+    if wrapper.dupe_index.is_ready():
+        dupes = wrapper.dupe_index.get_page(page, wrapper.page_size)
+    else:
+        dupes = wrapper.get_dupe_content(page)
+    mark_ignored(wrapper, dupes)
+    add_thumb_urls(wrapper, dupes)
+    for dupe in dupes:
+        dupe["server"] = wrapper.name
+    return dupes
+
+
+def get_merged_dupes(page):
+    # The same page from every server at once, tagged with the server it came
+    # from. Servers that fail or don't answer in time are left out and named
+    # in X-Unavailable-Servers; see /servers for why.
+    results, errors = server_pool.map(lambda wrapper: get_server_dupes(wrapper, page))
+    response = jsonify([dupe for dupes in results.values() for dupe in dupes])
+    if errors:
+        response.headers["X-Unavailable-Servers"] = ",".join(errors)
+    return response
+
+
+def get_dupes_page(cursor):
+    # Pass an empty cursor to start, then the returned cursor until hasMore is false
+    wrapper = get_plex_wrapper(request_server())
+    if not wrapper.dupe_index.is_ready():
+        check_live_cursor(wrapper, cursor)
+        results = wrapper.get_dupe_content_page(cursor)
+        mark_ignored(wrapper, results["items"])
+        add_thumb_urls(wrapper, results["items"])
+        return jsonify(results)
+    after = get_index_cursor(cursor)
+    dupes, has_more = wrapper.dupe_index.get_after(after, wrapper.page_size)
+    mark_ignored(wrapper, dupes)
+    add_thumb_urls(wrapper, dupes)
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor({"after": [dupes[-1]["library"], dupes[-1]["key"]]})
+    response = jsonify({
+        "items": dupes,
+        "cursor": next_cursor,
+        "hasMore": has_more,
+        "totals": wrapper.dupe_index.get_totals(),
+    })
+    response.headers["X-Scan-Age"] = str(int(wrapper.dupe_index.age()))
+    return response
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def check_live_cursor(wrapper, cursor):
+    # Live cursors hold per-library offsets into Plex's search results, along
+    # with the number of dupes in each library
+    state = decode_cursor(cursor, "offsets")
+    if not state:
+        return
+    offsets = state["offsets"]
+    totals = state.get("totals")
+    if (
+        not isinstance(offsets, dict)
+        or not isinstance(totals, dict)
+        or offsets.keys() != totals.keys()
+        or not set(totals) <= set(wrapper.libraries)
+        or not all(is_int(total) and total >= 0 for total in totals.values())
+        or not all(offset is None or (is_int(offset) and offset >= 0) for offset in offsets.values())
+    ):
+        raise InvalidCursorError(f"Invalid cursor: {cursor}")
+
+
+def get_index_cursor(cursor, sort=None):
+    # The keyset position in a cursor issued by the dupe index, for the listing
+    # sorted by sort (None being the unfiltered listing, ordered by library and key)
+    state = decode_cursor(cursor, "after")
+    if not state:
+        return None
+    after = state["after"]
+    if state.get("sort") != sort or not isinstance(after, list) or len(after) != (2 if sort is None else 3):
+        raise InvalidCursorError("Cursor was issued by another listing, request the first page again")
+    # Positions are compared with the index's own rows, so every element must
+    # have the type of the value it stands for: the sort value (text for
+    # titles, a number otherwise), then the library and content key
+    valid = all(isinstance(part, str) for part in after[-2:])
+    if sort is not None:
+        value = after[0]
+        valid = valid and (isinstance(value, str) if sort.lstrip("-") == "title" else is_int(value))
+    if not valid:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}")
+    return after
+
+
+def query_dupes(query, page):
+    # Filtered and sorted results are only served from the scan's index,
+    # never by walking the libraries on Plex
+    wrapper = get_plex_wrapper(request_server())
+    if not wrapper.dupe_index.is_ready():
+        get_scanner().start()
+        response = jsonify({"error": "Duplicates have not been scanned yet"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "30"
+        return response
+    increment_counter("dupe_index_cache_hits")
+    page_size = wrapper.page_size
+    if "cursor" in request.args:
+        after = get_index_cursor(request.args.get("cursor"), request.args.get("sort", ""))
+        dupes, total, has_more = wrapper.dupe_index.query(query, page_size, after=after)
+    else:
+        dupes, total, has_more = wrapper.dupe_index.query(query, page_size, offset=(page - 1) * page_size)
+    mark_ignored(wrapper, dupes)
+    add_thumb_urls(wrapper, dupes)
+    if "cursor" in request.args:
+        next_cursor = None
+        if has_more:
+            next_cursor = encode_cursor({
+                "after": wrapper.dupe_index.get_cursor(query, dupes[-1]),
+                "sort": request.args.get("sort", ""),
+            })
+        response = jsonify({"items": dupes, "cursor": next_cursor, "hasMore": has_more, "total": total})
+    else:
+        response = jsonify(dupes)
+    response.headers["X-Total-Count"] = str(total)
+    response.headers["X-Scan-Age"] = str(int(wrapper.dupe_index.age()))
+    response.headers["X-Scan-State"] = get_scanner().get_status()["state"]
+    return response
+
+
+@app.route("/content/dupes/cross-library")
+def get_cross_library_dupes():
+    # Content found in more than one library, as of the last background scan
+    wrapper = get_plex_wrapper(request_server())
+    response = jsonify(wrapper.cross_library_index.get_groups())
+    response.headers["X-Scan-State"] = get_scanner().get_status()["state"]
+    return response
+
+
+@app.route("/content/dupes/cross-server")
+def get_cross_server_dupes():
+    # Content found on more than one server, as of each server's last background scan
+    return jsonify(cross_server_index.get_groups())
+
+
+@app.route("/content/dupes/stream")
+def stream_dupes():
+    # Newline-delimited JSON, one dupe per line, written as each is serialized
+    try:
+        page = request_page()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    wrapper = get_plex_wrapper(request_server())
+    if wrapper.dupe_index.is_ready():
+        dupes = iter(wrapper.dupe_index.get_page(page, wrapper.page_size))
+    else:
+        dupes = wrapper.iter_dupe_content(page)
+
+    def generate():
+        try:
+            for dupe in dupes:
+                add_thumb_urls(wrapper, [dupe])
+                yield json.dumps(dupe) + "\n"
+        finally:
+            # Called on client disconnect too; stops any outstanding Plex work
+            if hasattr(dupes, "close"):
+                dupes.close()
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+def get_server_scan_status(server):
+    status = scanners[server].get_status()
+    status["notifications"] = listeners[server].get_status()
+    return status
+
+
+@app.route("/content/scan")
+def get_scan_status():
+    if is_multi_server() and request_server() is None:
+        # Read from each server's status file, so offline servers are reported too
+        return jsonify({"servers": {config.name: get_server_scan_status(config.name) for config in server_configs}})
+    return jsonify(get_server_scan_status(get_server_config(request_server()).name))
+
+
+@app.route("/content/scan", methods=["POST"])
+def start_scan():
+    if is_multi_server() and request_server() is None:
+        # Each scan runs on its own thread, so the servers are scanned concurrently
+        started = {config.name: scanners[config.name].start() for config in server_configs}
+        return jsonify({"success": True, "started": started})
+    started = get_scanner().start()
+    return jsonify({"success": True, "started": started})
+
+
+@app.route("/servers")
+def get_servers():
+    # Every configured server and how its last request through the server pool went
+    return jsonify(server_pool.get_status())
+
+
 @app.route("/content/samples")
 def get_samples():
-    samples = PlexWrapper().get_content_sample_files()
+    refresh = request.args.get("refresh", "0") == "1"
+    samples = get_plex_wrapper(request_server()).get_content_sample_files(refresh)
     return jsonify(samples)
 
 
+@app.route("/content/samples/stream")
+def stream_samples():
+    refresh = request.args.get("refresh", "0") == "1"
+    samples = get_plex_wrapper(request_server()).iter_content_sample_files(refresh)
+
+    def generate():
+        try:
+            for sample in samples:
+                yield json.dumps(sample) + "\n"
+        finally:
+            samples.close()
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@app.route("/content/samples/progress")
+def get_samples_progress():
+    return jsonify(get_plex_wrapper(request_server()).get_sample_progress())
+
+
 @app.route("/server/deleted-sizes")
 def get_deleted_sizes():
-    sizes = PlexWrapper().get_deleted_sizes()
+    sizes = get_plex_wrapper(request_server()).get_deleted_sizes()
     return jsonify(sizes)
 
 
@@ -73,18 +527,47 @@ def delete_media():
     content_key = content["content_key"]
     media_id = content["media_id"]
 
-    PlexWrapper().delete_media(library_name, content_key, media_id)
+    get_plex_wrapper(request_item_server()).delete_media(library_name, content_key, media_id)
 
     return jsonify({"success": True})
 
 
+@app.route("/delete/batch", methods=["POST"])
+def delete_media_batch():
+    # Streams one NDJSON result per media as each delete completes
+    content = request.get_json()
+    items = [
+        (item["library_name"], item["content_key"], item["media_id"])
+        for item in content["items"]
+    ]
+    wrapper = get_plex_wrapper(request_item_server())
+    concurrency = content.get("concurrency")
+    if concurrency is not None:
+        try:
+            concurrency = int(concurrency)
+        except (TypeError, ValueError):
+            return jsonify({"error": f"Invalid concurrency: {concurrency!r}"}), 400
+        concurrency = max(1, min(concurrency, wrapper.delete_concurrency))
+    results = wrapper.iter_delete_media_batch(items, concurrency)
+
+    def generate():
+        try:
+            for result in results:
+                yield json.dumps(result) + "\n"
+        finally:
+            results.close()
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
 @app.route("/content/ignore", methods=["POST"])
 def add_ignored_item():
     content = request.get_json()
     content_key = content["content_key"]
 
-    db = Database()
-    db.add_ignored_item(content_key)
+    wrapper = get_plex_wrapper(request_item_server())
+    wrapper.db.add_ignored_item(content_key)
+    wrapper.dupe_index.set_ignored(content_key, True)
 
     return jsonify({"success": True})
 
@@ -94,8 +577,9 @@ def remove_ignored_item():
     content = request.get_json()
     content_key = content["content_key"]
 
-    db = Database()
-    db.remove_ignored_item(content_key)
+    wrapper = get_plex_wrapper(request_item_server())
+    wrapper.db.remove_ignored_item(content_key)
+    wrapper.dupe_index.set_ignored(content_key, False)
 
     return jsonify({"success": True})
 
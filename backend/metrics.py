@@ -0,0 +1,136 @@
+import bisect
+import math
+import os
+import threading
+
+# Set METRICS=0 to skip timing decorated functions and routes entirely
+enabled = os.environ.get("METRICS", "1") == "1"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = [*zip(labelnames, labels), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    """
+    Fixed-bucket latency histogram. Memory is bounded by the number of label
+    combinations, which are always function or route names.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        with self.lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self.series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames, labels, [("le", _format_value(bucket))])
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}"
+
+
+class Gauge(object):
+    """Gauge whose values are read from callbacks at collection time."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.functions = {}
+
+    def set_function(self, function, *labels):
+        self.functions[labels] = function
+
+    def collect(self):
+        for labels, function in sorted(self.functions.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(function())}"
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, *args, **kwargs):
+        metric = Gauge(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        # collector() returns (name, type, documentation, [(labels dict, value)])
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+        for collector in self.collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+function_latency = registry.histogram(
+    "cleanarr_function_duration_seconds", "Time spent in traced functions.", ("function",)
+)
+route_latency = registry.histogram(
+    "cleanarr_http_request_duration_seconds", "Time spent handling HTTP requests.", ("route", "method")
+)
+pool_queue_depth = registry.gauge(
+    "cleanarr_pool_queue_depth", "Tasks waiting for a worker in a thread pool.", ("pool", "server")
+)
+plex_concurrency_limit = registry.gauge(
+    "cleanarr_plex_concurrency_limit", "Current limit on concurrent requests to Plex.", ("server",)
+)
+plex_in_flight = registry.gauge(
+    "cleanarr_plex_requests_in_flight", "Requests to Plex currently in flight.", ("server",)
+)
+plex_circuit_open = registry.gauge(
+    "cleanarr_plex_circuit_open", "1 while the Plex circuit breaker is open or half-open.", ("server",)
+)
@@ -0,0 +1,33 @@
+import threading
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class AdaptivePageSizer(object):
+    """
+    Picks how many items to request from Plex per search window, based on how
+    long recent windows took. Fast responses double the size (up to max_size),
+    responses slower than the target halve it (down to min_size), so large
+    libraries settle on the biggest window Plex can answer without timing out.
+    """
+
+    def __init__(self, initial_size=50, target_seconds=5.0, min_size=10, max_size=1000):
+        self.size = initial_size
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def get_size(self):
+        with self.lock:
+            return self.size
+
+    def observe(self, size, elapsed):
+        with self.lock:
+            if elapsed > self.target_seconds:
+                self.size = max(self.min_size, min(self.size, size) // 2)
+            elif elapsed < self.target_seconds / 2 and size >= self.size:
+                self.size = min(self.max_size, self.size * 2)
+            logger.debug("Window of %s took %.2fs, next page size %s", size, elapsed, self.size)
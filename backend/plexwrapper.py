@@ -1,20 +1,35 @@
 import os
+import threading
+import time
 import urllib.parse
+from datetime import datetime
+from xml.etree import ElementTree
 from urllib3 import PoolManager
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 
 import requests
+from plexapi import utils as plexutils
+from plexapi.exceptions import BadRequest, NotFound
+from plexapi.library import MovieSection, MusicSection, PhotoSection, ShowSection
 from plexapi.media import Media, MediaPart, MediaPartStream
 from plexapi.server import PlexServer
 from plexapi.video import Movie, Video, Episode
 
-from utils import trace_time
+import metrics
+from utils import decode_cursor, encode_cursor, increment_counter, trace_time
 from database import Database
+from crossdupes import CrossLibraryIndex
+from dupeindex import DupeIndex
+from governor import GovernedAdapter, RequestGovernor
 from logger import get_logger
+from pagesizer import AdaptivePageSizer
+from records import ContentRecord, FingerprintRecord
+from servers import get_server_config
+from sharedcache import SharedCache
 
 logger = get_logger(__name__)
 
-class HostNameIgnoringAdapter(requests.adapters.HTTPAdapter):
+class HostNameIgnoringAdapter(GovernedAdapter):
     def init_poolmanager(self, connections, maxsize, block=..., **pool_kwargs):
         self.poolmanager = PoolManager(num_pools=connections,
                                        maxsize=maxsize,
@@ -22,37 +37,228 @@ class HostNameIgnoringAdapter(requests.adapters.HTTPAdapter):
                                        assert_hostname=False)
 
 class PlexWrapper(object):
-    def __init__(self):
-        self.baseurl = os.environ.get("PLEX_BASE_URL")
-        token = os.environ.get("PLEX_TOKEN")
-        self.page_size = int(os.environ.get("PAGE_SIZE", 50))
+    # Attributes read by the serializers that make plexapi reload a partial
+    # object from Plex when they are missing from the search results.
+    RELOAD_ATTRIBUTES = {
+        "movie": ("title", "thumb", "duration", "guid", "year", "media"),
+        "episode": (
+            "title", "thumb", "duration", "guid", "year", "media",
+            "index", "parentIndex", "grandparentTitle",
+        ),
+    }
+
+    def __init__(self, baseurl=None, token=None, name=None, config_dir=None):
+        self.baseurl = baseurl or os.environ.get("PLEX_BASE_URL")
+        self.token = token or os.environ.get("PLEX_TOKEN")
+        # Set when several servers are configured (PLEX_SERVERS), each keeping its state under its own config_dir
+        self.name = name
+        # PAGE_SIZE=auto sizes cursor pages from observed Plex latency
+        page_size = os.environ.get("PAGE_SIZE", "50")
+        self.adaptive_page_size = page_size == "auto"
+        self.page_size = 50 if self.adaptive_page_size else int(page_size)
+        self.page_sizer = AdaptivePageSizer(
+            initial_size=self.page_size,
+            target_seconds=float(os.environ.get("PAGE_TARGET_SECONDS", 5)),
+            max_size=int(os.environ.get("PAGE_SIZE_MAX", 1000)),
+        )
         self.libraries = [
             x.strip()
             for x in os.environ.get("LIBRARY_NAMES", "Movies").split(";")
             if x.strip() != ""
         ]
-        timeout = int(os.environ.get("PLEX_TIMEOUT",60*60))
-        
+        self.timeout = int(os.environ.get("PLEX_TIMEOUT",60*60))
+        self.pool_size = int(os.environ.get("PLEX_POOL_SIZE", 32))
+        self.healthcheck_interval = int(os.environ.get("PLEX_HEALTHCHECK_INTERVAL", 30))
+        self.bulk_fetch = os.environ.get("BULK_FETCH", "0") == "1"
+        self.bulk_fetch_batch_size = int(os.environ.get("BULK_FETCH_BATCH_SIZE", 50))
+        self._connect_lock = threading.Lock()
+        self._last_healthcheck = 0
+        # Shared by every session this wrapper builds, so its state survives reconnects
+        self.governor = RequestGovernor(max_limit=self.pool_size)
+        server_label = name or "default"
+        metrics.plex_concurrency_limit.set_function(lambda: int(self.governor.limit), server_label)
+        metrics.plex_in_flight.set_function(lambda: self.governor.in_flight, server_label)
+        metrics.plex_circuit_open.set_function(lambda: int(self.governor.state != "closed"), server_label)
+        # Library sections and server identity, refreshed every PLEX_METADATA_TTL seconds
+        self.metadata_ttl = int(os.environ.get("PLEX_METADATA_TTL", 300))
+        # Pages fetched live from Plex, before a background scan has built the dupe index
+        self.result_cache_ttl = int(os.environ.get("RESULT_CACHE_TTL", 60))
+        self._metadata = None
+        self._metadata_loaded_at = 0
+        self._metadata_lock = threading.Lock()
+        # One bounded pool shared by every request: Plex searches and the
+        # reloads needed to serialize partial objects are the only work run on it.
+        serializer_workers = int(os.environ.get("SERIALIZER_WORKERS", 8))
+        self.executor = ThreadPoolExecutor(max_workers=serializer_workers, thread_name_prefix="plexwrapper")
+        self.delete_concurrency = int(os.environ.get("DELETE_CONCURRENCY", 4))
+        self.sample_max_duration = int(os.environ.get("SAMPLE_MAX_DURATION", 5 * 60))
+        self.sample_cache_ttl = int(os.environ.get("SAMPLE_CACHE_TTL", 60 * 60))
+        self.sample_cache = {}
+        # Scan id -> progress of each library in that sample scan
+        self.sample_progress = {}
+        self._sample_scans = 0
+        self._sample_progress_lock = threading.Lock()
+        metrics.pool_queue_depth.set_function(self.executor._work_queue.qsize, "plexwrapper", server_label)
+        self.stream_max_in_flight = int(os.environ.get("STREAM_MAX_IN_FLIGHT", serializer_workers * 2))
+
         logger.debug("PlexWrapper Init")
         logger.debug("PLEX_BASE_URL %s", self.baseurl)
         logger.debug("LIBRARY_NAMES %s", self.libraries)
 
+        self.connect()
+
+        logger.debug("Initializing DB...")
+        self.db = Database(config_dir)
+        logger.debug("Initialized DB!")
+
+        self.dupe_index = DupeIndex(config_dir=config_dir)
+        self.cross_library_index = CrossLibraryIndex(config_dir=config_dir)
+        # Shared with the other uWSGI workers, unlike everything else cached here
+        self.shared_cache = SharedCache()
+
+        self.traces = {}
+
+    def _build_session(self):
+        # A single keep-alive session is shared by every thread using this
+        # wrapper, so size the connection pool to the expected concurrency
+        # rather than the requests default of 10.
         session = requests.Session()
+        adapter = GovernedAdapter(
+            self.governor, pool_connections=self.pool_size, pool_maxsize=self.pool_size
+        )
+        session.mount("http://", adapter)
         if os.environ.get("BYPASS_SSL_VERIFY", "0") == "1":
-            session.mount("https://", HostNameIgnoringAdapter())
+            adapter = HostNameIgnoringAdapter(
+                self.governor, pool_connections=self.pool_size, pool_maxsize=self.pool_size
+            )
+        session.mount("https://", adapter)
+        session.hooks["response"].append(self._count_request)
+        return session
+
+    @staticmethod
+    def _count_request(response, *args, **kwargs):
+        increment_counter("plex_http_requests")
+        # Content-Length rather than len(content), which would consume streamed bodies
+        increment_counter("plex_http_response_bytes", int(response.headers.get("Content-Length", 0)))
+
+    def connect(self):
+        session = self._build_session()
         logger.debug("Connecting to Plex...")
-        self.plex = PlexServer(self.baseurl, token, session=session, timeout=timeout)
+        self.plex = PlexServer(self.baseurl, self.token, session=session, timeout=self.timeout)
+        self._last_healthcheck = time.monotonic()
         logger.debug("Connected to Plex!")
 
-        logger.debug("Initializing DB...")
-        self.db = Database()
-        logger.debug("Initialized DB!")
+    def reconnect(self):
+        logger.debug("Reconnecting to Plex...")
+        old_session = self.plex._session
+        self.connect()
+        self.invalidate_metadata()
+        old_session.close()
 
-        self.traces = {}
+    def is_healthy(self):
+        try:
+            self.plex.query("/identity")
+            return True
+        except Exception as e:
+            logger.error(f"Plex health check failed: {e}")
+            return False
+
+    def mark_unhealthy(self):
+        # Force a health check on the next call to ensure_connected()
+        self._last_healthcheck = 0
+
+    def ensure_connected(self):
+        if time.monotonic() - self._last_healthcheck < self.healthcheck_interval:
+            return
+        with self._connect_lock:
+            # Another thread may have completed the check while we waited
+            if time.monotonic() - self._last_healthcheck < self.healthcheck_interval:
+                return
+            if self.is_healthy():
+                self._last_healthcheck = time.monotonic()
+            else:
+                self.reconnect()
+
+    def invalidate_metadata(self):
+        # The next call to _get_metadata() reloads it from Plex
+        self._metadata_loaded_at = 0
+        self.shared_cache.delete_prefix(f"plex:{self.baseurl}")
+
+    def _query_shared(self, key):
+        # Fetched by one worker and shared with the others for PLEX_METADATA_TTL seconds
+        data = self.shared_cache.get_or_compute(
+            f"plex:{self.baseurl}{key}",
+            self.metadata_ttl,
+            lambda: ElementTree.tostring(self.plex.query(key), encoding="unicode"),
+        )
+        return ElementTree.fromstring(data)
+
+    def _load_sections(self):
+        # Same as plex.library.sections(), from the shared listing
+        key = "/library/sections"
+        sections = []
+        for elem in self._query_shared(key):
+            for cls in (MovieSection, ShowSection, MusicSection, PhotoSection):
+                if elem.attrib.get("type") == cls.TYPE:
+                    sections.append(cls(self.plex, elem, key))
+        return sections
+
+    def _get_metadata(self):
+        metadata = self._metadata
+        if metadata is not None and time.monotonic() - self._metadata_loaded_at < self.metadata_ttl:
+            return metadata
+        with self._metadata_lock:
+            # Another thread may have reloaded it while we waited
+            if self._metadata is not None and time.monotonic() - self._metadata_loaded_at < self.metadata_ttl:
+                return self._metadata
+            self._metadata = self._load_metadata(refresh=self._metadata is not None)
+            self._metadata_loaded_at = time.monotonic()
+            return self._metadata
 
     @trace_time
+    def _load_metadata(self, refresh=False):
+        # A single listing for every configured library. The server identity
+        # is read on connect, so it only costs a request when refreshing.
+        if refresh:
+            data = self._query_shared("/")
+            friendly_name = data.attrib.get("friendlyName")
+            machine_identifier = data.attrib.get("machineIdentifier")
+        else:
+            friendly_name = self.plex.friendlyName
+            machine_identifier = self.plex.machineIdentifier
+        sections_by_title = {section.title.lower().strip(): section for section in self._load_sections()}
+        if refresh:
+            # Keep unchanged sections, along with the filter definitions they
+            # have already loaded for searches
+            for section in self._metadata["sections"]:
+                current = sections_by_title.get(section.title.lower().strip())
+                if current is not None and section._server is self.plex and (current.key, current.type) == (section.key, section.type):
+                    sections_by_title[section.title.lower().strip()] = section
+        sections = []
+        missing = []
+        for library in self.libraries:
+            section = sections_by_title.get(library.lower().strip())
+            if section is None:
+                missing.append(library)
+            else:
+                sections.append(section)
+        return {
+            "sections": sections,
+            # Only raised when sections are needed, so /server/info still works
+            "missing": missing,
+            "friendlyName": friendly_name,
+            "machineIdentifier": machine_identifier,
+            "detailsUrl": self.baseurl + '/web/index.html#!/server/' + machine_identifier + '/details?key=',
+        }
+
     def _get_sections(self):
-        return [self.plex.library.section(title=library) for library in self.libraries]
+        metadata = self._get_metadata()
+        if metadata["missing"]:
+            raise NotFound(f"Invalid library section: {metadata['missing'][0]}")
+        return list(metadata["sections"])
+
+    def get_details_url(self, content_key):
+        return self._get_metadata()["detailsUrl"] + urllib.parse.quote_plus(content_key)
 
     @trace_time
     def get_deleted_sizes(self):
@@ -64,91 +270,479 @@ class PlexWrapper(object):
     @trace_time
     def get_server_info(self):
         return {
-            'name': self.plex.friendlyName,
+            'name': self._get_metadata()["friendlyName"],
             'url': self.baseurl + '/web/index.html'
         }
 
     @trace_time
     def get_dupe_content(self, page=1):
+        return self.shared_cache.get_or_compute(
+            f"dupes:{self.baseurl}:page:{page}:{self.page_size}",
+            self.result_cache_ttl,
+            lambda: list(self.iter_dupe_content(page)),
+        )
+
+    def invalidate_dupe_content(self):
+        # Called after deletes and refreshes, which change what a page holds
+        self.shared_cache.delete_prefix(f"dupes:{self.baseurl}:")
+
+    def iter_dupe_content(self, page=1):
+        """
+        Yield serialized dupes for one page of every library as soon as each
+        one is ready. At most stream_max_in_flight reloads are queued at once,
+        and closing the generator (e.g. when a client disconnects) cancels
+        any work that has not started yet.
+        """
         logger.debug("START")
-        dupes = []
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            logger.debug(f"GET DUPES FOR: {[(x.title, x.type) for x in self._get_sections()]}")
-            for section in self._get_sections():
-                future = executor.submit(self.get_dupe_content_for_section, page, section)
-                futures.append(future)
+        sections = self._get_sections()
+        logger.debug(f"GET DUPES FOR: {[(x.title, x.type) for x in sections]}")
+        # Only the Plex searches and reloads run on the shared pool; the
+        # serialization is driven from this thread so pool workers never
+        # wait on each other.
+        section_futures = {}
+        pending = set()
+        try:
+            for section in sections:
+                if section.type not in ("movie", "show"):
+                    continue
+                if self.bulk_fetch:
+                    offset = (page - 1) * self.page_size
+                    future = self.executor.submit(self.bulk_dupe_content_for_section, section, offset, self.page_size)
+                else:
+                    future = self.executor.submit(self._search_dupes_for_section, page, section)
+                section_futures[future] = section
 
-            for future in as_completed(futures):
-                results = future.result()
-                if results:
-                    dupes = dupes + results
+            for future in as_completed(section_futures):
+                if self.bulk_fetch:
+                    results, _ = future.result()
+                    yield from results
+                    continue
+                section = section_futures[future]
+                duplicate, _ = self._get_dupe_search_args(section)
+                to_dict_func = self._get_to_dict_func(section)
+                for item in future.result():
+                    if duplicate and len(item.media) < 2:
+                        continue
+                    if not self._needs_reload(item):
+                        yield to_dict_func(item, section.title)
+                        continue
+                    while len(pending) >= self.stream_max_in_flight:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for done_future in done:
+                            yield done_future.result()
+                    pending.add(self.executor.submit(self._reload_and_serialize, to_dict_func, item, section.title))
 
-        return dupes
+            for future in as_completed(pending):
+                yield future.result()
+        finally:
+            for future in [*section_futures, *pending]:
+                future.cancel()
 
-    @trace_time
-    def get_dupe_content_for_section(self, page, section):
-        if section.type not in ("movie", "show"):
-            return {}
-        dupes = []
+    def _get_dupe_search_args(self, section):
         duplicate=True
         # undocumented environment variable purely for development purposes.
         # instead of looking for duplicates, this will look for non-duplicates
         # which can be useful when wanting to test the UI against a larger dataset
         if os.getenv("CHAOS_NOT_DUPLICATE", "0") == "1":
             duplicate=False
-        to_dict_func = self.movie_to_dict
-        if section.type == "episode":
-            to_dict_func = self.episode_to_dict
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            logger.debug("SECTION: %s/%s", section.title, section.type)
-            offset = (page - 1) * self.page_size
-            limit = offset + self.page_size
-            logger.debug(
-                "Get results for %s/%s from offset %s to limit %s",
-                section.title,
-                section.type,
-                offset,
-                limit,
-            )
-            libtype = section.type
-            if libtype == "show":
-                libtype = "episode"
-            results = section.search(duplicate=duplicate, libtype=libtype, container_start=offset, limit=limit)
-            for item in results:
-                if not duplicate or len(item.media) > 1:
-                    future = executor.submit(to_dict_func, item, section.title)
-                    futures.append(future)
+        libtype = section.type
+        if libtype == "show":
+            libtype = "episode"
+        return duplicate, libtype
+
+    def _needs_reload(self, item):
+        # plexapi reloads a partial object the first time one of its
+        # attributes is read as None or [], so check the raw values instead
+        # of reading them through the object.
+        if item.isFullObject() or item._autoReload is False:
+            return False
+        attrs = self.RELOAD_ATTRIBUTES.get(item.TYPE, ())
+        return any(item.__dict__.get(attr) in (None, []) for attr in attrs)
 
-            for future in as_completed(futures):
-                dupes.append(future.result())
+    def _reload_and_serialize(self, to_dict_func, item, library):
+        item.reload()
+        return to_dict_func(item, library)
 
-        return dupes
+    def _get_to_dict_func(self, section):
+        if section.type == "show":
+            return self.episode_to_dict
+        return self.movie_to_dict
+
+    def _serialize_dupes(self, section, items, duplicate=True):
+        to_dict_func = self._get_to_dict_func(section)
+        results = []
+        for item in items:
+            if duplicate and len(item.media) < 2:
+                continue
+            if self._needs_reload(item):
+                results.append(self.executor.submit(self._reload_and_serialize, to_dict_func, item, section.title))
+            else:
+                results.append(to_dict_func(item, section.title))
+        return [result.result() if isinstance(result, Future) else result for result in results]
+
+    def _search_dupes_for_section(self, page, section):
+        duplicate, libtype = self._get_dupe_search_args(section)
+        logger.debug("SECTION: %s/%s", section.title, section.type)
+        offset = (page - 1) * self.page_size
+        return self._search_dupe_window(section, offset, self.page_size)
+
+    def _search_dupe_window(self, section, offset, size):
+        duplicate, libtype = self._get_dupe_search_args(section)
+        logger.debug(
+            "Get results for %s/%s from offset %s, size %s",
+            section.title,
+            section.type,
+            offset,
+            size,
+        )
+        return section.search(
+            duplicate=duplicate, libtype=libtype, container_start=offset, container_size=size, maxresults=size
+        )
 
-    # TODO: refactor and multithread
     @trace_time
-    def get_content_sample_files(self):
-        content = []
+    def get_dupe_content_for_section(self, page, section):
+        if section.type not in ("movie", "show"):
+            return {}
+        if self.bulk_fetch:
+            return self.bulk_dupe_content_for_section(section, (page - 1) * self.page_size, self.page_size)[0]
+        duplicate, libtype = self._get_dupe_search_args(section)
+        return self._serialize_dupes(section, self._search_dupes_for_section(page, section), duplicate)
 
+    @trace_time
+    def count_dupe_content_for_section(self, section):
+        duplicate, libtype = self._get_dupe_search_args(section)
+        key = section._buildSearchKey(duplicate=duplicate, libtype=libtype)
+        data = self.plex.query(key, headers={"X-Plex-Container-Start": "0", "X-Plex-Container-Size": "0"})
+        return int(data.attrib.get("totalSize", 0))
+
+    @trace_time
+    def scan_dupe_content_for_section(self, section, offset, size):
+        """
+        Fetch and serialize exactly one window of search results for the
+        background scanner. Returns the serialized dupes along with the number
+        of raw search results, so the caller knows when it has reached the end.
+        """
+        if self.bulk_fetch:
+            return self.bulk_dupe_content_for_section(section, offset, size)
+        duplicate, libtype = self._get_dupe_search_args(section)
+        results = self._search_dupe_window(section, offset, size)
+        return self._serialize_dupes(section, results, duplicate), len(results)
+
+    def _fetch_dupe_window(self, section, offset, size):
+        # Runs on the shared pool, so it must not wait on other pool tasks:
+        # non-bulk results are serialized by the caller.
+        start_time = time.perf_counter()
+        if self.bulk_fetch:
+            results, fetched = self.bulk_dupe_content_for_section(section, offset, size)
+        else:
+            results = self._search_dupe_window(section, offset, size)
+            fetched = len(results)
+        self.page_sizer.observe(size, time.perf_counter() - start_time)
+        return results, fetched
+
+    @trace_time
+    def get_dupe_content_page(self, cursor=None):
+        """
+        Cursor-based alternative to get_dupe_content. The cursor carries the
+        next offset and the total number of dupes for every library, so each
+        call fetches one window per library that still has results, and no
+        more. Returns the dupes along with the cursor for the next call.
+        """
+        return self.shared_cache.get_or_compute(
+            f"dupes:{self.baseurl}:cursor:{cursor or ''}:{self.page_size}",
+            self.result_cache_ttl,
+            lambda: self._get_dupe_content_page(cursor),
+        )
+
+    def _get_dupe_content_page(self, cursor):
+        state = decode_cursor(cursor)
+        offsets = state.get("offsets", {})
+        totals = state.get("totals", {})
+        size = self.page_sizer.get_size() if self.adaptive_page_size else self.page_size
+
+        futures = {}
         for section in self._get_sections():
-            for mediaContent in section.all():
-                samples = []
-                if mediaContent.TYPE != 'movie' or mediaContent.TYPE != 'episode':
-                    continue
-                for media in mediaContent.media:
-                    if media.duration is None or media.duration < (5 * 60 * 1000):
-                        samples.append(self.media_to_dict(media))
-                if len(samples) > 0:
-                    _media = dict()
-                    if mediaContent.TYPE == 'movie':
-                        _media = self.movie_to_dict(mediaContent, section.title)
-                    elif mediaContent.TYPE == 'episode':
-                        _media = self.episode_to_dict(mediaContent, section.title)
-                    _media["media"] = samples
-                    content.append(_media)
+            if section.type not in ("movie", "show"):
+                continue
+            if section.title not in totals:
+                totals[section.title] = self.count_dupe_content_for_section(section)
+                offsets[section.title] = 0
+            offset = offsets[section.title]
+            if offset is None:
+                continue
+            futures[self.executor.submit(self._fetch_dupe_window, section, offset, size)] = section
+
+        dupes = []
+        for future in as_completed(futures):
+            section = futures[future]
+            results, fetched = future.result()
+            if self.bulk_fetch:
+                dupes.extend(results)
+            else:
+                duplicate, _ = self._get_dupe_search_args(section)
+                dupes.extend(self._serialize_dupes(section, results, duplicate))
+            offset = offsets[section.title] + fetched
+            offsets[section.title] = offset if fetched == size and offset < totals[section.title] else None
+
+        has_more = any(offset is not None for offset in offsets.values())
+        return {
+            "items": dupes,
+            "cursor": encode_cursor({"offsets": offsets, "totals": totals}) if has_more else None,
+            "hasMore": has_more,
+            "totals": totals,
+        }
+
+    @trace_time
+    def bulk_dupe_content_for_section(self, section, offset, size):
+        """
+        Zero-reload fast path (BULK_FETCH=1). Instead of building plexapi objects
+        that lazily reload themselves one by one, fetch one window of search
+        results, then the full metadata of every duplicate in batches of
+        comma-joined ratingKeys, and serialize straight from the XML.
+        Returns the same (dupes, fetched) pair as scan_dupe_content_for_section.
+        """
+        duplicate, libtype = self._get_dupe_search_args(section)
+        key = section._buildSearchKey(duplicate=duplicate, libtype=libtype)
+        key += "&checkFiles=1&includeGuids=1"
+        headers = {"X-Plex-Container-Start": str(offset), "X-Plex-Container-Size": str(size)}
+        data = self.plex.query(key, headers=headers)
+        videos = data.findall("Video")
+        rating_keys = [
+            video.attrib["ratingKey"]
+            for video in videos
+            if not duplicate or len(video.findall("Media")) > 1
+        ]
+
+        dupes = []
+        for start in range(0, len(rating_keys), self.bulk_fetch_batch_size):
+            batch = rating_keys[start:start + self.bulk_fetch_batch_size]
+            metadata = self.plex.query(f"/library/metadata/{','.join(batch)}?checkFiles=1&includeGuids=1")
+            for video in metadata.findall("Video"):
+                dupes.append(self.video_element_to_dict(video, section.title))
+        return dupes, len(videos)
+
+    def _library_search_key(self, section, updated_after=None):
+        _, libtype = self._get_dupe_search_args(section)
+        filters = None
+        if updated_after is not None:
+            filters = {"updatedAt>>": datetime.fromtimestamp(updated_after)}
+        return section._buildSearchKey(libtype=libtype, filters=filters)
+
+    @trace_time
+    def count_library_items(self, section, updated_after=None):
+        key = self._library_search_key(section, updated_after)
+        data = self.plex.query(key, headers={"X-Plex-Container-Start": "0", "X-Plex-Container-Size": "0"})
+        return int(data.attrib.get("totalSize", 0))
+
+    @trace_time
+    def scan_library_fingerprints(self, section, offset, size, updated_after=None):
+        """
+        Fetch one window of every item in a library (or only those updated
+        after the given timestamp) as FingerprintRecords, straight from the
+        search XML.
+        """
+        key = self._library_search_key(section, updated_after)
+        headers = {"X-Plex-Container-Start": str(offset), "X-Plex-Container-Size": str(size)}
+        data = self.plex.query(key, headers=headers)
+        return [self.video_element_to_fingerprint(video, section.title) for video in data.findall("Video")]
+
+    @staticmethod
+    def video_element_to_fingerprint(video, library: str) -> FingerprintRecord:
+        attrib = video.attrib
+        files = []
+        for media in video.findall("Media"):
+            size = sum(plexutils.cast(int, part.attrib.get("size")) or 0 for part in media.findall("Part"))
+            files.append([size, plexutils.cast(int, media.attrib.get("duration"))])
+        return FingerprintRecord.from_dict({
+            "library": library,
+            "key": attrib.get("key"),
+            "title": attrib.get("title"),
+            "type": attrib.get("type"),
+            "year": plexutils.cast(int, attrib.get("year")),
+            "guid": attrib.get("guid"),
+            "updatedAt": plexutils.cast(int, attrib.get("updatedAt")),
+            "files": files,
+        })
+
+    def _get_sample_search_args(self, section):
+        libtype = "episode" if section.type == "show" else "movie"
+        # Let Plex drop everything longer than the threshold. This drops media
+        # with no duration too, which are only reported when the filter isn't
+        # supported and the whole library is searched instead.
+        filters = {"duration<<": self.sample_max_duration * 1000}
+        return libtype, filters
+
+    def _count_samples_for_section(self, section):
+        libtype, filters = self._get_sample_search_args(section)
+        try:
+            key = section._buildSearchKey(libtype=libtype, filters=filters)
+        except BadRequest as e:
+            logger.error(f"Duration filter not supported for {section.title}, scanning everything: {e}")
+            return section.totalViewSize(libtype=libtype, includeCollections=False)
+        data = self.plex.query(key, headers={"X-Plex-Container-Start": "0", "X-Plex-Container-Size": "0"})
+        return int(data.attrib.get("totalSize", 0))
+
+    def _search_sample_window(self, section, offset, size):
+        libtype, filters = self._get_sample_search_args(section)
+        try:
+            return section.search(
+                libtype=libtype, filters=filters, container_start=offset, container_size=size, maxresults=size
+            )
+        except BadRequest:
+            return section.search(libtype=libtype, container_start=offset, container_size=size, maxresults=size)
+
+    def _serialize_samples(self, section, items):
+        to_dict_func = self._get_to_dict_func(section)
+        threshold = self.sample_max_duration * 1000
+        content = []
+        for item in items:
+            samples = [
+                self.media_to_dict(media)
+                for media in item.media
+                if media.duration is None or media.duration < threshold
+            ]
+            if len(samples) > 0:
+                _media = to_dict_func(item, section.title)
+                _media["media"] = samples
+                content.append(_media)
         return content
 
+    @trace_time
+    def refresh_content(self, rating_keys, update_index=True):
+        """
+        Re-serialize the given items into the cached duplicate and sample
+        results, e.g. after Plex reported them as changed, without searching
+        any library. Items that are no longer duplicates or samples, or that
+        Plex no longer has, are dropped from both. Returns the number of
+        items Plex still has.
+        """
+        sections = {
+            str(section.key): section for section in self._get_sections() if section.type in ("movie", "show")
+        }
+        videos = []
+        for start in range(0, len(rating_keys), self.bulk_fetch_batch_size):
+            batch = rating_keys[start:start + self.bulk_fetch_batch_size]
+            try:
+                metadata = self.plex.query(f"/library/metadata/{','.join(batch)}?checkFiles=1&includeGuids=1")
+            except NotFound:
+                # None of the batch exists any more
+                continue
+            videos.extend(metadata.findall("Video"))
+
+        threshold = self.sample_max_duration * 1000
+        dupes = []
+        samples = []
+        refreshed_keys = {f"/library/metadata/{rating_key}" for rating_key in rating_keys}
+        found = set()
+        for video in videos:
+            section = sections.get(video.attrib.get("librarySectionID"))
+            if section is None:
+                continue
+            content = self.video_element_to_dict(video, section.title)
+            found.add(content["key"])
+            duplicate, _ = self._get_dupe_search_args(section)
+            if not duplicate or len(content["media"]) > 1:
+                dupes.append(content)
+            sample_media = [
+                media for media in content["media"] if media["duration"] is None or media["duration"] < threshold
+            ]
+            if sample_media:
+                samples.append(ContentRecord.from_dict({**content, "media": sample_media}))
+
+        if update_index:
+            # Anything refreshed but not re-added is no longer a duplicate
+            dupe_keys = {dupe["key"] for dupe in dupes}
+            removed = [
+                (section.title, key)
+                for section in sections.values()
+                for key in refreshed_keys - dupe_keys
+            ]
+            self.dupe_index.update_items(dupes, removed)
+            self.invalidate_dupe_content()
+        for library, (cached_at, cached) in list(self.sample_cache.items()):
+            kept = [record for record in cached if record.key not in refreshed_keys]
+            kept.extend(record for record in samples if record.library == library)
+            self.sample_cache[library] = (cached_at, kept)
+        return len(found)
+
+    @trace_time
+    def get_content_sample_files(self, refresh=False):
+        return list(self.iter_content_sample_files(refresh))
+
+    def iter_content_sample_files(self, refresh=False):
+        """
+        Yield content with media shorter than SAMPLE_MAX_DURATION seconds.
+        Every library is counted, then all of its pages are searched
+        concurrently on the shared pool, with results yielded as each page
+        completes. Finished libraries are cached for SAMPLE_CACHE_TTL seconds;
+        per-library progress is kept under the scan's own id in
+        self.sample_progress, so concurrent scans don't overwrite each other.
+        """
+        pending = {}
+        results = {}
+        windows_left = {}
+        with self._sample_progress_lock:
+            # Finished scans are dropped once another one starts
+            self.sample_progress = {
+                scan_id: scan for scan_id, scan in self.sample_progress.items() if scan["state"] == "running"
+            }
+            self._sample_scans += 1
+            scan = {"state": "running", "libraries": {}}
+            self.sample_progress[str(self._sample_scans)] = scan
+        try:
+            for section in self._get_sections():
+                if section.type not in ("movie", "show"):
+                    continue
+                cached = self.sample_cache.get(section.title)
+                if cached is not None and not refresh and time.time() - cached[0] < self.sample_cache_ttl:
+                    increment_counter("sample_cache_hits")
+                    for record in cached[1]:
+                        yield record.to_dict()
+                    continue
+                increment_counter("sample_cache_misses")
+                scan["libraries"][section.title] = {"state": "counting", "scanned": 0, "total": None}
+                pending[self.executor.submit(self._count_samples_for_section, section)] = section
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    section = pending.pop(future)
+                    progress = scan["libraries"][section.title]
+                    if progress["state"] == "counting":
+                        progress["total"] = future.result()
+                        progress["state"] = "scanning"
+                        results[section.title] = []
+                        offsets = range(0, progress["total"], self.page_size)
+                        windows_left[section.title] = len(offsets)
+                        for offset in offsets:
+                            window = self.executor.submit(self._search_sample_window, section, offset, self.page_size)
+                            pending[window] = section
+                    else:
+                        items = future.result()
+                        progress["scanned"] += len(items)
+                        windows_left[section.title] -= 1
+                        for sample in self._serialize_samples(section, items):
+                            results[section.title].append(ContentRecord.from_dict(sample))
+                            yield sample
+                    if windows_left[section.title] == 0:
+                        progress["state"] = "done"
+                        self.sample_cache[section.title] = (time.time(), results[section.title])
+            scan["state"] = "done"
+        finally:
+            if scan["state"] == "running":
+                scan["state"] = "cancelled"
+            for future in pending:
+                future.cancel()
+
+    def get_sample_progress(self):
+        with self._sample_progress_lock:
+            return {
+                scan_id: {"state": scan["state"], "libraries": {
+                    library: dict(progress) for library, progress in scan["libraries"].items()
+                }}
+                for scan_id, scan in self.sample_progress.items()
+            }
+
     @trace_time
     def get_content(self, media_id):
         return self.plex.fetchItem(media_id)
@@ -156,7 +750,7 @@ class PlexWrapper(object):
     @trace_time
     def delete_media(self, library_name, content_key, media_id):
         content = self.get_content(content_key)
-        deleted_size = self.db.get_deleted_size(library_name)
+        deleted_size = 0
 
         for media in content.media:
             if media.id == media_id:
@@ -164,14 +758,102 @@ class PlexWrapper(object):
                     deleted_size += part.size
                 media.delete()
 
-        self.db.set_deleted_size(library_name, deleted_size)
+        self.db.add_deleted_size(library_name, deleted_size)
+        self.dupe_index.remove_media(library_name, content_key, media_id)
+        self.invalidate_dupe_content()
+
+    def _delete_media_group(self, library_name, content_key, media_ids):
+        # Fetches the content once for every media being deleted from it
+        results = []
+        try:
+            content = self.get_content(content_key)
+        except Exception as e:
+            logger.error(f"Error fetching {content_key}: {e}")
+            return [
+                {"library_name": library_name, "content_key": content_key, "media_id": media_id,
+                 "success": False, "error": str(e)}
+                for media_id in media_ids
+            ]
+        media_by_id = {media.id: media for media in content.media}
+        for media_id in media_ids:
+            result = {"library_name": library_name, "content_key": content_key, "media_id": media_id}
+            media = media_by_id.get(media_id)
+            if media is None:
+                result.update(success=False, error="Media not found")
+                results.append(result)
+                continue
+            try:
+                deleted_size = sum(part.size or 0 for part in media.parts)
+                media.delete()
+                result.update(success=True, size=deleted_size)
+            except Exception as e:
+                logger.error(f"Error deleting media {media_id} of {content_key}: {e}")
+                result.update(success=False, error=str(e))
+            results.append(result)
+        return results
+
+    def iter_delete_media_batch(self, items, concurrency=None):
+        """
+        Delete many (library_name, content_key, media_id) tuples, yielding one
+        result dict per media as soon as it is done. Media are grouped by
+        content key so each item is fetched from Plex once, and at most
+        `concurrency` items are deleted at a time. Deleted sizes and the dupe
+        index are updated once at the end. If the caller stops early, groups
+        not started yet are skipped, but those already running are waited for
+        so every media Plex deleted is still accounted for.
+        """
+        concurrency = max(1, min(concurrency or self.delete_concurrency, self.delete_concurrency))
+        groups = {}
+        for library_name, content_key, media_id in items:
+            groups.setdefault((library_name, content_key), []).append(media_id)
+
+        deleted_sizes = {}
+        deleted = []
+        submitted = []
+        recorded = set()
+        pending = set()
+        try:
+            for (library_name, content_key), media_ids in groups.items():
+                while len(pending) >= concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from self._record_deletes(done, recorded, deleted_sizes, deleted)
+                future = self.executor.submit(self._delete_media_group, library_name, content_key, media_ids)
+                submitted.append(future)
+                pending.add(future)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from self._record_deletes(done, recorded, deleted_sizes, deleted)
+        finally:
+            for future in pending:
+                future.cancel()
+            wait(submitted)
+            unrecorded = [future for future in submitted if future not in recorded and not future.cancelled()]
+            self._record_deletes(unrecorded, recorded, deleted_sizes, deleted)
+            for library_name, deleted_size in deleted_sizes.items():
+                self.db.add_deleted_size(library_name, deleted_size)
+            self.dupe_index.remove_media_batch(deleted)
+            if deleted:
+                self.invalidate_dupe_content()
+
+    @staticmethod
+    def _record_deletes(futures, recorded, deleted_sizes, deleted):
+        # Accounts for every result of the finished groups before any is handed out
+        results = []
+        for future in futures:
+            recorded.add(future)
+            for result in future.result():
+                if result["success"]:
+                    library_name = result["library_name"]
+                    deleted_sizes[library_name] = deleted_sizes.get(library_name, 0) + result["size"]
+                    deleted.append((library_name, result["content_key"], result["media_id"]))
+                results.append(result)
+        return results
 
     @trace_time
     def video_to_dict(self, video: Video) -> dict:
         # https://python-plexapi.readthedocs.io/en/latest/modules/video.html#plexapi.video.Video
-        ignored = self.db.get_ignored_item(video.key)
         results = {
-            "ignored": ignored is not None,
+            "ignored": self.db.is_ignored(video.key),
         }
         attributes_to_fetch = {
             # "addedAt": lambda: str(video.addedAt),
@@ -179,19 +861,16 @@ class PlexWrapper(object):
             # "lastViewedAt": lambda: str(video.lastViewedAt),
             "librarySectionID": lambda: video.librarySectionID,
             # "summary": lambda: video.summary,
-            "thumbUrl": lambda: video.thumbUrl,
+            # The path only, see get_thumb_url
+            "thumbUrl": lambda: video.firstAttr("thumb", "parentThumb", "grandparentThumb"),
             "title": lambda: video.title,
             # "titleSort": lambda: video.titleSort,
             "type": lambda: video.type,
             # "updatedAt": lambda: str(video.updatedAt),
             # "viewCount": lambda: str(video.viewCount),
-            "url": lambda: self.baseurl + '/web/index.html#!/server/' + self.plex.machineIdentifier + '/details?key=' + urllib.parse.quote_plus(video.key)
+            "url": lambda: self.get_details_url(video.key)
         }
-        with ThreadPoolExecutor(max_workers=len(attributes_to_fetch)) as executor:
-            future_to_attr = {executor.submit(self.fetch_attribute, func): attr for attr, func in attributes_to_fetch.items()}
-            for future in as_completed(future_to_attr):
-                attr = future_to_attr[future]
-                results[attr] = future.result()
+        self.fetch_attributes(attributes_to_fetch, results)
         return results
 
 
@@ -202,6 +881,14 @@ class PlexWrapper(object):
         except Exception as e:
             logger.error(f"Error fetching attribute: {e}")
 
+    @classmethod
+    def fetch_attributes(cls, attributes_to_fetch, results):
+        # Plain attribute reads, done inline: anything that needs a round trip
+        # to Plex has already been loaded by _serialize_dupes.
+        for attr, func in attributes_to_fetch.items():
+            results[attr] = cls.fetch_attribute(func)
+        return results
+
     @trace_time
     def movie_to_dict(self, movie: Movie, library: str) -> dict:
         # https://python-plexapi.readthedocs.io/en/latest/modules/video.html#plexapi.video.Movie
@@ -224,11 +911,7 @@ class PlexWrapper(object):
             "contentType": 'movie',
             "library": library,
         }
-        with ThreadPoolExecutor(max_workers=len(attributes_to_fetch)) as executor:
-            future_to_attr = {executor.submit(self.fetch_attribute, func): attr for attr, func in attributes_to_fetch.items()}
-            for future in as_completed(future_to_attr):
-                attr = future_to_attr[future]
-                results[attr] = future.result()
+        self.fetch_attributes(attributes_to_fetch, results)
 
         return results
 
@@ -252,21 +935,118 @@ class PlexWrapper(object):
             "seriesTitle": lambda: episode.grandparentTitle,
             "media": lambda: [self.media_to_dict(media) for media in episode.media],
         }
-        with ThreadPoolExecutor(max_workers=len(attributes_to_fetch)) as executor:
-            future_to_attr = {executor.submit(self.fetch_attribute, func): attr for attr, func in attributes_to_fetch.items()}
-            for future in as_completed(future_to_attr):
-                attr = future_to_attr[future]
-                results[attr] = future.result()
+        self.fetch_attributes(attributes_to_fetch, results)
+
+        return results
 
+    def video_element_to_dict(self, video, library: str) -> dict:
+        # Same shape as movie_to_dict/episode_to_dict, built from raw metadata XML
+        attrib = video.attrib
+        content_type = attrib.get("type")
+        thumb = attrib.get("thumb") or attrib.get("parentThumb") or attrib.get("grandparentThumb")
+        results = {
+            "ignored": self.db.is_ignored(attrib.get("key")),
+            "key": attrib.get("key"),
+            "librarySectionID": plexutils.cast(int, attrib.get("librarySectionID")),
+            "thumbUrl": thumb,
+            "title": attrib.get("title"),
+            "type": content_type,
+            "url": self.get_details_url(attrib.get("key")),
+            "contentType": content_type,
+            "library": library,
+            "duration": plexutils.cast(int, attrib.get("duration")),
+            "guid": attrib.get("guid"),
+            "originalTitle": attrib.get("title"),
+            "year": plexutils.cast(int, attrib.get("year")),
+            "media": [self.media_element_to_dict(media) for media in video.findall("Media")],
+        }
+        if content_type == "episode":
+            season_number = plexutils.cast(int, attrib.get("parentIndex"))
+            episode_number = plexutils.cast(int, attrib.get("index"))
+            results["seasonNumber"] = season_number
+            results["seasonEpisode"] = f"s{str(season_number).zfill(2)}e{str(episode_number).zfill(2)}"
+            results["seriesTitle"] = attrib.get("grandparentTitle")
         return results
 
+    @classmethod
+    def media_element_to_dict(cls, media) -> dict:
+        attrib = media.attrib
+        return {
+            "id": plexutils.cast(int, attrib.get("id")),
+            "aspectRatio": plexutils.cast(float, attrib.get("aspectRatio")),
+            "audioChannels": plexutils.cast(int, attrib.get("audioChannels")),
+            "audioCodec": attrib.get("audioCodec"),
+            "bitrate": plexutils.cast(int, attrib.get("bitrate")),
+            "container": attrib.get("container"),
+            "duration": plexutils.cast(int, attrib.get("duration")),
+            "width": plexutils.cast(int, attrib.get("width")),
+            "height": plexutils.cast(int, attrib.get("height")),
+            "has64bitOffsets": plexutils.cast(bool, attrib.get("has64bitOffsets")),
+            "optimizedForStreaming": plexutils.cast(bool, attrib.get("optimizedForStreaming")),
+            "target": attrib.get("target"),
+            "title": attrib.get("title"),
+            "videoCodec": attrib.get("videoCodec"),
+            "videoFrameRate": attrib.get("videoFrameRate"),
+            "videoResolution": attrib.get("videoResolution"),
+            "videoProfile": attrib.get("videoProfile"),
+            "parts": [cls.media_part_element_to_dict(part) for part in media.findall("Part")],
+        }
+
+    @classmethod
+    def media_part_element_to_dict(cls, part) -> dict:
+        attrib = part.attrib
+        return {
+            "id": plexutils.cast(int, attrib.get("id")),
+            "container": attrib.get("container"),
+            "duration": plexutils.cast(int, attrib.get("duration")),
+            "file": attrib.get("file"),
+            "indexes": attrib.get("indexes"),
+            "key": attrib.get("key"),
+            "size": plexutils.cast(int, attrib.get("size")),
+            "exists": plexutils.cast(bool, attrib.get("exists")),
+            "accessible": plexutils.cast(bool, attrib.get("accessible")),
+            "streams": [
+                cls.media_part_stream_element_to_dict(stream)
+                for stream in part.findall("Stream")
+                if stream.attrib.get("streamType") == "1"  # video streams only
+            ],
+        }
+
+    @classmethod
+    def media_part_stream_element_to_dict(cls, stream) -> dict:
+        attrib = stream.attrib
+        return {
+            "id": plexutils.cast(int, attrib.get("id")),
+            "codec": attrib.get("codec"),
+            "codecID": attrib.get("codecID"),
+            "language": attrib.get("language"),
+            "languageCode": attrib.get("languageCode"),
+            "selected": plexutils.cast(bool, attrib.get("selected", "0")),
+            "type": plexutils.cast(int, attrib.get("streamType")),
+        }
+
     @trace_time
-    def get_thumbnail_url(self, content_key):
-        item = self.get_content(content_key)
-        if item is not None:
-            return item.thumbUrl
-        else:
-            return ""
+    def get_thumbnail_path(self, content_key):
+        # Only the path is cached, the token is added when fetching so it isn't written to disk
+        def fetch():
+            item = self.get_content(content_key)
+            if item is not None and item.thumb:
+                return item.thumb
+            else:
+                return ""
+
+        return self.shared_cache.get_or_compute(f"thumb-path:{self.baseurl}{content_key}", self.metadata_ttl, fetch)
+
+    def forget_thumbnail_path(self, content_key):
+        self.shared_cache.delete(f"thumb-path:{self.baseurl}{content_key}")
+
+    def get_thumb_url(self, thumb):
+        # Serialized items hold the thumb path, which is cached and indexed on
+        # disk, so the token is only added to the URL when responding
+        if not thumb or not thumb.startswith("/"):
+            # No thumb, or a URL serialized by an earlier version
+            return thumb
+        return self.plex.url(thumb, includeToken=True)
 
     @classmethod
     @trace_time
@@ -315,11 +1095,7 @@ class PlexWrapper(object):
                 for media_part_stream in media_part.videoStreams()
             ],
         }
-        with ThreadPoolExecutor(max_workers=len(attributes_to_fetch)) as executor:
-            future_to_attr = {executor.submit(cls.fetch_attribute, func): attr for attr, func in attributes_to_fetch.items()}
-            for future in as_completed(future_to_attr):
-                attr = future_to_attr[future]
-                results[attr] = future.result()
+        cls.fetch_attributes(attributes_to_fetch, results)
         return results
 
     @classmethod
@@ -336,9 +1112,58 @@ class PlexWrapper(object):
             "selected": lambda: media_part_stream.selected,
             "type": lambda: media_part_stream.type,
         }
-        with ThreadPoolExecutor(max_workers=len(attributes_to_fetch)) as executor:
-            future_to_attr = {executor.submit(cls.fetch_attribute, func): attr for attr, func in attributes_to_fetch.items()}
-            for future in as_completed(future_to_attr):
-                attr = future_to_attr[future]
-                results[attr] = future.result()
+        cls.fetch_attributes(attributes_to_fetch, results)
         return results
+
+
+# One PlexWrapper per configured server, keyed by server name
+_shared_wrappers = {}
+_shared_wrappers_lock = threading.Lock()
+# Held while a server's wrapper connects, so a slow server only blocks its own callers
+_wrapper_locks = {}
+
+
+def get_plex_wrapper(server=None):
+    """
+    Return the PlexWrapper shared by every request in this process for the
+    named server, by default the first one configured.
+    """
+    config = get_server_config(server)
+    with _shared_wrappers_lock:
+        wrapper = _shared_wrappers.get(config.name)
+        lock = _wrapper_locks.setdefault(config.name, threading.Lock())
+    if wrapper is None:
+        with lock:
+            wrapper = _shared_wrappers.get(config.name)
+            if wrapper is None:
+                wrapper = PlexWrapper(config.baseurl, config.token, config.name, config.config_dir)
+                _shared_wrappers[config.name] = wrapper
+                return wrapper
+    wrapper.ensure_connected()
+    return wrapper
+
+
+def get_existing_plex_wrapper(server=None):
+    """
+    Return the PlexWrapper already created for the named server, or None,
+    without connecting or checking the connection.
+    """
+    return _shared_wrappers.get(get_server_config(server).name)
+
+
+def mark_plex_wrapper_unhealthy(server=None):
+    wrapper = get_existing_plex_wrapper(server)
+    if wrapper is not None:
+        wrapper.mark_unhealthy()
+
+
+def _reset_shared_wrapper():
+    # uWSGI forks workers from the master process; never share a connection
+    # pool (or its sockets) between parent and child.
+    global _shared_wrappers, _shared_wrappers_lock, _wrapper_locks
+    _shared_wrappers = {}
+    _shared_wrappers_lock = threading.Lock()
+    _wrapper_locks = {}
+
+
+os.register_at_fork(after_in_child=_reset_shared_wrapper)
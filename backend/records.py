@@ -0,0 +1,98 @@
+import sys
+
+# Unset slots are left out of to_dict(), so movies and episodes keep their
+# own keys
+_MISSING = object()
+
+
+class Record(object):
+    """
+    Compact, slotted form of a serialized dict. Scan results held in memory
+    for a long time (the dupe index, the sample cache) are stored as records
+    and only turned back into dicts when a response is written, which saves
+    the per-item dict and lets repeated strings such as codecs, containers
+    and library names be shared through sys.intern().
+    """
+
+    __slots__ = ()
+    # Fields are serialized in this order
+    FIELDS = ()
+    # Low-cardinality string fields, interned so every record shares one copy
+    INTERNED = ()
+    # Fields holding a list of child records, mapped to the record class
+    CHILDREN = {}
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        for name in cls.FIELDS:
+            if name not in data:
+                continue
+            value = data[name]
+            if name in cls.CHILDREN:
+                value = tuple(cls.CHILDREN[name].from_dict(child) for child in value)
+            elif name in cls.INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(record, name, value)
+        return record
+
+    def to_dict(self):
+        results = {}
+        for name in self.FIELDS:
+            value = getattr(self, name, _MISSING)
+            if value is _MISSING:
+                continue
+            if name in self.CHILDREN:
+                value = [child.to_dict() for child in value]
+            results[name] = value
+        return results
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class StreamRecord(Record):
+    FIELDS = ("id", "codec", "codecID", "language", "languageCode", "selected", "type")
+    INTERNED = ("codec", "codecID", "language", "languageCode")
+    __slots__ = FIELDS
+
+
+class PartRecord(Record):
+    FIELDS = ("id", "container", "duration", "file", "indexes", "key", "size", "exists", "accessible", "streams")
+    INTERNED = ("container", "indexes")
+    CHILDREN = {"streams": StreamRecord}
+    __slots__ = FIELDS
+
+
+class MediaRecord(Record):
+    FIELDS = (
+        "id", "aspectRatio", "audioChannels", "audioCodec", "bitrate", "container", "duration", "width", "height",
+        "has64bitOffsets", "optimizedForStreaming", "target", "title", "videoCodec", "videoFrameRate",
+        "videoResolution", "videoProfile", "parts",
+    )
+    INTERNED = (
+        "audioCodec", "container", "target", "videoCodec", "videoFrameRate", "videoResolution", "videoProfile",
+    )
+    CHILDREN = {"parts": PartRecord}
+    __slots__ = FIELDS
+
+
+class ContentRecord(Record):
+    """A movie or episode with its media, as built by movie_to_dict/episode_to_dict."""
+
+    FIELDS = (
+        "ignored", "key", "librarySectionID", "thumbUrl", "title", "type", "url", "contentType", "library",
+        "duration", "guid", "originalTitle", "year", "seasonNumber", "seasonEpisode", "seriesTitle", "media",
+    )
+    INTERNED = ("type", "contentType", "library", "seriesTitle")
+    CHILDREN = {"media": MediaRecord}
+    __slots__ = FIELDS
+
+
+class FingerprintRecord(Record):
+    """What cross-library matching needs to know about an item: its guid and,
+    for every media, the total file size and duration."""
+
+    FIELDS = ("library", "key", "title", "type", "year", "guid", "updatedAt", "files")
+    INTERNED = ("library", "type")
+    __slots__ = FIELDS
@@ -0,0 +1,163 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+from logger import get_logger
+from records import ContentRecord
+from utils import get_counter, trace_time
+
+logger = get_logger(__name__)
+
+
+class DupeScanner(object):
+    """
+    Scans every configured library for duplicates in the background and writes
+    the serialized results into the wrapper's DupeIndex. Scans can be started
+    on demand, or every SCAN_INTERVAL seconds when that is set.
+
+    Only one process scans at a time (guarded by a lock file under CONFIG_DIR),
+    and progress is written next to the index so any worker can report it.
+    """
+
+    def __init__(self, wrapper_factory, config_dir=None):
+        config_dir = config_dir or os.environ.get("CONFIG_DIR", "")  # Will be set by Dockerfile
+        self.wrapper_factory = wrapper_factory
+        self.page_size = int(os.environ.get("SCAN_PAGE_SIZE", 200))
+        self.interval = int(os.environ.get("SCAN_INTERVAL", 0))
+        self.lock_path = os.path.join(config_dir, "dupe_scan.lock")
+        self.status_path = os.path.join(config_dir, "dupe_scan_status.json")
+        self.thread = None
+        self.scheduler = None
+        self.lock = threading.Lock()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.is_running():
+                return False
+            self.thread = threading.Thread(target=self._run, name="dupe-scanner", daemon=True)
+            self.thread.start()
+            return True
+
+    def start_scheduler(self):
+        with self.lock:
+            if self.interval <= 0 or (self.scheduler is not None and self.scheduler.is_alive()):
+                return
+            self.scheduler = threading.Thread(target=self._schedule, name="dupe-scan-scheduler", daemon=True)
+            self.scheduler.start()
+
+    def _schedule(self):
+        while True:
+            try:
+                age = self.wrapper_factory().dupe_index.age()
+                if age is None or age >= self.interval:
+                    self.start()
+                    self.thread.join()
+                    age = 0
+            except Exception as e:
+                # Plex is unreachable; try again in an interval rather than give up on it
+                logger.error(f"Scheduled dupe scan skipped: {e}")
+                age = 0
+            time.sleep(max(self.interval - age, 1))
+
+    def _read_status(self):
+        try:
+            with open(self.status_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"state": "idle", "sections": {}}
+
+    @staticmethod
+    def _get_scanned_at(status):
+        # When the dupe index was last replaced by a scan
+        if "scannedAt" in status:
+            return status["scannedAt"]
+        if status["state"] == "idle" and "startedAt" in status:
+            # Written before scannedAt was recorded, by a scan that succeeded
+            return status["startedAt"]
+        return None
+
+    def get_status(self):
+        status = self._read_status()
+        # Taken from the status rather than the wrapper's index, so reporting
+        # on a server never connects to it
+        scanned_at = self._get_scanned_at(status)
+        status["scanAge"] = time.time() - scanned_at if scanned_at is not None else None
+        return status
+
+    def _write_status(self, status):
+        tmp_path = f"{self.status_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, self.status_path)
+
+    def _run(self):
+        with open(self.lock_path, "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug("Dupe scan already running in another process")
+                return
+            try:
+                self.scan()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @trace_time
+    def scan(self):
+        status = {"state": "scanning", "startedAt": time.time(), "sections": {}}
+        # Kept if this scan fails
+        scanned_at = self._get_scanned_at(self._read_status())
+        if scanned_at is not None:
+            status["scannedAt"] = scanned_at
+        requests_before = get_counter("plex_http_requests")
+        dupes = []
+        sections = []
+        try:
+            wrapper = self.wrapper_factory()
+            for section in wrapper._get_sections():
+                if section.type not in ("movie", "show"):
+                    continue
+                sections.append(section)
+                progress = {"total": wrapper.count_dupe_content_for_section(section), "scanned": 0}
+                status["sections"][section.title] = progress
+                self._write_status(status)
+                offset = 0
+                while True:
+                    results, fetched = wrapper.scan_dupe_content_for_section(section, offset, self.page_size)
+                    # Held as records until the scan is done, to keep huge libraries small
+                    dupes.extend(ContentRecord.from_dict(result) for result in results)
+                    offset += fetched
+                    progress["scanned"] = offset
+                    self._write_status(status)
+                    if fetched < self.page_size:
+                        break
+
+            # Items ignored while the scan was running would otherwise be lost
+            ignored_keys = wrapper.db.get_ignored_items(item.key for item in dupes)
+            for item in dupes:
+                item.ignored = item.key in ignored_keys
+            wrapper.dupe_index.replace(dupes, status["startedAt"])
+            status["scannedAt"] = status["startedAt"]
+
+            cross_library_index = wrapper.cross_library_index
+            # With several servers, even a single library can have content on another server
+            if cross_library_index.enabled and (len(sections) > 1 or wrapper.name is not None):
+                status["crossLibrary"] = {"state": "scanning"}
+                self._write_status(status)
+                changed = cross_library_index.update(wrapper, sections, self.page_size)
+                status["crossLibrary"] = {"state": "idle", "changed": changed}
+            status["state"] = "idle"
+        except Exception as e:
+            logger.error(f"Dupe scan failed: {e}")
+            status["state"] = "failed"
+            status["error"] = str(e)
+        status["finishedAt"] = time.time()
+        # Includes any other Plex traffic from this process during the scan
+        status["plexRequests"] = get_counter("plex_http_requests") - requests_before
+        logger.debug("Dupe scan issued %s Plex HTTP requests", status["plexRequests"])
+        self._write_status(status)
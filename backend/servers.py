@@ -0,0 +1,183 @@
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+ServerConfig = namedtuple("ServerConfig", ("name", "baseurl", "token", "config_dir"))
+
+# Server names are used as directory names under CONFIG_DIR/servers
+SERVER_NAME_PATTERN = re.compile(r"^\w[\w .-]*$", re.ASCII)
+
+
+class UnknownServerError(Exception):
+    pass
+
+
+class MissingServerError(Exception):
+    pass
+
+
+def parse_servers(value, default_token=None, config_dir=""):
+    """
+    Parse PLEX_SERVERS: entries separated by ";" like LIBRARY_NAMES, each
+    "name|url|token", where the token defaults to PLEX_TOKEN.
+    """
+    configs = []
+    for entry in value.split(";"):
+        if entry.strip() == "":
+            continue
+        fields = [field.strip() for field in entry.split("|")]
+        if len(fields) not in (2, 3) or not fields[1]:
+            raise ValueError(f"Expected name|url|token in PLEX_SERVERS, got {entry!r}")
+        name, baseurl = fields[:2]
+        token = fields[2] if len(fields) == 3 and fields[2] else default_token
+        if not SERVER_NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid server name {name!r} in PLEX_SERVERS")
+        if any(config.name == name for config in configs):
+            raise ValueError(f"Server {name!r} appears more than once in PLEX_SERVERS")
+        configs.append(ServerConfig(name, baseurl, token, os.path.join(config_dir, "servers", name)))
+    return configs
+
+
+_server_configs = None
+
+
+def get_server_configs():
+    """
+    The Plex servers to manage, in the order given. Without PLEX_SERVERS
+    this is a single server from PLEX_BASE_URL and PLEX_TOKEN, named None,
+    whose state stays directly under CONFIG_DIR as before. Each server listed
+    in PLEX_SERVERS keeps its own under CONFIG_DIR/servers/<name>.
+    """
+    global _server_configs
+    if _server_configs is None:
+        value = os.environ.get("PLEX_SERVERS", "")
+        if value.strip() == "":
+            configs = [ServerConfig(None, os.environ.get("PLEX_BASE_URL"), os.environ.get("PLEX_TOKEN"), None)]
+        else:
+            config_dir = os.environ.get("CONFIG_DIR", "")  # Will be set by Dockerfile
+            configs = parse_servers(value, os.environ.get("PLEX_TOKEN"), config_dir)
+            for config in configs:
+                os.makedirs(config.config_dir, exist_ok=True)
+        _server_configs = configs
+    return _server_configs
+
+
+def get_server_config(name=None):
+    configs = get_server_configs()
+    if name is None:
+        return configs[0]
+    for config in configs:
+        if config.name == name:
+            return config
+    raise UnknownServerError(f"Unknown server {name!r}")
+
+
+def is_multi_server():
+    return get_server_configs()[0].name is not None
+
+
+class ServerPool(object):
+    """
+    Runs the same call against every configured Plex server at once, so one
+    slow or offline server can't hold up the others. Each server has its own
+    few workers: calls stuck on an unreachable server only tie up that
+    server's workers, and once they are all busy further calls to it fail
+    straight away rather than queueing. Callers wait up to SERVER_TIMEOUT
+    seconds; a server that hasn't answered by then is reported as timed out,
+    and whatever it returns later is dropped. A server that failed or timed
+    out is left alone for SERVER_RETRY_INTERVAL seconds, reporting the same
+    error, so an offline server doesn't cost every request the full timeout.
+    """
+
+    def __init__(self, wrapper_factory, configs=None):
+        self.wrapper_factory = wrapper_factory
+        self.configs = configs or get_server_configs()
+        self.timeout = float(os.environ.get("SERVER_TIMEOUT", 30))
+        self.workers = int(os.environ.get("SERVER_WORKERS", 4))
+        self.retry_interval = float(os.environ.get("SERVER_RETRY_INTERVAL", 30))
+        self.lock = threading.Lock()
+        self.executors = {
+            config.name: ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"server-{config.name}")
+            for config in self.configs
+        }
+        self.in_flight = {config.name: 0 for config in self.configs}
+        # Outcome of the last call to each server
+        self.status = {config.name: {"state": "unknown"} for config in self.configs}
+        # Server name -> time.monotonic() before which it isn't called again
+        self.retry_at = {}
+
+    def _call(self, name, function):
+        try:
+            # Connecting happens here too, on the server's own workers
+            return function(self.wrapper_factory(name))
+        finally:
+            with self.lock:
+                self.in_flight[name] -= 1
+
+    def _set_status(self, name, state, error=None):
+        status = {"state": state, "at": time.time()}
+        if error is not None:
+            status["error"] = error
+        with self.lock:
+            self.status[name] = status
+            if state in ("error", "timeout"):
+                self.retry_at[name] = time.monotonic() + self.retry_interval
+            elif state == "ok":
+                self.retry_at.pop(name, None)
+
+    def map(self, function, timeout=None):
+        """
+        Call function(wrapper) for every server. Returns the results of the
+        servers that answered in time, in configured order, and the error
+        message of every other server, both keyed by server name.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        futures = {}
+        errors = {}
+        for config in self.configs:
+            name = config.name
+            with self.lock:
+                if time.monotonic() < self.retry_at.get(name, 0):
+                    errors[name] = self.status[name]["error"]
+                    continue
+                busy = self.in_flight[name] >= self.workers
+                if not busy:
+                    self.in_flight[name] += 1
+            if busy:
+                errors[name] = "Still waiting for earlier requests to this server"
+                self._set_status(name, "busy", errors[name])
+                continue
+            futures[self.executors[name].submit(self._call, name, function)] = name
+
+        done, not_done = wait(futures, timeout=timeout)
+        results = {}
+        for future in done:
+            name = futures[future]
+            try:
+                results[name] = future.result()
+                self._set_status(name, "ok")
+            except Exception as e:
+                logger.error(f"Request to server {name} failed: {e}")
+                errors[name] = str(e)
+                self._set_status(name, "error", errors[name])
+        for future in not_done:
+            name = futures[future]
+            errors[name] = f"No answer within {timeout:g} seconds"
+            self._set_status(name, "timeout", errors[name])
+        ordered = {config.name: results[config.name] for config in self.configs if config.name in results}
+        return ordered, errors
+
+    def get_status(self):
+        with self.lock:
+            return [
+                {"name": config.name, "url": config.baseurl, "inFlight": self.in_flight[config.name],
+                 **self.status[config.name]}
+                for config in self.configs
+            ]
@@ -0,0 +1,151 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils import increment_counter
+
+CACHE_FILENAME = "cache.db"
+# Expired entries are deleted once every this many writes
+PRUNE_EVERY = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS locks (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class SharedCache(object):
+    """
+    JSON results shared by every uWSGI worker through a SQLite file under
+    CONFIG_DIR, each with its own TTL. get_or_compute() is single-flight
+    across processes: the first caller to miss a key takes a lock row and
+    computes it, while other callers poll until the value appears. Locks
+    expire after SHARED_CACHE_LOCK_TIMEOUT seconds, so a worker that dies
+    mid-computation only holds the others up until then.
+
+    Set SHARED_CACHE=0 to compute everything in-process, as before.
+    """
+
+    def __init__(self, path=None):
+        config_dir = os.environ.get("CONFIG_DIR", "")  # Will be set by Dockerfile
+        self.path = path or os.path.join(config_dir, CACHE_FILENAME)
+        self.enabled = os.environ.get("SHARED_CACHE", "1") == "1"
+        self.lock_timeout = float(os.environ.get("SHARED_CACHE_LOCK_TIMEOUT", 120))
+        self.local = threading.local()
+        self._writes = 0
+        if self.enabled:
+            self.get_db().executescript(SCHEMA)
+
+    def get_db(self):
+        # One connection per thread, as in Database
+        if not hasattr(self.local, "db"):
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            # Losing the last writes to a crash only costs recomputing them
+            db.execute("PRAGMA synchronous=OFF")
+            self.local.db = db
+        return self.local.db
+
+    @staticmethod
+    def _owner():
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def _get(self, key):
+        row = self.get_db().execute(
+            "SELECT value FROM entries WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return (True, json.loads(row[0])) if row is not None else (False, None)
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        found, value = self._get(key)
+        return value if found else default
+
+    def set(self, key, value, ttl):
+        if not self.enabled:
+            return
+        now = time.time()
+        db = self.get_db()
+        db.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), now + ttl),
+        )
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            db.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+
+    def delete(self, key):
+        if not self.enabled:
+            return
+        self.get_db().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def delete_prefix(self, prefix):
+        if not self.enabled:
+            return
+        # Keys are compared as text, so every key starting with prefix sorts in [prefix, prefix + U+10FFFF)
+        self.get_db().execute("DELETE FROM entries WHERE key >= ? AND key < ?", (prefix, prefix + "\U0010ffff"))
+
+    def _try_lock(self, key, owner):
+        now = time.time()
+        db = self.get_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM locks WHERE key = ? AND expires_at <= ?", (key, now))
+            acquired = db.execute(
+                "INSERT OR IGNORE INTO locks (key, owner, expires_at) VALUES (?, ?, ?)",
+                (key, owner, now + self.lock_timeout),
+            ).rowcount == 1
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return acquired
+
+    def _unlock(self, key, owner):
+        self.get_db().execute("DELETE FROM locks WHERE key = ? AND owner = ?", (key, owner))
+
+    def get_or_compute(self, key, ttl, compute):
+        """
+        Return the cached value of key, or compute(), cache and return it. The
+        value must survive a JSON round trip, as other workers get it decoded.
+        """
+        if not self.enabled:
+            return compute()
+        found, value = self._get(key)
+        if found:
+            increment_counter("shared_cache_hits")
+            return value
+        owner = self._owner()
+        delay = 0.05
+        while not self._try_lock(key, owner):
+            # Another worker or thread is computing it
+            increment_counter("shared_cache_waits")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            found, value = self._get(key)
+            if found:
+                increment_counter("shared_cache_hits")
+                return value
+        try:
+            # It may have been stored between our miss and taking the lock
+            found, value = self._get(key)
+            if found:
+                increment_counter("shared_cache_hits")
+                return value
+            increment_counter("shared_cache_misses")
+            value = compute()
+            self.set(key, value, ttl)
+            return value
+        finally:
+            self._unlock(key, owner)
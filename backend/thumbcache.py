@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from plexapi import utils as plexutils
+
+from logger import get_logger
+from utils import increment_counter, trace_time
+
+logger = get_logger(__name__)
+
+
+class ThumbnailCache(object):
+    """
+    Disk-backed thumbnail cache under CONFIG_DIR/thumbnails, addressed by
+    content key. Each entry is the image plus a small JSON sidecar holding
+    the Plex thumb path and the validators Plex returned, so stale entries are
+    revalidated with a conditional request instead of refetched. The least
+    recently used entries are evicted once the cache grows past its size cap.
+    """
+
+    def __init__(self):
+        config_dir = os.environ.get("CONFIG_DIR", "")  # Will be set by Dockerfile
+        self.path = os.path.join(config_dir, "thumbnails")
+        self.max_bytes = int(os.environ.get("THUMBNAIL_CACHE_SIZE_MB", 256)) * 1024 * 1024
+        self.ttl = int(os.environ.get("THUMBNAIL_CACHE_TTL", 24 * 60 * 60))
+        # When set, Plex resizes thumbnails with its transcoder before sending them
+        self.width = int(os.environ.get("THUMBNAIL_WIDTH", 0))
+        self.height = int(os.environ.get("THUMBNAIL_HEIGHT", 0))
+        self.lock = threading.Lock()
+        self.total_bytes = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, content_key, server=None):
+        # Content keys are only unique within a server
+        if server is not None:
+            content_key = f"{server}:{content_key}"
+        name = hashlib.sha1(f"{content_key}@{self.width}x{self.height}".encode()).hexdigest()
+        return os.path.join(self.path, name)
+
+    @staticmethod
+    def _read_meta(entry_path):
+        try:
+            with open(entry_path + ".json") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_meta(entry_path, meta):
+        tmp_path = f"{entry_path}.json.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, entry_path + ".json")
+
+    def _get_upstream_path(self, wrapper, content_key):
+        path = wrapper.get_thumbnail_path(content_key)
+        if path and (self.width or self.height):
+            # Same request as PlexServer.transcodeImage, minus the token
+            params = {
+                "url": path,
+                "height": self.height or self.width,
+                "width": self.width or self.height,
+                "minSize": 1,
+                "upscale": 1,
+            }
+            path = f"/photo/:/transcode{plexutils.joinArgs(params)}"
+        return path
+
+    def _remove(self, entry_path):
+        for path in (entry_path, entry_path + ".json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @trace_time
+    def get(self, wrapper, content_key):
+        """
+        Returns (path, meta) for the cached thumbnail of content_key, fetching
+        or revalidating it first when needed, or (None, None) if the content
+        has no thumbnail or Plex can't find it.
+        """
+        entry_path = self._entry_path(content_key, wrapper.name)
+        meta = self._read_meta(entry_path)
+        # Entries written before thumb paths were stored are fetched again
+        if meta is not None and "path" in meta and os.path.isfile(entry_path):
+            # Touch the image so eviction treats it as recently used
+            os.utime(entry_path)
+            if time.time() - meta["fetchedAt"] < self.ttl:
+                increment_counter("thumbnail_cache_hits")
+                return entry_path, meta
+        else:
+            meta = None
+        increment_counter("thumbnail_cache_misses")
+
+        if meta is not None:
+            headers = {}
+            if meta.get("upstreamEtag"):
+                headers["If-None-Match"] = meta["upstreamEtag"]
+            if meta.get("lastModified"):
+                headers["If-Modified-Since"] = meta["lastModified"]
+            r = self._fetch(wrapper, meta["path"], headers)
+            if r.status_code == 304:
+                meta["fetchedAt"] = time.time()
+                self._write_meta(entry_path, meta)
+                return entry_path, meta
+            if r.status_code in (404, 410):
+                # The artwork changed since it was cached, look the thumb up again
+                logger.debug("Thumbnail of %s is gone upstream, resolving it again", content_key)
+                r.close()
+                self._remove(entry_path)
+                wrapper.forget_thumbnail_path(content_key)
+                meta = None
+        if meta is None:
+            path = self._get_upstream_path(wrapper, content_key)
+            if not path:
+                return None, None
+            r = self._fetch(wrapper, path)
+            if r.status_code in (404, 410):
+                # Same as having no thumbnail, and the path is looked up again next time
+                r.close()
+                wrapper.forget_thumbnail_path(content_key)
+                return None, None
+        else:
+            path = meta["path"]
+        r.raise_for_status()
+
+        tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(r.content)
+        os.replace(tmp_path, entry_path)
+        meta = {
+            "path": path,
+            "etag": hashlib.sha1(r.content).hexdigest(),
+            "upstreamEtag": r.headers.get("ETag"),
+            "lastModified": r.headers.get("Last-Modified"),
+            "contentType": r.headers.get("Content-Type", "image/jpeg"),
+            "fetchedAt": time.time(),
+        }
+        self._write_meta(entry_path, meta)
+        self._add_bytes(len(r.content))
+        return entry_path, meta
+
+    @staticmethod
+    def _fetch(wrapper, path, headers=None):
+        url = wrapper.plex.url(path, includeToken=True)
+        return wrapper.plex._session.get(url, headers=headers, timeout=wrapper.timeout)
+
+    def _add_bytes(self, size):
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(entry.stat().st_size for entry in self._image_entries())
+            else:
+                self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _image_entries(self):
+        return [
+            entry for entry in os.scandir(self.path)
+            if entry.is_file() and "." not in entry.name
+        ]
+
+    def _evict(self):
+        # Oldest access first, down to 90% of the cap so we don't evict on every write
+        entries = sorted(self._image_entries(), key=lambda entry: entry.stat().st_mtime)
+        total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total_bytes <= self.max_bytes * 0.9:
+                break
+            logger.debug("Evicting thumbnail %s", entry.name)
+            total_bytes -= entry.stat().st_size
+            self._remove(entry.path)
+        self.total_bytes = total_bytes
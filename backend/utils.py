@@ -1,30 +1,103 @@
+import base64
+import json
 import os
+import threading
 import time
+from collections import Counter, deque
 from functools import wraps
+
+import metrics
 from logger import get_logger
 
 logger = get_logger(__name__)
-traces = []
+# Only the most recent traces are kept, so long-running workers don't grow
+traces = deque(maxlen=int(os.getenv("TRACE_LIMIT", 10000)))
+counters = Counter()
+counters_lock = threading.Lock()
 
 
 def trace_time(method):
+    debug = os.getenv("DEBUG") == "1"
+    if not debug and not metrics.enabled:
+        return method
+    name = method.__qualname__
+
     @wraps(method)
     def timed(*args, **kw):
-        if os.getenv("DEBUG") != "1":
-            return method(*args, **kw)
         start_time = time.perf_counter()
-        result = method(*args, **kw)
-        end_time = time.perf_counter()
-        duration = end_time - start_time
-        traces.append((method.__name__, duration))
-        logger.debug(f"{method.__name__} took {duration} seconds")
-        return result
+        try:
+            return method(*args, **kw)
+        finally:
+            duration = time.perf_counter() - start_time
+            metrics.function_latency.observe(duration, name)
+            if debug:
+                traces.append((method.__name__, duration))
+                logger.debug(f"{method.__name__} took {duration} seconds")
     return timed
 
+def increment_counter(name, amount=1):
+    with counters_lock:
+        counters[name] += amount
+
+
+def get_counter(name):
+    return counters[name]
+
+
+def collect_counters():
+    with counters_lock:
+        values = dict(counters)
+    for name, value in sorted(values.items()):
+        yield f"cleanarr_{name}_total", "counter", f"Total {name.replace('_', ' ')}.", [({}, value)]
+    # Counters named <cache>_cache_hits/<cache>_cache_misses also get a hit ratio
+    ratios = []
+    for name, hits in sorted(values.items()):
+        if name.endswith("_cache_hits"):
+            cache = name[:-len("_cache_hits")]
+            requests = hits + values.get(f"{cache}_cache_misses", 0)
+            ratios.append(({"cache": cache}, hits / requests if requests else 0.0))
+    if ratios:
+        yield "cleanarr_cache_hit_ratio", "gauge", "Fraction of cache lookups that were hits.", ratios
+
+
+metrics.registry.register_collector(collect_counters)
+
+
+def encode_cursor(state):
+    # Cursors are opaque to clients: urlsafe base64 of the JSON pagination state
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode()
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def decode_cursor(cursor, expected=None):
+    """
+    Decode a cursor made by encode_cursor. When expected is given, the cursor
+    must hold that key: cursors of the live listing hold "offsets", those of
+    the dupe index "after", and one from the other listing is rejected rather
+    than silently starting over from the first page.
+    """
+    if not cursor:
+        return {}
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}")
+    if not isinstance(state, dict):
+        raise InvalidCursorError(f"Invalid cursor: {cursor}")
+    if expected is not None and expected not in state:
+        raise InvalidCursorError("Cursor was issued by another listing, request the first page again")
+    return state
+
+
 def print_top_traces(n):
     # Sort the traces by the execution time and print the top N
     top_traces = sorted(traces, key=lambda record: record[1], reverse=True)[:n]
     print("==================================================================")
     for method, time_taken in top_traces:
         print(f"{method} took {time_taken} seconds")
+    for name, value in sorted(counters.items()):
+        print(f"{name}: {value}")
     print("==================================================================")
@@ -53,7 +53,7 @@ export const ContentPage:FunctionComponent<any> = () => {
       movie.media.forEach(media => {
         if (media.id in mediaStore.media) {
           promises.push(
-            mediaStore.deleteMedia(movie.library, movie.key, media).then(() => {
+            mediaStore.deleteMedia(movie.library, movie.key, media, movie.server).then(() => {
               deletedMediaStore.addMedia(media);
             })
           )
@@ -144,7 +144,7 @@ export const ContentPage:FunctionComponent<any> = () => {
       id: 'delete-toaster'
     });
     mediaStore.isDeleting = true;
-    mediaStore.deleteMedia(movie.library, movie.key, media).then(() => {
+    mediaStore.deleteMedia(movie.library, movie.key, media, movie.server).then(() => {
       deletedMediaStore.addMedia(media);
       mediaStore.isDeleting = false;
       toaster.success(`Item deleted!`, {
@@ -157,11 +157,11 @@ export const ContentPage:FunctionComponent<any> = () => {
   }
 
   const onIgnoreContent = (content: Content) => {
-    contentStore.ignoreContent(content.key);
+    contentStore.ignoreContent(content.key, content.server);
   }
 
   const onUnIgnoreContent = (content: Content) => {
-    contentStore.unIgnoreContent(content.key);
+    contentStore.unIgnoreContent(content.key, content.server);
   }
 
   const onChangeIncludeIgnored = (value: boolean) => {
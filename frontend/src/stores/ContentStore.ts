@@ -69,12 +69,12 @@ export class ContentStore {
   }
 
   @action
-  async ignoreContent(contentKey: string): Promise<any> {
+  async ignoreContent(contentKey: string, server?: string): Promise<any> {
     return new Promise((resolve, reject) => {
-      ignoreMedia(contentKey)
+      ignoreMedia(contentKey, server)
           .then(() => {
             for (let i = 0; i < this.content.length; i++) {
-              if (this.content[i].key === contentKey) {
+              if (this.content[i].key === contentKey && this.content[i].server === server) {
                 const item = {
                   ...this.content[i],
                   ignored: true,
@@ -94,12 +94,12 @@ export class ContentStore {
   }
 
   @action
-  async unIgnoreContent(contentKey: string): Promise<any> {
+  async unIgnoreContent(contentKey: string, server?: string): Promise<any> {
     return new Promise((resolve, reject) => {
-      unIgnoreMedia(contentKey)
+      unIgnoreMedia(contentKey, server)
         .then(() => {
           for (let i = 0; i < this.content.length; i++) {
-            if (this.content[i].key === contentKey) {
+            if (this.content[i].key === contentKey && this.content[i].server === server) {
               const item = {
                 ...this.content[i],
                 ignored: false,
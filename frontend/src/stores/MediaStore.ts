@@ -25,9 +25,9 @@ export class MediaStore {
     this.media = {};
   }
 
-  deleteMedia(libraryName: string, movieKey: string, media: Media): Promise<any> {
+  deleteMedia(libraryName: string, movieKey: string, media: Media, server?: string): Promise<any> {
     return new Promise((resolve, reject) => {
-      deleteMedia(libraryName, movieKey, media.id)
+      deleteMedia(libraryName, movieKey, media.id, server)
         .then(() => {
           this.removeMedia(media);
           resolve();
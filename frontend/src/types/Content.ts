@@ -30,4 +30,5 @@ export interface Content {
   library: string,
   url: string,
   ignored: boolean,
+  server?: string,
 }
@@ -30,22 +30,25 @@ export const getSampleContent = (): Promise<any> => {
   return axios.get(SAMPLES_URL);
 };
 
-export const deleteMedia = (library: string, contentKey: string, mediaId: number): Promise<any> => {
+export const deleteMedia = (library: string, contentKey: string, mediaId: number, server?: string): Promise<any> => {
   return axios.post(DELETE_MEDIA_URL, {
     'library_name': library,
     'content_key': contentKey,
-    'media_id': mediaId
+    'media_id': mediaId,
+    'server': server
   })
 };
 
-export const ignoreMedia = (contentKey: string): Promise<any> => {
+export const ignoreMedia = (contentKey: string, server?: string): Promise<any> => {
   return axios.post(IGNORE_MEDIA_URL, {
-    'content_key': contentKey
+    'content_key': contentKey,
+    'server': server
   })
 };
 
-export const unIgnoreMedia = (contentKey: string): Promise<any> => {
+export const unIgnoreMedia = (contentKey: string, server?: string): Promise<any> => {
   return axios.post(UNIGNORE_MEDIA_URL, {
-    'content_key': contentKey
+    'content_key': contentKey,
+    'server': server
   })
 };